@@ -0,0 +1,175 @@
+"""Spiral Abyss: the best pairs of teams that share no character.
+
+Each half of the Abyss needs its own team, so a pair is two candidate teams
+(the Format A/B/C teams generate_teams_optimized ranks) without a character
+in common, scored as the sum of their score_teams scores. Traveler variants
+count as one character.
+
+Teams are encoded as bitmasks of the characters they use, so two teams are
+disjoint when their masks AND to zero. With the teams sorted best first,
+top_disjoint_pairs pairs each team with the best disjoint partners that
+could still enter the top ``num_pairs`` and stops at the first team whose
+best conceivable pair cannot. That only needs the teams scoring at least
+some cutoff: best_pairs starts the cutoff just below the best score and
+lowers it until no team under it could reach the current top pairs.
+Candidates come from the team index when it is ready (already scored and
+sorted per main) or are enumerated and scored best bound first.
+
+Ties are broken by team order -- score, then scoring.team_ranks -- and then
+by the pair's positions in that order, so the result is exactly that of
+ranking every disjoint pair (brute_force_pairs).
+"""
+import heapq
+
+import numpy as np
+
+import scoring
+
+# Initial distance of the cutoff below the best score; doubled as needed
+CUTOFF_STEP = 32
+
+
+def identities(names):
+    """Per roster index, an id shared by every variant of one character."""
+    ids = {}
+    return np.array([ids.setdefault('traveler' if name.startswith('traveler-') else name, len(ids))
+                     for name in names], dtype=np.int32)
+
+
+def team_masks(identity, teams):
+    """``(masks, valid)``: each team's characters as bits in uint64 words,
+    and whether its members are four different characters."""
+    ids = identity[teams]
+    words = int(identity.max()) // 64 + 1 if len(identity) else 1
+    masks = np.zeros((len(teams), words), dtype=np.uint64)
+    for k in range(4):
+        word, bit = np.divmod(ids[:, k], 64)
+        for w in range(words):
+            in_word = word == w
+            masks[in_word, w] |= np.left_shift(np.uint64(1), bit[in_word].astype(np.uint64))
+    valid = np.ones(len(teams), dtype=bool)
+    for a in range(4):
+        for b in range(a + 1, 4):
+            valid &= ids[:, a] != ids[:, b]
+    return masks, valid
+
+
+def top_disjoint_pairs(scores, masks, num_pairs, chunk_size=4096):
+    """The best ``num_pairs`` pairs of disjoint teams as ``(total, i, j)``,
+    ``i < j``, best first. ``scores`` must be sorted best first."""
+    best = []  # min-heap of (total, -i, -j): the worst kept pair on top
+    n = len(scores)
+    if num_pairs <= 0:
+        return []
+    negated = -scores
+    for i in range(n - 1):
+        full = len(best) == num_pairs
+        # Later pairs come after every kept one, so they lose ties
+        if full and scores[i] + scores[i + 1] <= best[0][0]:
+            break
+        # Partners that could still beat the worst kept pair, best first
+        end = n if not full else i + 1 + int(np.searchsorted(negated[i + 1:], scores[i] - best[0][0], side='right'))
+        start, need = i + 1, num_pairs
+        while start < end and need > 0:
+            stop = min(start + chunk_size, end)
+            disjoint = ~(masks[start:stop] & masks[i]).any(axis=1)
+            for j in (start + np.flatnonzero(disjoint)[:need]).tolist():
+                pair = (int(scores[i] + scores[j]), -i, -j)
+                if len(best) < num_pairs:
+                    heapq.heappush(best, pair)
+                elif pair > best[0]:
+                    heapq.heappushpop(best, pair)
+                else:
+                    need = 0
+                    break
+                need -= 1
+            start = stop
+    return [(total, -i, -j) for total, i, j in sorted(best, reverse=True)]
+
+
+def brute_force_pairs(scores, masks, num_pairs):
+    """top_disjoint_pairs by checking every pair; for small candidate sets."""
+    i, j = np.triu_indices(len(scores), 1)
+    disjoint = ~(masks[i] & masks[j]).any(axis=1)
+    i, j = i[disjoint], j[disjoint]
+    total = scores[i] + scores[j]
+    best = np.lexsort((j, i, -total))[:num_pairs]
+    return [(int(total[k]), int(i[k]), int(j[k])) for k in best]
+
+
+class EnumeratedCandidates:
+    """The teams of enumerate_candidates, scored in order of their upper
+    bound only as far as the cutoff requires."""
+
+    def __init__(self, roster, rules, teams, identity):
+        self.roster, self.rules, self.teams, self.identity = roster, rules, teams, identity
+        value = roster.tier_value + scoring.member_bonus_bounds(roster, rules)
+        bounds = scoring.team_bounds(roster, teams, value)
+        self.order = np.argsort(-bounds)
+        self.bounds = bounds[self.order]
+        self.scores = np.empty(0, dtype=np.int64)  # of teams[order[:len(scores)]]
+        self.top = int(self.bounds[0]) if len(self.bounds) else 0
+
+    def fetch(self, cutoff):
+        """``(teams, scores, masks, ranks, complete)`` of every team scoring
+        at least ``cutoff`` (all of them if ``complete``)."""
+        n = int(np.searchsorted(-self.bounds, -cutoff, side='right'))
+        if n > len(self.scores):
+            more = self.teams[self.order[len(self.scores):n]]
+            self.scores = np.concatenate([self.scores, scoring.score_teams(self.roster, self.rules, more)])
+        complete = n == len(self.order)
+        keep = np.flatnonzero(self.scores[:n] >= cutoff) if not complete else np.arange(n)
+        # Copies of a team share its bound and score, so all of them are
+        # here; in enumeration order the first one is kept
+        keep = keep[np.argsort(self.order[keep])]
+        teams = self.teams[self.order[keep]]
+        masks, valid = team_masks(self.identity, teams)
+        valid &= scoring.first_occurrences(teams, len(self.roster))
+        teams = teams[valid]
+        return teams, self.scores[keep[valid]], masks[valid], scoring.team_ranks(teams, len(self.roster)), complete
+
+
+class IndexedCandidates:
+    """The candidate teams of a roster read from team_index shards, which
+    hold them scored and sorted best first per main DPS."""
+
+    def __init__(self, shards, table_size, roster, identity):
+        self.shards, self.roster, self.identity = shards, roster, identity
+        # Table id -> roster index, -1 for characters not in the roster
+        self.to_roster = np.full(table_size, -1, dtype=np.int16)
+        self.to_roster[roster.ids] = np.arange(len(roster), dtype=np.int16)
+        # The best team of a shard needn't be in the roster, so this is a bound
+        self.top = max((int(shard.scores[0]) for shard in shards if len(shard)), default=0)
+
+    def fetch(self, cutoff):
+        found_teams, found_scores, complete = [], [], True
+        for shard in self.shards:
+            n = int(np.searchsorted(-shard.scores, -cutoff, side='right'))
+            complete &= n == len(shard)
+            teams = self.to_roster[shard.members[:n]]
+            fits = (teams >= 0).all(axis=1)
+            found_teams.append(teams[fits])
+            found_scores.append(shard.scores[:n][fits].astype(np.int64))
+        teams = np.concatenate(found_teams) if found_teams else np.empty((0, 4), dtype=np.int16)
+        scores = np.concatenate(found_scores) if found_scores else np.empty(0, dtype=np.int64)
+        masks, valid = team_masks(self.identity, teams)
+        teams = teams[valid]
+        return teams, scores[valid], masks[valid], scoring.team_ranks(teams, len(self.roster)), complete
+
+
+def best_pairs(candidates, num_pairs):
+    """``[(total, team_a, team_b, score_a, score_b), ...]`` best first, teams
+    as rows of roster indices, from an Enumerated- or IndexedCandidates."""
+    step = CUTOFF_STEP
+    while True:
+        cutoff = candidates.top - step
+        teams, scores, masks, ranks, complete = candidates.fetch(cutoff)
+        order = np.lexsort((ranks, -scores))
+        teams, scores, masks = teams[order], scores[order], masks[order]
+        pairs = top_disjoint_pairs(scores, masks, num_pairs)
+        # Unfetched teams score below the cutoff, and so does any pair
+        # they are in once it falls under the worst pair kept
+        best_score = max(int(scores[0]), cutoff) if len(scores) else cutoff
+        if complete or (len(pairs) == num_pairs and cutoff + best_score <= pairs[-1][0]):
+            return [(total, teams[i], teams[j], int(scores[i]), int(scores[j])) for total, i, j in pairs]
+        step *= 2
@@ -0,0 +1,361 @@
+"""Fingerprinted, precompressed static assets.
+
+``python assets.py`` hashes every file under static/, writes gzip and
+brotli copies of the text assets (only gzip without the brotli package
+from requirements.txt) and a
+slim character index for the selector grid to STATIC_BUILD_DIR, and
+records it all in a manifest. Server startup loads the manifest and only
+re-hashes files whose size or mtime changed, so it rebuilds whatever is
+missing or stale itself.
+
+Every asset is served under two URLs: its plain path, answered with a
+content-hash ETag and ``Cache-Control: no-cache`` so browsers revalidate
+(and usually get a 304), and a fingerprinted one such as
+``styles.<hash>.css``, cached for a year as immutable. Pages link the
+fingerprinted URLs through the ``asset()`` template function, so a new
+deploy changes the URLs rather than relying on caches expiring. Text assets
+and pages are kept in memory, with their compressed variants, and picked by
+Accept-Encoding; images are sent from disk.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = 'static'
+BUILD_DIR = os.getenv('STATIC_BUILD_DIR', 'static_build')
+MANIFEST = 'manifest.json'
+# Generated from the selector's name list; replaces it for the grid
+CHARACTER_LIST = 'assets/images/characters/characters.json'
+CHARACTER_INDEX = 'character-index.json'
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Smaller files gain nothing from compression
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# Preferred first; gzip is always available
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+with open(__file__, 'rb') as _f:
+    SCHEMA_HASH = hashlib.sha256(_f.read() + ','.join(ENCODINGS).encode()).hexdigest()[:16]
+
+STATIC_BYTES = metrics.counter('static_bytes_total', "Static asset and page body bytes sent", ['encoding'])
+STATIC_RESPONSES = metrics.counter('static_responses_total', "Static asset and page responses", ['status'])
+
+
+def fingerprint(path, content_hash):
+    """``styles.css`` -> ``styles.<hash>.css``; extensionless names get a suffix."""
+    head, slash, name = path.rpartition('/')
+    stem, dot, ext = name.rpartition('.')
+    if not stem:  # no extension, or a dotfile
+        stem, dot, ext = name, '', ''
+    return f"{head}{slash}{stem}.{content_hash[:12]}{dot}{ext}"
+
+
+def icon_key(name):
+    # As login-functions.js derives icon directories from names
+    return name.lower().replace(' ', '_')
+
+
+def content_type(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def compressible(path, size):
+    return size >= MIN_COMPRESS_SIZE and content_type(path).startswith(COMPRESSIBLE)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def accepted_encodings(header):
+    """Codings named in an Accept-Encoding header, without those at q=0."""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        params = params.strip()
+        try:
+            q = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            q = 0.0
+        if q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def etag_matches(header, etag):
+    # If-None-Match uses the weak comparison
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+class Payload:
+    """One in-memory body and its compressed variants."""
+    __slots__ = ('body', 'content_hash', 'media_type', 'variants')
+
+    def __init__(self, body, media_type, variants=None):
+        self.body = body
+        self.content_hash = hashlib.sha256(body).hexdigest()[:20]
+        self.media_type = media_type
+        # encoding -> compressed body, only where smaller
+        self.variants = variants if variants is not None else {}
+
+    @classmethod
+    def compressed(cls, body, media_type):
+        payload = cls(body, media_type)
+        for encoding in ENCODINGS:
+            data = compress(body, encoding)
+            if len(data) < len(body):
+                payload.variants[encoding] = data
+        return payload
+
+    def response(self, headers, cache_control):
+        """200 or 304 for request ``headers``, with the best accepted encoding."""
+        encoding = None
+        if self.variants:
+            accepted = accepted_encodings(headers.get('accept-encoding', ''))
+            encoding = next((e for e in ENCODINGS if e in self.variants and e in accepted), None)
+        # Each representation needs its own strong ETag
+        etag = f'"{self.content_hash}-{encoding}"' if encoding else f'"{self.content_hash}"'
+        response_headers = {'etag': etag, 'cache-control': cache_control}
+        if self.variants:
+            response_headers['vary'] = 'Accept-Encoding'
+        if etag_matches(headers.get('if-none-match', ''), etag):
+            STATIC_RESPONSES.inc(status='304')
+            return Response(status_code=304, headers=response_headers)
+        body = self.variants[encoding] if encoding else self.body
+        if encoding:
+            response_headers['content-encoding'] = encoding
+        STATIC_RESPONSES.inc(status='200')
+        STATIC_BYTES.inc(len(body), encoding=encoding or 'identity')
+        return Response(body, media_type=self.media_type, headers=response_headers)
+
+
+class Assets:
+    def __init__(self, static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+        self.static_dir = static_dir
+        self.build_dir = build_dir
+        self.files = {}     # path under static_dir -> manifest entry
+        self.urls = {}      # fingerprinted path -> path
+        self.payloads = {}  # path -> Payload, for text assets
+        self.pages = {}     # (template name, version) -> Payload
+        self.version = None
+        self.lock = threading.Lock()
+        self.last_build = {}
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.build_dir, MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest.get("files", {}) if manifest.get("schema") == SCHEMA_HASH else {}
+
+    def _variant_path(self, path, encoding):
+        return os.path.join(self.build_dir, path + SUFFIXES[encoding])
+
+    def _scan(self, directory=None, prefix=''):
+        # (path under static_dir, full path, stat), skipping dotfiles
+        entries = sorted(os.scandir(directory or self.static_dir), key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                yield from self._scan(entry.path, f"{prefix}{entry.name}/")
+            elif entry.is_file():
+                yield f"{prefix}{entry.name}", entry.path, entry.stat()
+
+    def _load_variants(self, path, entry):
+        variants = {}
+        for encoding in entry.get("encodings", []):
+            try:
+                with open(self._variant_path(path, encoding), 'rb') as f:
+                    variants[encoding] = f.read()
+            except OSError:
+                return None
+        return variants
+
+    def _write_variants(self, path, payload):
+        for encoding, data in payload.variants.items():
+            target = self._variant_path(path, encoding)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(f"{target}.tmp", 'wb') as f:
+                f.write(data)
+            os.replace(f"{target}.tmp", target)
+
+    def _built_path(self, path, create=False):
+        if create:
+            os.makedirs(self.build_dir, exist_ok=True)
+        return os.path.join(self.build_dir, path)
+
+    def source_path(self, path, entry):
+        return self._built_path(path) if entry.get("built") else os.path.join(self.static_dir, path)
+
+    def _character_index(self, files):
+        # Only what the selector grid needs: names, and the icon URLs as a
+        # pattern plus each icon's fingerprint
+        with open(os.path.join(self.static_dir, CHARACTER_LIST), encoding='utf-8') as f:
+            names = json.load(f)
+        characters = []
+        for name in names:
+            entry = files.get(f"assets/images/characters/{icon_key(name)}/icon-big.png")
+            characters.append([name, entry["hash"][:12]] if entry else [name])
+        index = {"icon": "/static/assets/images/characters/{key}/icon-big.{hash}.png", "characters": characters}
+        return json.dumps(index, separators=(',', ':')).encode()
+
+    def build(self):
+        """Hash new or changed files, compress the text ones and regenerate
+        the character index; returns counts of what was done."""
+        stored = self._read_manifest()
+        files, payloads = {}, {}
+        hashed = compressed = 0
+        for path, full_path, st in self._scan():
+            entry = stored.get(path)
+            if entry is None or entry.get("size") != st.st_size or entry.get("mtime_ns") != st.st_mtime_ns:
+                with open(full_path, 'rb') as f:
+                    data = f.read()
+                entry = {"hash": hashlib.sha256(data).hexdigest()[:20], "size": st.st_size,
+                         "mtime_ns": st.st_mtime_ns}
+                hashed += 1
+                if compressible(path, len(data)):
+                    payloads[path] = Payload.compressed(data, content_type(path))
+                    entry["encodings"] = list(payloads[path].variants)
+                    self._write_variants(path, payloads[path])
+                    compressed += 1
+            files[path] = entry
+
+        # The character index is built output, served as if under static/
+        body = self._character_index(files)
+        content_hash = hashlib.sha256(body).hexdigest()[:20]
+        entry = stored.get(CHARACTER_INDEX)
+        if entry is None or entry.get("hash") != content_hash:
+            payloads[CHARACTER_INDEX] = Payload.compressed(body, 'application/json')
+            entry = {"hash": content_hash, "size": len(body), "built": True,
+                     "encodings": list(payloads[CHARACTER_INDEX].variants)}
+            with open(self._built_path(CHARACTER_INDEX, create=True), 'wb') as f:
+                f.write(body)
+            self._write_variants(CHARACTER_INDEX, payloads[CHARACTER_INDEX])
+            compressed += 1
+        files[CHARACTER_INDEX] = entry
+
+        if files != stored:
+            os.makedirs(self.build_dir, exist_ok=True)
+            tmp = os.path.join(self.build_dir, f"{MANIFEST}.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({"schema": SCHEMA_HASH, "files": files}, f, indent=0, sort_keys=True)
+            os.replace(tmp, os.path.join(self.build_dir, MANIFEST))
+        return files, payloads, {"files": len(files), "hashed": hashed, "compressed": compressed}
+
+    def load(self):
+        """Build what is stale, then load the text assets into memory."""
+        try:
+            files, payloads, counts = self.build()
+        except OSError as e:
+            logger.warning("Could not build static assets in '%s', serving them unversioned: %s", self.build_dir, e)
+            return {}
+        for path, entry in files.items():
+            if path in payloads or "encodings" not in entry:
+                continue
+            variants = self._load_variants(path, entry)
+            with open(self.source_path(path, entry), 'rb') as f:
+                body = f.read()
+            if variants is None:  # lost from the build directory
+                payloads[path] = Payload.compressed(body, content_type(path))
+                self._write_variants(path, payloads[path])
+            else:
+                payloads[path] = Payload(body, content_type(path), variants)
+        version = hashlib.sha256(json.dumps({p: e["hash"] for p, e in files.items()}, sort_keys=True).encode())
+        with self.lock:
+            self.files = files
+            self.urls = {fingerprint(path, entry["hash"]): path for path, entry in files.items()}
+            self.payloads = payloads
+            self.pages = {}
+            self.version = version.hexdigest()[:16]
+        self.last_build = counts
+        logger.info("Static assets: %d files (%d hashed, %d compressed)", counts["files"], counts["hashed"],
+                    counts["compressed"])
+        return counts
+
+    def url(self, path, files=None):
+        """The fingerprinted URL of ``path`` under static/, or its plain URL
+        if it is not in the manifest."""
+        entry = (files if files is not None else self.files).get(path)
+        return f"/static/{fingerprint(path, entry['hash']) if entry else path}"
+
+    def page(self, name, render):
+        """A rendered page as a Payload, rendered once per asset version."""
+        key = (name, self.version)
+        payload = self.pages.get(key)
+        if payload is None:
+            payload = Payload.compressed(render().encode(), 'text/html; charset=utf-8')
+            self.pages[key] = payload
+        return payload
+
+    def stats(self):
+        return {"version": self.version, "payloads": len(self.payloads),
+                "payload_bytes": sum(len(p.body) + sum(map(len, p.variants.values())) for p in self.payloads.values()),
+                **self.last_build}
+
+
+class AssetFiles(StaticFiles):
+    """StaticFiles for an Assets manifest: fingerprinted URLs are immutable,
+    plain ones revalidate; anything else falls through to StaticFiles."""
+
+    def __init__(self, assets, **kwargs):
+        super().__init__(directory=assets.static_dir, **kwargs)
+        self.assets = assets
+
+    async def get_response(self, path, scope):
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+        path = path.replace(os.sep, '/')
+        assets = self.assets
+        if path in assets.urls:
+            name, cache_control = assets.urls[path], IMMUTABLE
+        elif path in assets.files:
+            name, cache_control = path, REVALIDATE
+        else:
+            return await super().get_response(path, scope)
+
+        headers = Headers(scope=scope)
+        payload = assets.payloads.get(name)
+        if payload is not None:
+            return payload.response(headers, cache_control)
+        entry = assets.files[name]
+        etag = f'"{entry["hash"]}"'
+        response_headers = {'etag': etag, 'cache-control': cache_control}
+        if etag_matches(headers.get('if-none-match', ''), etag):
+            STATIC_RESPONSES.inc(status='304')
+            return Response(status_code=304, headers=response_headers)
+        STATIC_RESPONSES.inc(status='200')
+        STATIC_BYTES.inc(entry["size"], encoding='identity')
+        return FileResponse(assets.source_path(name, entry), media_type=content_type(name), headers=response_headers)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    assets = Assets()
+    print(json.dumps(assets.load()))
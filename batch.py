@@ -0,0 +1,62 @@
+"""Precompute team recommendations for many rosters.
+
+Reads one {"id": ..., "characters": [...]} object per line and writes one
+result per line, in the same order, like POST /generate_teams_batch.
+
+Usage: python batch.py rosters.jsonl [-o results.jsonl] [--explain] [--workers N]
+       (input "-" reads stdin; output defaults to stdout)
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Startup messages go to stderr so stdout carries only results; this also
+# runs in every worker process
+with contextlib.redirect_stdout(sys.stderr):
+    import server
+
+
+async def aiter_file(f):
+    for line in f:
+        yield line
+
+
+async def run(args, out):
+    executor = None
+    # Build or load the team index once here; workers only load it
+    server.refresh_team_index()
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=server.refresh_team_index, initargs=(False,))
+    count = 0
+    start = time.perf_counter()
+    try:
+        with (sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')) as f:
+            async for result in server.stream_batch(aiter_file(f), explain=args.explain, executor=executor):
+                out.write(json.dumps(result) + "\n")
+                count += 1
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    elapsed = time.perf_counter() - start
+    print(f"{count} rosters in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f}/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help='JSONL rosters, or "-" for stdin')
+    parser.add_argument("-o", "--output", help="JSONL results (default: stdout)")
+    parser.add_argument("--explain", action="store_true", help="add a Gemini explanation to each result")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="processes ranking rosters (default: one per CPU)")
+    args = parser.parse_args()
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    with out, contextlib.redirect_stdout(sys.stderr):
+        asyncio.run(run(args, out))
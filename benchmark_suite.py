@@ -0,0 +1,794 @@
+"""Reproducible benchmarks for team generation and the selection endpoint.
+
+Runs, on synthetic rosters drawn from actual.csv with fixed seeds:
+
+* a golden-output check: the teams recommended for every roster in
+  benchmark_golden.json must not change (exhaustive and pruned search);
+* an equivalence check of scoring.score_teams with calculate_team_score
+  (tests/test_scoring.py checks scoring.element_score_table);
+* micro-benchmarks of the scoring functions and generation stages;
+* generate_teams_optimized end to end;
+* the process-pool search against the sequential one, per worker count;
+* the latency of the Spiral Abyss pair search with and without the team
+  index (tests/test_abyss.py checks it against checking every pair);
+* an equivalence check of constrained team queries (must-include, exclude,
+  element and format filters) with filtering every ranked candidate, and
+  their latency next to the unconstrained query, searched and indexed;
+* a load test of POST /generate_teams_from_selection with Gemini replaced
+  by a stub that answers after a fixed delay plus a delay per prompt token;
+* page views of the selector (page, stylesheet, script, character index
+  and icons), first and repeat visits, with and without assets.py;
+* server.py import time and peak RSS in a fresh interpreter, loading the
+  roster from actual.csv and from the snapshot.
+
+Writes a JSON report with latency percentiles, throughput, peak memory and
+bytes and CPU per page view.
+Exits non-zero if a check fails, if the full-roster Abyss search misses
+--abyss-target-ms, or if --baseline is given and a p95 grew by more than
+--tolerance.
+
+Usage: python benchmark_suite.py [--sizes 10 25 50 all] [--report report.json]
+                                 [--baseline old.json] [--update-golden]
+                                 [--workers 1 2 4] [--skip parallel startup ...]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+os.environ.setdefault('API_KEY', 'benchmark')
+# Results from earlier runs would turn the load test into store hits
+os.environ.setdefault('STORE_PATH', '')
+
+import assets
+import llm
+import prompts
+import scoring
+import server
+import snapshot
+import team_index
+from searchv2 import EXPLANATION_CACHE
+
+# The roster data every benchmark runs on
+DATA = server.REGISTRY.get()
+
+GOLDEN_PATH = 'benchmark_golden.json'
+SEED = 2024
+ROSTERS_PER_SIZE = 3
+NUM_TEAMS = 6
+MAX_TEAMS_PER_DPS = 2
+ABYSS_PAIRS = (1, 3, 10)
+
+
+# --- Rosters ---
+def synthetic_roster(size, seed):
+    names = sorted(DATA.character_data)
+    if size == 'all':
+        return names
+    return sorted(random.Random(seed).sample(names, int(size)))
+
+
+def roster_set(sizes):
+    rosters = []
+    for size in sizes:
+        for n in range(1 if size == 'all' else ROSTERS_PER_SIZE):
+            rosters.append({"id": f"{size}-{n}", "size": size, "characters": synthetic_roster(size, SEED + n)})
+    return rosters
+
+
+def prepare(characters):
+    expanded = server.expand_traveler_variants(characters, DATA.character_data)
+    char_cache = server.build_char_cache(expanded, DATA)
+    main_dps_list, sub_dps_list, support_list = server.role_lists(char_cache)
+    roster = DATA.characters.roster(expanded)
+    rules = DATA.rules.for_roster(roster)
+    teams, main_pos, _ = scoring.enumerate_candidates(roster, main_dps_list, sub_dps_list, support_list)
+    unique = scoring.first_occurrences(teams, len(roster))
+    return {
+        "char_cache": char_cache,
+        "roles": (main_dps_list, sub_dps_list, support_list),
+        "roster": roster,
+        "rules": rules,
+        "teams": teams[unique],
+        "main_pos": main_pos[unique],
+    }
+# --- End Rosters ---
+
+
+# --- Measurement ---
+def summarize(times, items=1):
+    times = np.asarray(times)
+    p50, p95, p99 = np.percentile(times, [50, 95, 99])
+    return {
+        "runs": len(times),
+        "mean_ms": float(times.mean() * 1000),
+        "p50_ms": float(p50 * 1000),
+        "p95_ms": float(p95 * 1000),
+        "p99_ms": float(p99 * 1000),
+        "max_ms": float(times.max() * 1000),
+        "per_second": float(items * len(times) / times.sum()) if times.sum() else None,
+    }
+
+
+def peak_memory_mb(fn):
+    # Separate, untimed run: tracing slows allocation down. NumPy reports
+    # its buffers to tracemalloc, so arrays are included.
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(fn, budget, items=1, min_runs=5, max_runs=1000):
+    """Time ``fn`` for about ``budget`` seconds after one warm-up call."""
+    fn()
+    times = []
+    deadline = time.perf_counter() + budget
+    while len(times) < min_runs or (len(times) < max_runs and time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {**summarize(times, items), "items": items, "peak_memory_mb": peak_memory_mb(fn)}
+# --- End Measurement ---
+
+
+# --- Golden Output ---
+def current_teams(characters, prune):
+    return server.generate_teams_optimized(characters, DATA.character_data, NUM_TEAMS, MAX_TEAMS_PER_DPS,
+                                           prune=prune, parallel=False)
+
+
+def write_golden(rosters):
+    golden = {
+        "num_teams": NUM_TEAMS,
+        "max_teams_per_dps": MAX_TEAMS_PER_DPS,
+        "rosters": [{"id": r["id"], "characters": r["characters"], "teams": current_teams(r["characters"], False)}
+                    for r in rosters],
+    }
+    with open(GOLDEN_PATH, 'w', encoding='utf-8') as f:
+        json.dump(golden, f, indent=1)
+        f.write("\n")
+    return golden
+
+
+def check_golden():
+    # The golden file carries its own rosters, so it does not depend on how
+    # this script samples them
+    with open(GOLDEN_PATH, encoding='utf-8') as f:
+        golden = json.load(f)
+    mismatches = []
+    for entry in golden["rosters"]:
+        for prune in (False, True):
+            teams = server.generate_teams_optimized(entry["characters"], DATA.character_data, golden["num_teams"],
+                                                    golden["max_teams_per_dps"], prune=prune, parallel=False)
+            if teams != entry["teams"]:
+                mismatches.append({"id": entry["id"], "prune": prune, "expected": entry["teams"], "actual": teams})
+    return {"ok": not mismatches, "rosters": len(golden["rosters"]), "mismatches": mismatches}
+
+
+def check_reference_scores(rosters, sample_size=5000):
+    """scoring.score_teams against calculate_team_score on a sample of each
+    roster's candidates."""
+    mismatches = []
+    teams_checked = 0
+    for r in rosters:
+        p = prepare(r["characters"])
+        roster, teams = p["roster"], p["teams"]
+        teams = teams[np.random.default_rng(SEED).permutation(len(teams))[:sample_size]]
+        batched = scoring.score_teams(roster, p["rules"], teams).tolist()
+        per_team = [server.calculate_team_score([roster.names[i] for i in team], p["char_cache"], DATA.rules)
+                    for team in teams]
+        teams_checked += len(teams)
+        mismatches += [{"id": r["id"], "team": [roster.names[i] for i in team], "expected": expected, "batched": actual}
+                       for team, expected, actual in zip(teams, per_team, batched) if expected != actual]
+    return {"ok": not mismatches, "teams": teams_checked, "mismatches": mismatches}
+# --- End Golden Output ---
+
+
+# --- Micro-benchmarks ---
+def micro_benchmarks(rosters, budget):
+    results = {}
+    for size in dict.fromkeys(r["size"] for r in rosters):
+        characters = next(r["characters"] for r in rosters if r["size"] == size)
+        p = prepare(characters)
+        roster, rules, teams, main_pos = p["roster"], p["rules"], p["teams"], p["main_pos"]
+        main_dps_list, sub_dps_list, support_list = p["roles"]
+        scores = scoring.score_teams(roster, rules, teams)
+        group = results[str(size)] = {"candidates": len(teams)}
+        group["expand"] = benchmark(lambda: server.role_lists(server.build_char_cache(
+            server.expand_traveler_variants(characters, DATA.character_data), DATA)), budget)
+        group["enumerate"] = benchmark(lambda: scoring.first_occurrences(
+            scoring.enumerate_candidates(roster, main_dps_list, sub_dps_list, support_list)[0], len(roster)),
+            budget, items=len(teams))
+        group["score_teams"] = benchmark(lambda: scoring.score_teams(roster, rules, teams), budget, items=len(teams))
+        group["rank_candidates"] = benchmark(
+            lambda: scoring.rank_candidates(scores, main_pos, NUM_TEAMS, MAX_TEAMS_PER_DPS), budget, items=len(teams))
+        group["search_top_teams"] = benchmark(
+            lambda: scoring.search_top_teams(roster, rules, teams, main_pos, NUM_TEAMS, MAX_TEAMS_PER_DPS),
+            budget, items=len(teams))
+
+        # The per-team functions the engine replaced, on a fixed sample
+        sample = [[roster.names[i] for i in team]
+                  for team in teams[np.random.default_rng(SEED).permutation(len(teams))[:2000]]]
+        char_cache = p["char_cache"]
+        elements = [[char_cache[char].element for char in team] for team in sample]
+        if sample:
+            group["calculate_resonance_score"] = benchmark(
+                lambda: [server.calculate_resonance_score(e, team, char_cache, DATA.rules)
+                         for e, team in zip(elements, sample)], budget, items=len(sample))
+            group["calculate_team_score"] = benchmark(
+                lambda: [server.calculate_team_score(team, char_cache, DATA.rules) for team in sample],
+                budget, items=len(sample))
+    return results
+
+
+def generation_benchmarks(rosters, budget):
+    results = {}
+    for size in dict.fromkeys(r["size"] for r in rosters):
+        group = [r["characters"] for r in rosters if r["size"] == size]
+        calls = iter(range(1 << 62))
+        # Cycle through the rosters of this size
+        results[str(size)] = benchmark(
+            lambda: server.generate_teams_optimized(group[next(calls) % len(group)], DATA.character_data,
+                                                    NUM_TEAMS, MAX_TEAMS_PER_DPS), budget)
+    return results
+# --- End Micro-benchmarks ---
+
+
+# --- Process Pool ---
+def default_workers():
+    counts, n = [], 1
+    while n <= (os.cpu_count() or 1):
+        counts.append(n)
+        n *= 2
+    return counts
+
+
+def fastest(fn, repeat=3):
+    """(result, best time): pool runs vary too much for percentiles of a few runs."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def parallel_benchmarks(size, worker_counts):
+    """scoring.parallel_top_teams on one roster per worker count, exhaustive
+    and pruned, against the sequential search; each must return its teams."""
+    p = prepare(synthetic_roster(size, SEED))
+    roster, rules, teams, main_pos = p["roster"], p["rules"], p["teams"], p["main_pos"]
+    main_dps_list, sub_dps_list, support_list = p["roles"]
+    results = {"roster_size": str(size), "main_dps": len(main_dps_list)}
+    mismatches = []
+    for prune in (False, True):
+        label = "pruned" if prune else "exhaustive"
+        if prune:
+            sequential = lambda: teams[scoring.search_top_teams(roster, rules, teams, main_pos, NUM_TEAMS,
+                                                                MAX_TEAMS_PER_DPS)]
+        else:
+            sequential = lambda: teams[scoring.rank_candidates(scoring.score_teams(roster, rules, teams), main_pos,
+                                                               NUM_TEAMS, MAX_TEAMS_PER_DPS)]
+        expected, base = fastest(sequential)
+        group = results[label] = {"sequential_s": base, "workers": {}}
+        for workers in worker_counts:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                # Warm the workers up so process start-up is not timed
+                list(pool.map(abs, range(workers)))
+                rows, elapsed = fastest(lambda: scoring.parallel_top_teams(
+                    pool, roster, rules, main_dps_list, sub_dps_list, support_list, NUM_TEAMS, MAX_TEAMS_PER_DPS,
+                    partitions=2 * workers, prune=prune))
+            if rows.tolist() != expected.tolist():
+                mismatches.append({"prune": prune, "workers": workers})
+            group["workers"][str(workers)] = {"seconds": elapsed, "speedup": base / elapsed}
+    return {**results, "ok": not mismatches, "mismatches": mismatches}
+# --- End Process Pool ---
+
+
+# --- Spiral Abyss ---
+def abyss_index():
+    # A private index, so the server's team_index directory is left alone
+    index = team_index.TeamIndex(tempfile.mkdtemp(prefix='abyss-index-'))
+    index.refresh(DATA.characters, DATA.rules)
+    return index
+
+
+def abyss_benchmarks(rosters, budget, index):
+    results = {}
+    saved = server.TEAM_INDEX
+    try:
+        for strategy, server.TEAM_INDEX in (("search", team_index.TeamIndex('')), ("index", index)):
+            for size in dict.fromkeys(r["size"] for r in rosters):
+                group = [r["characters"] for r in rosters if r["size"] == size]
+                for num_pairs in ABYSS_PAIRS:
+                    calls = iter(range(1 << 62))
+                    results.setdefault(strategy, {}).setdefault(str(size), {})[str(num_pairs)] = benchmark(
+                        lambda: server.generate_abyss_pairs(group[next(calls) % len(group)], DATA.character_data,
+                                                            num_pairs), budget)
+    finally:
+        server.TEAM_INDEX = saved
+    return results
+
+
+def abyss_misses(results, target_ms):
+    """Full-roster Abyss benchmarks whose p95 is over ``target_ms``."""
+    return [f"abyss.{strategy}.all.{num_pairs}" for strategy, sizes in results.items()
+            for num_pairs, result in sizes.get('all', {}).items() if result["p95_ms"] > target_ms]
+# --- End Spiral Abyss ---
+
+
+# --- Team Queries ---
+def query_cases(characters):
+    """Constrained queries on a roster, roughly loosest to tightest."""
+    table = DATA.characters
+    rng = random.Random(SEED)
+    supports = [name for name in characters if table[name].is_support]
+    elements = [table[name].element for name in characters if table[name].element < len(scoring.ELEMENTS)]
+    common = max(set(elements), key=elements.count)
+    picks = rng.sample(characters, 2)
+    return {
+        "none": None,
+        "exclude": scoring.TeamQuery(exclude=rng.sample(characters, 3)),
+        "format_c": scoring.TeamQuery(formats=[scoring.FORMAT_C]),
+        "include_support": scoring.TeamQuery(include=supports[:1]),
+        "elements_2": scoring.TeamQuery(elements=[common, (common + 1) % len(scoring.ELEMENTS)]),
+        "include_2": scoring.TeamQuery(include=picks),
+        "mono_element": scoring.TeamQuery(exclude_elements=[e for e in range(len(scoring.ELEMENTS)) if e != common]),
+    }
+
+
+def filtered_teams(characters, query):
+    """Every candidate ranked, those not matching ``query`` dropped, then
+    limited per main DPS and overall: what a constrained query must return."""
+    p = prepare(characters)
+    roster, teams, main_pos = p["roster"], p["teams"], p["main_pos"]
+    keep = np.ones(len(teams), dtype=bool)
+    if query is not None:
+        for name in query.exclude:
+            keep &= ~(teams == roster.index.get(name, -1)).any(axis=1)
+        for element in query.exclude_elements:
+            keep &= ~(roster.element[teams] == element).any(axis=1)
+        required = [roster.index.get(name, -1) for name in query.include]
+        keep &= scoring.matching_teams(roster, teams, required, query.element_mask(), query.formats)
+    teams, main_pos = teams[keep], main_pos[keep]
+    best = scoring.rank_candidates(scoring.score_teams(roster, p["rules"], teams), main_pos, NUM_TEAMS,
+                                   MAX_TEAMS_PER_DPS)
+    return [[roster.names[i] for i in row] for row in teams[best]]
+
+
+def check_queries(index, rosters=40, sizes=(6, 40)):
+    """Constrained generate_teams_optimized, by search, exhaustive ranking
+    and the index, against filtered_teams on random rosters."""
+    rng = random.Random(SEED)
+    names = sorted(DATA.character_data)
+    mismatches = []
+    saved = server.TEAM_INDEX
+    try:
+        for _ in range(rosters):
+            characters = sorted(rng.sample(names, rng.randint(*sizes)))
+            for case, query in query_cases(characters).items():
+                expected = filtered_teams(characters, query)
+                server.TEAM_INDEX = index
+                actual = {"index": server.generate_teams_optimized(characters, DATA.character_data, NUM_TEAMS,
+                                                                   MAX_TEAMS_PER_DPS, query=query)}
+                server.TEAM_INDEX = team_index.TeamIndex('')
+                for strategy, prune in (("search", True), ("exhaustive", False)):
+                    actual[strategy] = server.generate_teams_optimized(
+                        characters, DATA.character_data, NUM_TEAMS, MAX_TEAMS_PER_DPS, prune=prune, parallel=False,
+                        query=query)
+                for strategy, teams in actual.items():
+                    # Without a team, a roster gets a fallback team unless the
+                    # query narrows more than the roster
+                    if teams != expected and (expected or (query is not None and query.narrows)):
+                        mismatches.append({"characters": characters, "case": case, "strategy": strategy,
+                                           "expected": expected, "actual": teams})
+    finally:
+        server.TEAM_INDEX = saved
+    return {"ok": not mismatches, "rosters": rosters, "mismatches": mismatches}
+
+
+def query_benchmarks(rosters, budget, index):
+    results = {}
+    saved = server.TEAM_INDEX
+    try:
+        for strategy, server.TEAM_INDEX in (("search", team_index.TeamIndex('')), ("index", index)):
+            for size in dict.fromkeys(r["size"] for r in rosters):
+                group = [r["characters"] for r in rosters if r["size"] == size]
+                cases = [query_cases(characters) for characters in group]
+                for case in cases[0]:
+                    calls = iter(range(1 << 62))
+
+                    def run():
+                        n = next(calls) % len(group)
+                        return server.generate_teams_optimized(group[n], DATA.character_data, NUM_TEAMS,
+                                                               MAX_TEAMS_PER_DPS, query=cases[n][case])
+
+                    results.setdefault(strategy, {}).setdefault(str(size), {})[case] = benchmark(run, budget)
+    finally:
+        server.TEAM_INDEX = saved
+    return results
+
+
+def query_slowdowns(results, tolerance):
+    """Constrained queries whose median is over the unconstrained one by
+    more than ``tolerance`` (a fraction) and a millisecond; medians, as the
+    runs compared are only a few milliseconds each."""
+    return [f"queries.{strategy}.{size}.{case}" for strategy, sizes in results.items()
+            for size, cases in sizes.items() for case, result in cases.items()
+            if result["p50_ms"] > max(cases["none"]["p50_ms"] * (1 + tolerance), cases["none"]["p50_ms"] + 1)]
+# --- End Team Queries ---
+
+
+# --- Load Test ---
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class StubModels:
+    """Stands in for ``client.aio.models``: a fixed answer after ``latency``
+    plus ``token_latency`` per (estimated) prompt token."""
+
+    def __init__(self, latency, token_latency=0.0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.prompt_tokens = []
+
+    async def generate_content(self, model, contents, config):
+        tokens = prompts.estimate_tokens(contents)
+        self.prompt_tokens.append(tokens)
+        await asyncio.sleep(self.latency + self.token_latency * tokens)
+        return StubResponse("**Team 1: Benchmark**\nStub explanation.")
+
+
+class StubClient:
+    def __init__(self, latency, token_latency=0.0):
+        self.models = StubModels(latency, token_latency)
+        self.aio = type('StubAio', (), {'models': self.models})()
+
+
+async def load_test(size, requests, concurrency, latency, token_latency=0.0):
+    import httpx
+
+    stub = StubClient(latency, token_latency)
+    llm.set_client(stub)
+    server.TEAM_CACHE.clear()
+    EXPLANATION_CACHE.clear()
+    rosters = [synthetic_roster(size, SEED + 1000 + n) for n in range(requests)]
+    semaphore = asyncio.Semaphore(concurrency)
+    times, failures = [], 0
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://benchmark",
+                                 timeout=None) as client:
+        async def one(characters):
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/generate_teams_from_selection", json={"characters": characters})
+                times.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    failures += 1
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        await asyncio.gather(*(one(characters) for characters in rosters))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    return {
+        **summarize(times),
+        "per_second": requests / elapsed,
+        "roster_size": size,
+        "requests": requests,
+        "concurrency": concurrency,
+        "llm_latency_s": latency,
+        "llm_token_latency_s": token_latency,
+        "llm_calls": len(stub.models.prompt_tokens),
+        "prompt_tokens_mean": float(np.mean(stub.models.prompt_tokens)) if stub.models.prompt_tokens else 0.0,
+        "prompt_tokens_max": max(stub.models.prompt_tokens, default=0),
+        "failures": failures,
+        "peak_memory_mb": peak,
+    }
+# --- End Load Test ---
+
+# --- Page Views ---
+def legacy_app():
+    """/ and /static as served before assets.py: the page rendered with
+    plain asset URLs on every request, files through plain StaticFiles."""
+    from starlette.applications import Starlette
+    from starlette.responses import HTMLResponse
+    from starlette.routing import Mount, Route
+    from starlette.staticfiles import StaticFiles
+
+    def asset(path):
+        # The grid read the plain name list then
+        return f"/static/{assets.CHARACTER_LIST if path == assets.CHARACTER_INDEX else path}"
+
+    def root(request):
+        return HTMLResponse(server.templates.get_template("login.html").render(asset=asset))
+
+    # Same middleware as the server, so only the asset handling differs
+    return Starlette(routes=[Route("/", root), Mount("/static", StaticFiles(directory="static"))],
+                     middleware=server.app.user_middleware)
+
+
+async def page_view(client, cache):
+    """Everything a browser fetches to show the selector grid, honouring
+    ``cache`` ({url: (etag, cache-control, body)}) like a browser would.
+    Returns (requests, bytes received)."""
+    requests = received = 0
+
+    async def fetch(url):
+        nonlocal requests, received
+        cached = cache.get(url)
+        if cached and 'immutable' in cached[1]:
+            return cached[2]
+        headers = {"If-None-Match": cached[0]} if cached and cached[0] else {}
+        response = await client.get(url, headers=headers)
+        requests += 1
+        received += response.num_bytes_downloaded
+        if response.status_code == 304:
+            return cached[2]
+        cache[url] = (response.headers.get("etag"), response.headers.get("cache-control", ""), response.content)
+        return response.content
+
+    html = (await fetch("/")).decode()
+    stylesheet = re.search(r'rel="stylesheet" href="(/static/[^"]+)"', html).group(1)
+    script = re.search(r'<script src="(/static/[^"]+)"', html).group(1)
+    index_url = re.search(r'data-character-index="([^"]+)"', html).group(1)
+    await fetch(stylesheet)
+    await fetch(script)
+    index = json.loads(await fetch(index_url))
+    if isinstance(index, dict):
+        icons = [index["icon"].replace("{key}", assets.icon_key(name)).replace("{hash}", rest[0])
+                 for name, *rest in index["characters"] if rest]
+    else:
+        icons = [f"/static/assets/images/characters/{assets.icon_key(name)}/icon-big.png" for name in index]
+    for icon in icons:
+        await fetch(icon)
+    return requests, received
+
+
+async def page_view_test(views):
+    """Bytes, requests and server CPU per page view, first visit (empty
+    cache) and repeat visit, with and without the asset pipeline."""
+    import httpx
+
+    results = {}
+    for name, app in (("legacy", legacy_app()), ("assets", server.app)):
+        results[name] = {}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark",
+                                     headers={"Accept-Encoding": "gzip"}) as client:
+            for visit in ("first", "repeat"):
+                shared = {}
+                if visit == "repeat":
+                    await page_view(client, shared)
+                requests = received = 0
+                cpu = time.process_time()
+                for _ in range(views):
+                    # Client and server share this process, so CPU is an upper bound
+                    done, size = await page_view(client, shared if visit == "repeat" else {})
+                    requests, received = requests + done, received + size
+                cpu = time.process_time() - cpu
+                results[name][visit] = {
+                    "views": views,
+                    "bytes_per_view": received / views,
+                    "requests_per_view": requests / views,
+                    "cpu_ms_per_view": cpu * 1000 / views,
+                    "cpu_us_per_request": cpu * 1e6 / max(requests, 1),
+                }
+    return results
+# --- End Page Views ---
+
+
+# --- Startup ---
+# Peak RSS from VmHWM: ru_maxrss of a child started from this (larger)
+# process reports the parent's size
+STARTUP_PROBE = """
+import json, re, sys, time
+start = time.perf_counter()
+import server
+elapsed = time.perf_counter() - start
+with open("/proc/self/status") as f:
+    peak_kb = int(re.search(r"VmHWM:\\s+(\\d+)", f.read()).group(1))
+print(json.dumps({
+    "import_s": elapsed,
+    "max_rss_mb": peak_kb / 1024,
+    "pandas": "pandas" in sys.modules,
+    "characters": len(server.REGISTRY.get().character_data),
+}))
+"""
+
+
+def measure_import(snapshot_path):
+    env = {**os.environ, "ROSTER_SNAPSHOT": snapshot_path}
+    result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def startup_benchmarks(runs):
+    """Medians over ``runs`` fresh imports of server.py, from actual.csv
+    (no snapshot) and from a freshly written snapshot."""
+    snapshot.write_snapshot(snapshot.build_roster_data(), snapshot.source_hashes())
+    results = {}
+    for label, path in (("csv", ""), ("snapshot", snapshot.SNAPSHOT_PATH)):
+        samples = [measure_import(path) for _ in range(runs)]
+        results[label] = {
+            "runs": runs,
+            "import_s": statistics.median(sample["import_s"] for sample in samples),
+            "min_import_s": min(sample["import_s"] for sample in samples),
+            "max_rss_mb": statistics.median(sample["max_rss_mb"] for sample in samples),
+            "pandas": samples[0]["pandas"],
+            "characters": samples[0]["characters"],
+        }
+    results["ok"] = results["csv"]["characters"] == results["snapshot"]["characters"]
+    return results
+# --- End Startup ---
+
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "generation_workers": server.GENERATION_WORKERS,
+        "seed": SEED,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def regressions(report, baseline, tolerance):
+    """Benchmarks whose p95 grew by more than ``tolerance`` (a fraction)."""
+    found = []
+
+    def walk(new, old, path):
+        if not isinstance(new, dict) or not isinstance(old, dict):
+            return
+        if "p95_ms" in new and "p95_ms" in old and old["p95_ms"]:
+            change = new["p95_ms"] / old["p95_ms"] - 1
+            if change > tolerance:
+                found.append({"benchmark": path, "baseline_p95_ms": old["p95_ms"], "p95_ms": new["p95_ms"],
+                              "change": change})
+            return
+        for key in new:
+            walk(new[key], old.get(key), f"{path}.{key}" if path else key)
+
+    for section in ("micro", "generation", "abyss", "queries", "load"):
+        walk(report.get(section), baseline.get(section), section)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=['10', '25', '50', 'all'], help="roster sizes (default: 10 25 50 all)")
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds per micro-benchmark (default: 1)")
+    parser.add_argument("--requests", type=int, default=200, help="load test requests (default: 200)")
+    parser.add_argument("--concurrency", type=int, default=16, help="load test concurrency (default: 16)")
+    parser.add_argument("--load-size", default='25', help="load test roster size (default: 25)")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="stub Gemini delay in seconds (default: 0.05)")
+    parser.add_argument("--llm-token-latency", type=float, default=0.00002,
+                        help="stub Gemini delay per prompt token in seconds (default: 0.00002)")
+    parser.add_argument("--report", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="earlier report to compare p95 latencies against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 growth vs baseline (default: 0.2)")
+    parser.add_argument("--update-golden", action="store_true", help=f"rewrite {GOLDEN_PATH} from the current code")
+    parser.add_argument("--abyss-target-ms", type=float, default=1000,
+                        help="p95 allowed for the full-roster Abyss search, either strategy (default: 1000)")
+    parser.add_argument("--page-views", type=int, default=20, help="page views per page view test (default: 20)")
+    parser.add_argument("--parallel-size", default='all', help="process pool roster size (default: all)")
+    parser.add_argument("--workers", nargs="+", type=int, default=default_workers(),
+                        help="process pool worker counts (default: 1 2 4 ... up to the CPU count)")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh imports per startup test (default: 5)")
+    parser.add_argument("--skip", nargs="*", default=[],
+                        choices=["micro", "generation", "parallel", "abyss", "queries", "load", "pages", "startup"],
+                        help="sections to skip")
+    args = parser.parse_args()
+
+    rosters = roster_set(args.sizes)
+    if args.update_golden:
+        write_golden(rosters)
+        print(f"Wrote {GOLDEN_PATH} ({len(rosters)} rosters)", file=sys.stderr)
+
+    report = {"environment": environment(), "golden": check_golden(),
+              "reference_scores": check_reference_scores(rosters)}
+    print(f"golden: {'ok' if report['golden']['ok'] else 'MISMATCH'} ({report['golden']['rosters']} rosters)",
+          file=sys.stderr)
+    print(f"reference scores: {'ok' if report['reference_scores']['ok'] else 'MISMATCH'} "
+          f"({report['reference_scores']['teams']} teams)", file=sys.stderr)
+    if "micro" not in args.skip:
+        report["micro"] = micro_benchmarks(rosters, args.budget)
+    if "generation" not in args.skip:
+        report["generation"] = generation_benchmarks(rosters, args.budget)
+    if "parallel" not in args.skip:
+        report["parallel"] = parallel_benchmarks(args.parallel_size, args.workers)
+        for label in ("exhaustive", "pruned"):
+            print(f"parallel ({label}): sequential {report['parallel'][label]['sequential_s']:.3f}s, " +
+                  ", ".join(f"{workers} workers {r['speedup']:.2f}x"
+                            for workers, r in report["parallel"][label]["workers"].items()), file=sys.stderr)
+        if not report["parallel"]["ok"]:
+            print("parallel: MISMATCH with the sequential search", file=sys.stderr)
+    if "abyss" not in args.skip:
+        index = abyss_index()
+        report["abyss"] = abyss_benchmarks(rosters, args.budget, index)
+        report["abyss_target_misses"] = abyss_misses(report["abyss"], args.abyss_target_ms)
+        for name in report["abyss_target_misses"]:
+            print(f"abyss target missed: {name} p95 over {args.abyss_target_ms:.0f} ms", file=sys.stderr)
+    if "queries" not in args.skip:
+        index = index if "abyss" not in args.skip else abyss_index()
+        report["query_check"] = check_queries(index)
+        print(f"queries: {'ok' if report['query_check']['ok'] else 'MISMATCH'} "
+              f"({report['query_check']['rosters']} rosters)", file=sys.stderr)
+        report["queries"] = query_benchmarks(rosters, args.budget, index)
+        report["query_slowdowns"] = query_slowdowns(report["queries"], args.tolerance)
+        for name in report["query_slowdowns"]:
+            print(f"query slower than unconstrained: {name}", file=sys.stderr)
+    if "load" not in args.skip:
+        report["load"] = asyncio.run(load_test(args.load_size, args.requests, args.concurrency, args.llm_latency,
+                                                args.llm_token_latency))
+    if "pages" not in args.skip:
+        report["pages"] = asyncio.run(page_view_test(args.page_views))
+        for name, visits in report["pages"].items():
+            print(f"pages ({name}): " + ", ".join(f"{visit} {r['bytes_per_view'] / 1024:.0f} KiB "
+                                                   f"{r['requests_per_view']:.0f} requests "
+                                                   f"{r['cpu_ms_per_view']:.1f} ms CPU" for visit, r in visits.items()),
+                  file=sys.stderr)
+    if "startup" not in args.skip:
+        report["startup"] = startup_benchmarks(args.startup_runs)
+        for label in ("csv", "snapshot"):
+            r = report["startup"][label]
+            print(f"startup ({label}): import {r['import_s']:.3f}s, peak RSS {r['max_rss_mb']:.1f} MB, "
+                  f"pandas imported: {r['pandas']}", file=sys.stderr)
+        if not report["startup"]["ok"]:
+            print("startup: snapshot and CSV loaded different rosters", file=sys.stderr)
+    report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    failed = not report["golden"]["ok"] or not report["reference_scores"]["ok"]
+    failed = failed or not report.get("parallel", {"ok": True})["ok"] or not report.get("startup", {"ok": True})["ok"]
+    failed = failed or bool(report.get("abyss_target_misses"))
+    failed = failed or not report.get("query_check", {"ok": True})["ok"]
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report["regressions"] = regressions(report, json.load(f), args.tolerance)
+        for item in report["regressions"]:
+            print(f"regression: {item['benchmark']} p95 {item['baseline_p95_ms']:.2f} -> {item['p95_ms']:.2f} ms "
+                  f"({item['change']:+.0%})", file=sys.stderr)
+        failed = failed or bool(report["regressions"])
+
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
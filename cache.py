@@ -0,0 +1,197 @@
+"""Small in-process caches shared by the API endpoints."""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUTTLCache:
+    """Bounded LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize=256, ttl=3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def values(self):
+        """Every stored value, expired or not (they still hold memory)."""
+        with self._lock:
+            return [value for _, value in self._data.values()]
+
+    def clear(self):
+        with self._lock:
+            if self._data:
+                self.invalidations += 1
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+class FileVersion:
+    """Content hash of a set of data files, re-hashed only when they change.
+
+    Each call to ``current()`` stats the files; the (comparatively slow)
+    hashing only happens when a size or mtime differs from the last call.
+    """
+
+    def __init__(self, *paths):
+        self.paths = paths
+        self._stamp = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stamp.append((path, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append((path, None, None))
+        return tuple(stamp)
+
+    def current(self):
+        stamp = self._stat()
+        with self._lock:
+            if stamp != self._stamp:
+                digest = hashlib.sha256()
+                for path in self.paths:
+                    digest.update(path.encode())
+                    try:
+                        with open(path, 'rb') as f:
+                            digest.update(f.read())
+                    except FileNotFoundError:
+                        digest.update(b'\0missing')
+                self._stamp = stamp
+                self._version = digest.hexdigest()[:16]
+            return self._version
+
+
+class VersionedCache(LRUTTLCache):
+    """LRU+TTL cache that empties itself when its version changes.
+
+    ``version`` is anything with a ``current()`` method returning a version
+    id, e.g. a FileVersion or a registry.DataRegistry.
+
+    Keys are stored together with the version they were computed under, so
+    an entry can never be served across a data change even if the clear
+    races with a concurrent write.
+    """
+
+    def __init__(self, version, maxsize=256, ttl=3600, clock=time.monotonic):
+        super().__init__(maxsize=maxsize, ttl=ttl, clock=clock)
+        self.version = version
+        self._seen_version = None
+
+    def versioned_key(self, key, version=None):
+        # ``version`` pins the key to the data a caller is actually using,
+        # which may already be older than the current one
+        current = self.version.current()
+        if current != self._seen_version:
+            if self._seen_version is not None:
+                self.clear()
+            self._seen_version = current
+        return (current if version is None else version, key)
+
+    def stats(self):
+        stats = super().stats()
+        stats["version"] = self._seen_version
+        return stats
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight task.
+
+    Each waiter awaits the task through ``asyncio.shield``, so one caller
+    going away does not cancel the others' work. The result or exception
+    reaches every waiter and nothing is kept once the task finishes; cache
+    successful results separately.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0  # tasks started
+        self.coalesced = 0  # callers that joined a running task
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Retrieve the error even if every waiter left, so it is not logged
+        # as "never retrieved"; the waiters still present get it raised
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, factory):
+        """Await ``factory()`` (a coroutine or future), or the call already
+        running under ``key``."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def __contains__(self, key):
+        return key in self._inflight
+
+    def stats(self):
+        return {"inflight": len(self._inflight), "calls": self.calls, "coalesced": self.coalesced}
@@ -0,0 +1,118 @@
+"""Shared, indexed view of characters.json.
+
+The file is parsed once at startup and again only when its mtime changes.
+Every name is indexed under ``lookup_key``, a case-insensitive,
+hyphen-normalised form that also matches the actual.csv keys produced by
+``normalise`` (including the few characters spelled differently in the two
+files).  Each character's talent texts (skills, passives, artifact set) are
+extracted at load time, so explaining a team is just dictionary lookups.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def normalise(name):
+    # Normalize and convert to lowercase
+    return name.replace(" ", "-").lower()
+
+
+# Spellings in characters.json or the selector that differ from actual.csv
+ALIASES = {
+    'itto': 'arataki-itto',
+    'sanganomiya-kokomi': 'kokomi',
+    'sangonomiya-kokomi': 'kokomi',
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def lookup_key(name):
+    key = normalise(name.strip())
+    key = key.replace('(', '').replace(')', '').replace('traveller', 'traveler')
+    key = '-'.join(part for part in key.split('-') if part)
+    return ALIASES.get(key, key)
+
+
+def display_name(name):
+    # Capitalised with hyphens kept, e.g. "Kaedehara-Kazuha"
+    return '-'.join(part.capitalize() for part in name.strip().split('-'))
+
+
+TALENT_FIELDS = (
+    ('Elemental Skill', 'elemental_skill'),
+    ('Elemental Burst', 'elemental_burst'),
+    ('Passive talent 1', 'passive_talent_1'),
+    ('Passive talent 2', 'passive_talent_2'),
+    ('Artifact Set', 'best_artifact_set'),
+)
+
+
+def _text(value):
+    if isinstance(value, dict):
+        # Artifact sets: {"name", "piece_bonus", "description"}
+        value = ': '.join(str(part) for part in value.values() if part)
+    return ' '.join(str(value).split())
+
+
+def talent_texts(data):
+    # (label, text) pairs for the prompt, whitespace collapsed; missing
+    # fields are left out instead of being sent as "N/A"
+    return tuple((label, _text(data[field])) for label, field in TALENT_FIELDS if data.get(field))
+
+
+class CharacterStore:
+    def __init__(self, path='characters.json'):
+        self.path = path
+        self._mtime = None  # of the last version we tried to load
+        self.loaded = False
+        # (entries, talents), swapped as one reference on reload
+        self._index = ({}, {})
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Reload the file if its mtime changed. Returns True on reload."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if not self.loaded:
+                logger.error("Character data file '%s' not found.", self.path)
+            return False
+        if mtime == self._mtime:
+            return False
+
+        with self._lock:
+            if mtime == self._mtime:
+                return False
+            self._mtime = mtime
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    raw = json.load(f)
+            except json.JSONDecodeError:
+                # Keep serving the last good copy
+                logger.error("Invalid JSON format in '%s'.", self.path)
+                return False
+
+            entries = {lookup_key(name): data for name, data in raw.items()}
+            talents = {key: talent_texts(data) for key, data in entries.items()}
+            self._index = (entries, talents)
+            self.loaded = True
+
+        logger.info("Loaded %d character descriptions from '%s'.", len(entries), self.path)
+        return True
+
+    def get(self, name):
+        return self._index[0].get(lookup_key(name))
+
+    def talents(self, name):
+        return self._index[1].get(lookup_key(name))
+
+    def __contains__(self, name):
+        return lookup_key(name) in self._index[0]
+
+
+CHARACTER_STORE = CharacterStore()
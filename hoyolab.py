@@ -0,0 +1,88 @@
+"""Pooled, cached access to HoYoLAB for /get_characters.
+
+genshin.Client objects are kept per account (``ltuid_v2``) so the game
+account lookup it does on first use is not repeated on every page load.
+Each account's owned-character list is cached for a short time, and
+concurrent requests for the same account share one upstream call.
+
+Swap the client constructor with ``set_client_factory`` to run this against
+a local stub of the HoYoLAB API.
+"""
+import hashlib
+import os
+
+import genshin
+
+from cache import LRUTTLCache, SingleFlight
+
+HOYOLAB_POOL_SIZE = int(os.getenv('HOYOLAB_POOL_SIZE', 256))
+HOYOLAB_CLIENT_TTL = float(os.getenv('HOYOLAB_CLIENT_TTL', 3600))
+OWNED_CHARACTERS_TTL = float(os.getenv('OWNED_CHARACTERS_TTL', 300))
+
+client_factory = genshin.Client
+
+
+def set_client_factory(factory):
+    """Replace the client constructor, e.g. with a stub exposing
+    ``get_calculator_characters``. Pooled clients are dropped."""
+    global client_factory
+    client_factory = factory
+    CLIENT_POOL.clear()
+    OWNED_CHARACTERS.clear()
+
+
+# ltuid_v2 -> (cookies, client)
+CLIENT_POOL = LRUTTLCache(maxsize=HOYOLAB_POOL_SIZE, ttl=HOYOLAB_CLIENT_TTL)
+# account key -> list of character names
+OWNED_CHARACTERS = LRUTTLCache(maxsize=HOYOLAB_POOL_SIZE, ttl=OWNED_CHARACTERS_TTL)
+# account key -> task fetching its characters
+OWNED_FLIGHTS = SingleFlight()
+
+
+def account_key(cookies):
+    # The token is part of the key so a request can only ever be answered
+    # with data fetched using the same credentials
+    token = hashlib.sha256(str(cookies.get('ltoken_v2')).encode()).hexdigest()[:16]
+    return (str(cookies.get('ltuid_v2')), token)
+
+
+def get_client(cookies):
+    ltuid = str(cookies.get('ltuid_v2'))
+    pooled = CLIENT_POOL.get(ltuid)
+    if pooled is not None and pooled[0] == cookies:
+        return pooled[1]
+    # New account, or the same account logged in again with new cookies
+    client = client_factory(cookies)
+    CLIENT_POOL.set(ltuid, (dict(cookies), client))
+    return client
+
+
+async def _fetch_owned_characters(cookies, key):
+    try:
+        characters = await get_client(cookies).get_calculator_characters(sync=True)
+    except genshin.errors.InvalidCookies:
+        CLIENT_POOL.pop(str(cookies.get('ltuid_v2')))
+        raise
+    names = [char.name for char in characters]
+    OWNED_CHARACTERS.set(key, names)
+    return names
+
+
+async def get_owned_characters(cookies):
+    """Names of the characters on the account, from cache when fresh."""
+    key = account_key(cookies)
+    names = OWNED_CHARACTERS.get(key)
+    if names is not None:
+        return list(names)
+
+    # One caller disconnecting does not cancel the others' fetch. Errors
+    # reach every waiter and are not cached.
+    return list(await OWNED_FLIGHTS.run(key, lambda: _fetch_owned_characters(cookies, key)))
+
+
+def stats():
+    return {
+        "clients": CLIENT_POOL.stats(),
+        "owned_characters": OWNED_CHARACTERS.stats(),
+        "inflight": len(OWNED_FLIGHTS),
+    }
@@ -0,0 +1,166 @@
+"""Non-blocking access to Gemini.
+
+Every request goes through ``generate_text``, which uses the async client so
+the event loop keeps serving other endpoints while the model responds.
+Calls are capped by a semaphore, each attempt has a timeout, and transient
+failures (timeouts, 429s, 5xx, connection errors) are retried with
+exponential backoff.
+
+Point GEMINI_BASE_URL at a local fake server, or swap the client with
+``set_client``, to exercise this without the real API.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+import weakref
+
+from dotenv import load_dotenv
+from google import genai
+from google.genai import errors, types
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+if not API_KEY:
+    raise ValueError("API_KEY environment variable not set.")
+
+MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 60))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_BACKOFF = float(os.getenv('LLM_BACKOFF', 1.0))
+
+
+LLM_SECONDS = metrics.histogram('gemini_request_seconds', "Gemini call latency, including retries", ['call', 'outcome'])
+LLM_TOKENS = metrics.counter('gemini_tokens_total', "Tokens reported by Gemini usage metadata", ['type'])
+LLM_RETRIES = metrics.counter('gemini_retries_total', "Gemini attempts that failed and were retried", ['call'])
+
+
+class LLMError(Exception):
+    """Raised when Gemini could not produce a response after all retries."""
+
+
+def _make_client():
+    base_url = os.getenv('GEMINI_BASE_URL')
+    http_options = types.HttpOptions(base_url=base_url) if base_url else None
+    return genai.Client(api_key=API_KEY, http_options=http_options)
+
+
+client = _make_client()
+
+
+def set_client(new_client):
+    """Replace the Gemini client, e.g. with a stub exposing ``aio.models``."""
+    global client
+    client = new_client
+
+
+# asyncio primitives belong to one event loop, so keep one semaphore per loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return semaphore
+
+
+def _is_retryable(exc):
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(exc, errors.APIError):
+        return exc.code == 429 or (exc.code or 0) >= 500
+    return False
+
+
+def _record_usage(usage):
+    if usage is None:
+        return
+    for kind, field in (('prompt', 'prompt_token_count'), ('output', 'candidates_token_count'),
+                        ('total', 'total_token_count')):
+        count = getattr(usage, field, None)
+        if count:
+            LLM_TOKENS.inc(count, type=kind)
+
+
+def _backoff(attempt):
+    # Exponential with full jitter so retries from many requests spread out
+    return random.uniform(0, LLM_BACKOFF * (2 ** attempt))
+
+
+async def generate_text(prompt, temperature=0.5, timeout=None, retries=None):
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    config = types.GenerateContentConfig(temperature=temperature)
+    start = time.perf_counter()
+
+    for attempt in range(retries + 1):
+        try:
+            async with _semaphore():
+                response = await asyncio.wait_for(
+                    client.aio.models.generate_content(model=MODEL, contents=prompt, config=config),
+                    timeout=timeout,
+                )
+            LLM_SECONDS.observe(time.perf_counter() - start, call='generate', outcome='ok')
+            _record_usage(getattr(response, 'usage_metadata', None))
+            return response.text
+        except Exception as e:
+            if not _is_retryable(e) or attempt == retries:
+                LLM_SECONDS.observe(time.perf_counter() - start, call='generate', outcome='error')
+                raise LLMError(f"Gemini request failed after {attempt + 1} attempt(s): {e!r}") from e
+            LLM_RETRIES.inc(call='generate')
+            delay = _backoff(attempt)
+            logger.warning("Gemini request failed (%r); retrying in %.1fs", e, delay)
+            await asyncio.sleep(delay)
+
+
+async def stream_text(prompt, temperature=0.5, timeout=None, retries=None):
+    """Yield the response text chunk by chunk as the model produces it.
+
+    ``timeout`` applies to the wait for each chunk. A failed attempt is only
+    retried if nothing has been yielded yet; after that the error is raised
+    so the caller never sees text repeated.
+    """
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    config = types.GenerateContentConfig(temperature=temperature)
+    start = time.perf_counter()
+
+    for attempt in range(retries + 1):
+        started = False
+        usage = None
+        try:
+            async with _semaphore():
+                stream = await asyncio.wait_for(
+                    client.aio.models.generate_content_stream(model=MODEL, contents=prompt, config=config),
+                    timeout=timeout,
+                )
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                    except StopAsyncIteration:
+                        LLM_SECONDS.observe(time.perf_counter() - start, call='stream', outcome='ok')
+                        _record_usage(usage)
+                        return
+                    # Usage is cumulative; the last chunk carries the totals
+                    usage = getattr(chunk, 'usage_metadata', None) or usage
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+        except Exception as e:
+            if started or not _is_retryable(e) or attempt == retries:
+                LLM_SECONDS.observe(time.perf_counter() - start, call='stream', outcome='error')
+                raise LLMError(f"Gemini stream failed after {attempt + 1} attempt(s): {e!r}") from e
+            LLM_RETRIES.inc(call='stream')
+            delay = _backoff(attempt)
+            logger.warning("Gemini stream failed (%r); retrying in %.1fs", e, delay)
+            await asyncio.sleep(delay)
@@ -0,0 +1,243 @@
+"""Minimal Prometheus-style metrics, rendered by GET /metrics.
+
+Counters and histograms are plain dicts behind a lock, so recording costs a
+few microseconds. Values that already live elsewhere (cache statistics) are
+read at scrape time through collectors instead of being counted twice.
+
+Set PROFILE_SAMPLE_RATE (e.g. 0.01) to run cProfile on that fraction of
+``profiled()`` blocks; the accumulated profile is served by
+GET /debug/profile (an admin endpoint; needs X-Admin-Token).
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(entry)) for key, entry in self._values.items()]
+        samples = []
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                samples.append((f"{self.name}_bucket", labels, cumulative))
+            samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [("le", "+Inf")]), entry[-1]))
+            samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), entry[-2]))
+            samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), entry[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        """``collector()`` returns ``[(name, kind, documentation, [(labels dict, value), ...]), ...]``."""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def cache_collector(caches):
+    """Collector exposing ``stats()`` of named caches (cache.LRUTTLCache)."""
+    fields = (
+        ('cache_hits_total', 'counter', "Cache lookups that found a fresh entry", 'hits'),
+        ('cache_misses_total', 'counter', "Cache lookups that found nothing", 'misses'),
+        ('cache_evictions_total', 'counter', "Entries dropped to stay within maxsize", 'evictions'),
+        ('cache_entries', 'gauge', "Entries currently stored", 'size'),
+        ('cache_hit_ratio', 'gauge', "Hits over lookups since start", 'hit_rate'),
+    )
+
+    def collect():
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        return [
+            (metric, kind, documentation, [({"cache": name}, values[field]) for name, values in stats.items()])
+            for metric, kind, documentation, field in fields
+        ]
+    return collect
+
+
+def flight_collector(flights):
+    """Collector exposing ``stats()`` of named cache.SingleFlight groups."""
+    fields = (
+        ('singleflight_calls_total', 'counter', "Computations started", 'calls'),
+        ('singleflight_coalesced_total', 'counter', "Callers that joined a computation already in flight", 'coalesced'),
+        ('singleflight_inflight', 'gauge', "Computations currently in flight", 'inflight'),
+    )
+
+    def collect():
+        stats = {name: flight.stats() for name, flight in flights.items()}
+        return [
+            (metric, kind, documentation, [({"flight": name}, values[field]) for name, values in stats.items()])
+            for metric, kind, documentation, field in fields
+        ]
+    return collect
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# --- Sampling profiler ---
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+_profile_stats = None
+_profile_samples = 0
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def profiled():
+    """Profile the block for a PROFILE_SAMPLE_RATE fraction of calls."""
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active on this thread
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        global _profile_stats, _profile_samples
+        with _profile_lock:
+            if _profile_stats is None:
+                _profile_stats = pstats.Stats(profiler)
+            else:
+                _profile_stats.add(profiler)
+            _profile_samples += 1
+
+
+def sampled(fn):
+    """Decorator running ``fn`` under ``profiled()``."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with profiled():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+# pstats.SortKey values plus the aliases sort_stats() also takes (tottime, ncalls, ...)
+PROFILE_SORT_KEYS = sorted({key.value for key in pstats.SortKey} | set(pstats.Stats.sort_arg_dict_default))
+PROFILE_MAX_LIMIT = 500
+
+
+def profile_report(limit=40, sort='cumulative'):
+    # sort must be one of PROFILE_SORT_KEYS; limit is clamped
+    if sort not in PROFILE_SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(PROFILE_SORT_KEYS)}")
+    limit = min(max(limit, 1), PROFILE_MAX_LIMIT)
+    with _profile_lock:
+        if _profile_stats is None:
+            return f"No profiles collected (PROFILE_SAMPLE_RATE={PROFILE_SAMPLE_RATE}).\n"
+        out = io.StringIO()
+        _profile_stats.stream = out
+        out.write(f"{_profile_samples} sampled blocks\n")
+        _profile_stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
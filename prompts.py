@@ -0,0 +1,158 @@
+"""Explanation prompts, sized to a token budget.
+
+The static instructions are dedented and rendered once at import. A prompt
+adds a character glossary -- each distinct character's talent texts, once,
+under a short id such as [C1] -- and the team, whose members refer to the
+glossary by id. If the prompt would exceed EXPLAIN_PROMPT_TOKENS, the
+talent texts are cut back to whole sentences: short texts are kept whole
+and the longer ones share what is left of the budget equally.
+
+Token counts are estimated at four characters per token, which is close
+enough for budgeting; gemini_tokens_total has Gemini's own counts.
+"""
+import functools
+import hashlib
+import logging
+import os
+import re
+import textwrap
+
+import metrics
+from character_store import display_name, lookup_key
+
+logger = logging.getLogger(__name__)
+
+# Estimated tokens per prompt; 0 sends the talent texts untruncated
+EXPLAIN_PROMPT_TOKENS = int(os.getenv('EXPLAIN_PROMPT_TOKENS', 1500))
+# No talent text is cut shorter than this, whatever the budget
+MIN_TEXT_TOKENS = 24
+
+INSTRUCTIONS = textwrap.dedent('''
+    You are an expert Genshin Impact team strategist. Based solely on the given team composition and character details, generate a structured explanation that covers elemental synergies, valid playstyles, role distribution, resource management (based on characters' energy requirements), a funny overall judgement on the team and optimal artifact sets.
+
+    1. Allowed reactions (DO NOT mix up these reactions, DO NOT MENTION UNRELATED REACTIONS.):
+    - Vaporize = Hydro + Pyro
+    - Freeze = Cryo + Hydro
+    - Superconduct = Cryo + Electro
+    - Melt = Cryo + Pyro
+    - Burning = Dendro + Pyro
+    - Bloom = Dendro + Hydro
+    - Quicken = Dendro + Electro
+    - Hyperbloom = Electro + Dendro + Hydro. If this occurs, bloom or quicken should not be mentioned.
+    - Burgeon = Pyro + Dendro + Hydro
+    - Electro-Charged = Hydro + Electro
+    - Overload = Pyro + Electro
+    - Swirl = triggered only with Pyro/Hydro/Electro/Cryo
+    - Crystallize = triggered only with Pyro/Hydro/Electro/Cryo
+    2. IMPORTANT: Capitalize the first letter of all character names in the explanation, but KEEP the hyphens, e.g Kamisato-Ayato instead of kamisato-ayato.
+    3. Explain only the one team given below. Do not write a title or repeat the team list; start directly with the explanation. Character details are in the character glossary; team members refer to it by id, e.g. [C1]. The following is an example explanation for Mavuika (Main DPS), Citlali (Sub-DPS), Xilonen (Support), Bennett (Support):
+    Both Citlali and Xilonen gain and lose Nightsoul points quickly, allowing Mavuika to continuously cast her Elemental Burst with ease. Bennett provides healing and ATK buff through his Burst.
+
+    Role distribution: Citlali is a notable off-field Cryo driver who can help Mavuika continuously trigger Melt on most of her attacks. On top of that, Citlali reduces enemies’ resistance to Pyro by 20% through her Ascension passive. Let Xilonen take the field for a few seconds and shred enemies' RES, allowing your attacks to deal more manage.
+
+    Resource management: Fighting Spirit generation is crucial for Mavuika, but that is not an issue with both Citlali and Xilonen, who both have Nightsoul, in the team.
+
+    Overall, this is an extremely good team which should serve you well in both the abyss and the overworld. With 3 five-stars in the same team, are you sure you aren't a whale?
+
+    Recommended artifact set: Mavuika (Obsidian Codex), Citlali (Scroll of the Hero of Cinder City), Xilonen (Archaic Petra), Bennett (Noblesse Oblige)
+''').strip()
+
+with open(__file__, 'rb') as _f:
+    # Part of every explanation cache key: editing the instructions, the
+    # layout or the budget changes the prompts
+    PROMPT_VERSION = hashlib.sha256(_f.read() + str(EXPLAIN_PROMPT_TOKENS).encode()).hexdigest()[:12]
+
+PROMPT_TOKENS = metrics.histogram('explanation_prompt_tokens', "Estimated tokens per explanation prompt",
+                                  buckets=(250, 500, 750, 1000, 1500, 2000, 3000, 4000, 6000, 8000))
+TRUNCATED = metrics.counter('explanation_truncated_texts_total', "Talent texts shortened to fit the prompt budget")
+
+SENTENCE_END = re.compile(r'[.!?](?=\s|$)')
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+INSTRUCTION_TOKENS = estimate_tokens(INSTRUCTIONS)
+
+
+@functools.lru_cache(maxsize=4096)
+def shorten(text, max_tokens):
+    """``text`` cut to at most ``max_tokens``, at a sentence end if one is
+    past halfway, otherwise at a word with an ellipsis."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens * 4 - 1
+    head = text[:limit]
+    ends = [match.end() for match in SENTENCE_END.finditer(head)]
+    if ends and ends[-1] >= limit // 2:
+        return head[:ends[-1]]
+    if ' ' in head:
+        head = head.rsplit(' ', 1)[0]
+    return head.rstrip(',;: ') + '…'
+
+
+def allocate(lengths, budget):
+    """Token caps for texts of ``lengths`` tokens sharing ``budget``: the
+    shortest are kept whole, the rest split what is left equally."""
+    caps = [0] * len(lengths)
+    remaining = max(budget, 0)
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    for n, i in enumerate(order):
+        share = max(remaining // (len(order) - n), MIN_TEXT_TOKENS)
+        caps[i] = min(lengths[i], share)
+        remaining -= caps[i]
+    return caps
+
+
+def build_team_prompt(team, talents, budget=EXPLAIN_PROMPT_TOKENS):
+    """``(prompt, prompt_tokens)`` for one team as built by format_teams.
+
+    ``talents(name)`` returns a character's ``((label, text), ...)``, or None
+    if there is no description of them.
+    """
+    glossary_ids, entries, members = {}, [], []
+    for char in team['Characters']:
+        name = display_name(char['Name'])
+        key = lookup_key(char['Name'])
+        if key not in glossary_ids:
+            texts = talents(char['Name'])
+            glossary_ids[key] = f"C{len(entries) + 1}" if texts is not None else None
+            if texts is not None:
+                entries.append((glossary_ids[key], name, texts))
+        glossary_id = glossary_ids[key]
+        if glossary_id is None:
+            members.append(f" - {name} (Data not found!)")
+        else:
+            members.append(f" - {name} [{glossary_id}] (Role: {char['Role']}, Element: {char['Element']}, Tier: {char['Tier']})")
+
+    formatted_team_key = ", ".join(f"{char['Name']} ({char['Role']})" for char in team['Characters'])
+    team_text = f"Team for Analysis:\n**Team Explanation Start**\nTEAM: {formatted_team_key}\nMembers:\n" + "\n".join(members)
+
+    texts = [text for _, _, fields in entries for _, text in fields]
+    lengths = [estimate_tokens(text) for text in texts]
+    if budget > 0:
+        # Everything but the talent texts themselves is fixed
+        skeleton = "Character glossary:\n" + "".join(
+            f"[{glossary_id}] {name}\n" + "".join(f"  {label}: \n" for label, _ in fields)
+            for glossary_id, name, fields in entries)
+        available = budget - INSTRUCTION_TOKENS - estimate_tokens(team_text) - estimate_tokens(skeleton) - 2
+        caps = iter(allocate(lengths, available))
+    else:
+        caps = iter(lengths)
+
+    glossary, truncated = ["Character glossary:"], 0
+    for glossary_id, name, fields in entries:
+        glossary.append(f"[{glossary_id}] {name}")
+        for label, text in fields:
+            short = shorten(text, next(caps))
+            truncated += short is not text
+            glossary.append(f"  {label}: {short}")
+
+    prompt = "\n\n".join((INSTRUCTIONS, "\n".join(glossary), team_text))
+    prompt_tokens = estimate_tokens(prompt)
+    PROMPT_TOKENS.observe(prompt_tokens)
+    if truncated:
+        TRUNCATED.inc(truncated)
+    logger.debug("Explanation prompt: %d tokens, %d talent texts shortened", prompt_tokens, truncated)
+    return prompt, prompt_tokens
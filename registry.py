@@ -0,0 +1,188 @@
+"""Versioned roster data, replaced whole when the source files change.
+
+A RosterData snapshot holds everything derived from actual.csv and
+team_rules.json: the raw dicts, the CharacterTable, the compiled rules and
+the all-character encoding used by sessions. Snapshots are never modified.
+A request takes one with ``REGISTRY.get()`` and uses it throughout, so it
+finishes on the version it started with even if a reload lands meanwhile.
+
+``reload()`` parses and validates the files on the calling thread (the
+watcher or POST /admin/reload, never a request) and swaps the new snapshot
+in with a single assignment; invalid data is rejected and the current
+snapshot stays. ``current()`` returns the version id, a hash of the source
+files, so a DataRegistry can stand in for a cache.FileVersion.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+
+import scoring
+from cache import FileVersion
+from character_store import normalise
+from snapshot import SOURCES, load_roster_data, source_hashes
+
+logger = logging.getLogger(__name__)
+
+# characters.json only feeds explanations, but cached results include those
+VERSION_SOURCES = SOURCES + ('characters.json',)
+# Seconds between checks of the source files; 0 disables the watcher
+DATA_WATCH_INTERVAL = float(os.getenv('DATA_WATCH_INTERVAL', 5))
+
+
+class DataError(ValueError):
+    """New roster data that failed to parse or validate."""
+
+
+class RosterData:
+    __slots__ = ('version', 'loaded_at', 'character_data', 'team_rules', 'characters', 'rules',
+                 'all_characters', 'all_rules', 'order')
+
+    def __init__(self, version, character_data, team_rules):
+        self.version = version
+        self.loaded_at = time.time()
+        self.character_data = MappingProxyType(character_data)
+        self.team_rules = team_rules
+        # Every character as a scoring.Character with a small integer id (its
+        # position in character_data), plus the same fields as id-indexed arrays
+        self.characters = scoring.CharacterTable(character_data)
+        # Normalised, index-based rule tables; built once so scoring never has
+        # to walk or normalise the raw rule lists
+        self.rules = scoring.compile_team_rules(team_rules, character_data, normalise)
+        # Every character encoded once, so sessions can work in global indices
+        self.all_characters = self.characters.roster(list(character_data))
+        self.all_rules = self.rules.for_roster(self.all_characters)
+        self.order = scoring.character_order(self.all_characters)
+
+
+def validate(data):
+    """Problems with a RosterData that should keep it from replacing a good one."""
+    problems = []
+    if not data.character_data:
+        return ["No characters loaded from actual.csv"]
+    for name, info in data.character_data.items():
+        if info.get('tier') not in scoring.TIER_VALUES:
+            problems.append(f"{name}: unknown tier {info.get('tier')!r}")
+        if info.get('element') not in scoring.ELEMENTS:
+            problems.append(f"{name}: unknown element {info.get('element')!r}")
+        roles = info.get('roles') or []
+        if not roles or any(role not in scoring.ROLE_BITS for role in roles):
+            problems.append(f"{name}: bad roles {roles!r}")
+    if not (data.characters.roles & scoring.ROLE_MAIN_DPS).any():
+        problems.append("No Main DPS characters")
+    problems.extend(f"team_rules.json: unknown {name}" for name in data.rules.unknown_names)
+    return problems
+
+
+def data_version(paths=VERSION_SOURCES):
+    digest = hashlib.sha256()
+    for path, content_hash in sorted(source_hashes(paths).items()):
+        digest.update(f"{path}:{content_hash};".encode())
+    return digest.hexdigest()[:16]
+
+
+class DataRegistry:
+    def __init__(self, paths=VERSION_SOURCES):
+        self.paths = paths
+        self._data = None
+        self._reload_lock = threading.Lock()
+        self._listeners = []
+        self._watcher = None
+        self.reloads = 0
+        self.last_error = None
+
+    def get(self):
+        """The current RosterData; keep using the same one for a whole request."""
+        return self._data
+
+    def current(self):
+        return self._data.version
+
+    def subscribe(self, listener):
+        """Call ``listener(data)`` on the reloading thread after each swap."""
+        self._listeners.append(listener)
+
+    def _build(self, strict):
+        # Hashed before reading, so a change while parsing only means one
+        # more reload later, never a stale version id for new data
+        version = data_version(self.paths)
+        try:
+            raw = load_roster_data(strict=strict)
+            data = RosterData(version, raw["character_data"], raw["team_rules"])
+        except Exception as e:
+            raise DataError(f"Could not load roster data: {e}") from e
+        return data
+
+    def load(self):
+        """Initial load. Problems are logged, not fatal: there is nothing older to keep."""
+        with self._reload_lock:
+            data = self._build(strict=False)
+            for problem in validate(data):
+                logger.error("Roster data: %s", problem)
+            self._data = data
+        return data
+
+    def reload(self, force=False):
+        """Load the source files again and swap them in if they changed.
+
+        Returns ``(changed, data)``; raises DataError, leaving the current
+        snapshot in place, if the new files are invalid.
+        """
+        with self._reload_lock:
+            old = self._data
+            if not force and old is not None and data_version(self.paths) == old.version:
+                return False, old
+            try:
+                data = self._build(strict=True)
+                problems = validate(data)
+                if problems:
+                    raise DataError("; ".join(problems[:20]))
+            except DataError as e:
+                self.last_error = str(e)
+                logger.error("Roster data reload rejected, keeping version %s: %s",
+                             old.version if old else None, e)
+                raise
+            self._data = data
+            self.reloads += 1
+            self.last_error = None
+        logger.info("Roster data version %s -> %s (%d characters)", old.version if old else None,
+                    data.version, len(data.character_data))
+        for listener in self._listeners:
+            try:
+                listener(data)
+            except Exception:
+                logger.exception("Roster data reload listener failed")
+        return True, data
+
+    def _watch(self, interval):
+        files = FileVersion(*self.paths)
+        seen = files.current()
+        while True:
+            time.sleep(interval)
+            stamp = files.current()
+            if stamp == seen:
+                continue
+            seen = stamp
+            try:
+                self.reload()
+            except DataError:
+                pass  # logged; the next change to the files tries again
+
+    def watch(self, interval=DATA_WATCH_INTERVAL):
+        """Reload in a daemon thread whenever the source files change."""
+        if interval > 0 and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, args=(interval,), name="data-watch", daemon=True)
+            self._watcher.start()
+
+    def stats(self):
+        data = self._data
+        return {
+            "version": data.version if data else None,
+            "characters": len(data.character_data) if data else 0,
+            "loaded_at": data.loaded_at if data else None,
+            "reloads": self.reloads,
+            "last_error": self.last_error,
+            "watching": self._watcher is not None,
+        }
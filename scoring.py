@@ -0,0 +1,1093 @@
+"""Batched NumPy scoring engine used by generate_teams_optimized.
+
+Every character gets a small integer id when the data is loaded, and its
+element, roles, nightsoul, off-field flag and tier value are kept both as a
+``__slots__`` record and as arrays indexed by id (CharacterTable).  A
+request's roster is a slice of those arrays, every Format A/B/C candidate
+is enumerated as a row of roster indices, and the base, resonance,
+reaction, nightsoul, off-field and synergy scores are computed for all
+candidates at once.  The per-team functions in server.py remain the
+reference implementation; the two must always agree.
+"""
+import heapq
+import logging
+from functools import lru_cache
+from itertools import combinations, combinations_with_replacement
+from math import comb
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ELEMENTS = ["Pyro", "Hydro", "Cryo", "Electro", "Geo", "Anemo", "Dendro"]
+PYRO, HYDRO, CRYO, ELECTRO, GEO, ANEMO, DENDRO = range(len(ELEMENTS))
+ELEMENT_BITS = {element: 1 << i for i, element in enumerate(ELEMENTS)}
+POPCOUNT = np.array([bin(mask).count('1') for mask in range(1 << len(ELEMENTS))], dtype=np.int32)
+
+ROLE_MAIN_DPS = 1
+ROLE_SUB_DPS = 2
+ROLE_SUPPORT = 4
+
+FORMAT_A = 0  # 1 Main DPS + 2 Sub-DPS + 1 Support
+FORMAT_B = 1  # 1 Main DPS + 1 Sub-DPS + 2 Supports
+FORMAT_C = 2  # 1 Main DPS + 3 Supports
+
+# Indexed by the number of nightsoul / off-field characters in the team
+NIGHTSOUL_SCORES = np.array([0, 0, 20, 25, 30], dtype=np.int64)
+OFF_FIELD_BONUSES = np.array([0, 0, 10, 15, 0], dtype=np.int64)
+
+PREFERRED_CHARACTER_BONUS = 50
+PREFERRED_ELEMENT_BONUS = 25
+EXCLUDED_ELEMENT_PENALTY = 100
+INCOMPATIBLE_SUPPORT_PENALTY = 100
+
+# Resonance bonus for two or more members of an element
+RESONANCE_WEIGHTS = {PYRO: 20, HYDRO: 15, CRYO: 20, ELECTRO: 15, GEO: 15, ANEMO: 10, DENDRO: 15}
+# Bonus for a team able to trigger each reaction (see element_scores).
+# Changing either table rebuilds the element_score_table lookup.
+REACTION_WEIGHTS = {
+    'vaporize': 25,
+    'melt': 30,
+    'freeze': 8,
+    'overload': 15,
+    'hyperbloom': 50,  # needs an off-field Dendro and no Pyro
+    'burgeon': 20,
+    'bloom': 15,
+    'quicken': 8,
+    'crystallise': 5,
+    'swirl': 25,
+    'anemo_clash': -50,  # Anemo with Geo or Dendro
+}
+
+TIER_VALUES = {"SS": 100, "S": 80, "A": 50, "B": 20, "C": 10}
+ROLE_BITS = {'Main DPS': ROLE_MAIN_DPS, 'Sub-DPS': ROLE_SUB_DPS, 'Support': ROLE_SUPPORT}
+
+# Character-specific adjustments of calculate_resonance_score:
+# (character, needs Support role, elements counted, fewest, most, delta).
+# delta applies to a team with the character when its number of members of
+# the counted elements is between fewest and most.  compile_team_rules
+# resolves the names to character ids.
+CHARACTER_RULES = [
+    ('fischl', False, (HYDRO, DENDRO), 2, 4, -20),  # not the best in hyperbloom
+    ('chevreuse', True, (PYRO, ELECTRO), 0, 2, -50),  # needs Pyro/Electro teammates
+    ('kujou-sara', True, (ELECTRO,), 0, 1, -100),  # needs Electro DPS
+    ('shenhe', True, (CRYO,), 0, 1, -100),  # Cryo support
+    ('faruzan', True, (ANEMO,), 0, 1, -100),
+    ('gorou', True, (GEO,), 0, 1, -100),
+    ('kuki-shinobu', True, (HYDRO, DENDRO), 2, 4, 100),  # preferred over Fischl in hyperbloom
+]
+
+
+class Character:
+    """One character_data entry; ``id`` is its position in character_data."""
+
+    __slots__ = ('id', 'name', 'element', 'roles', 'tier_value', 'nightsoul', 'off_field')
+
+    def __init__(self, id, name, element, roles, tier_value, nightsoul, off_field):
+        self.id = id
+        self.name = name
+        self.element = element  # index into CharacterTable.element_names
+        self.roles = roles  # ROLE_* bitmask
+        self.tier_value = tier_value
+        self.nightsoul = nightsoul
+        self.off_field = off_field
+
+    @property
+    def is_main_dps(self):
+        return bool(self.roles & ROLE_MAIN_DPS)
+
+    @property
+    def is_sub_dps(self):
+        return bool(self.roles & ROLE_SUB_DPS)
+
+    @property
+    def is_support(self):
+        return bool(self.roles & ROLE_SUPPORT)
+
+    def __repr__(self):
+        return f"Character({self.id}, {self.name!r})"
+
+
+class CharacterTable:
+    """Every character in character_data, built once at load time.
+
+    ``records[id]`` is the Character with that id, and ``element``,
+    ``roles``, ``tier_value``, ``nightsoul`` and ``off_field`` hold the same
+    fields as arrays indexed by id.
+    """
+
+    def __init__(self, char_data):
+        self.names = list(char_data)
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        # The seven real elements keep fixed indices; anything else in the
+        # CSV (e.g. 'Unknown') gets its own slot after them.
+        self.element_index = {element: i for i, element in enumerate(ELEMENTS)}
+        for info in char_data.values():
+            self.element_index.setdefault(info.get('element', 'Unknown'), len(self.element_index))
+        self.element_names = list(self.element_index)
+
+        self.records = []
+        for i, (name, info) in enumerate(char_data.items()):
+            roles = 0
+            for role in info.get('roles', []):
+                roles |= ROLE_BITS.get(role, 0)
+            self.records.append(Character(
+                i, name, self.element_index[info.get('element', 'Unknown')], roles,
+                TIER_VALUES.get(info.get('tier', 'B'), 0), bool(info.get('nightsoul', False)),
+                bool(info.get('off_field', False))))
+
+        self.element = np.array([c.element for c in self.records], dtype=np.int8)
+        self.roles = np.array([c.roles for c in self.records], dtype=np.int8)
+        self.tier_value = np.array([c.tier_value for c in self.records], dtype=np.int64)
+        self.nightsoul = np.array([c.nightsoul for c in self.records], dtype=bool)
+        self.off_field = np.array([c.off_field for c in self.records], dtype=bool)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, name):
+        return self.records[self.index[name]]
+
+    def ids(self, names):
+        return np.array([self.index[name] for name in names], dtype=np.int16)
+
+    def roster(self, names):
+        return EncodedRoster(self, names)
+
+
+class EncodedRoster:
+    """The characters taking part in one request, sliced out of a
+    CharacterTable.  ``ids[i]`` is the table id of roster index ``i``."""
+
+    def __init__(self, table, names):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.ids = table.ids(self.names)
+        self.element_index = table.element_index
+
+        self.element = table.element[self.ids]
+        self.tier_value = table.tier_value[self.ids]
+        self.nightsoul = table.nightsoul[self.ids]
+        self.off_field = table.off_field[self.ids]
+        self.roles = table.roles[self.ids]
+        self.dendro_off_field = (self.element == DENDRO) & self.off_field
+        self.element_code = member_codes(self.element, self.dendro_off_field)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def num_elements(self):
+        return len(self.element_index)
+
+    def indices(self, names):
+        return np.array([self.index[name] for name in names], dtype=np.int16)
+
+
+class CompiledRules:
+    """team_rules.json resolved once against the character data.
+
+    Characters are identified by their position in ``names`` (the
+    character_data keys).  ``synergy[a, b]`` is the bonus ``a`` gets from a
+    preferred teammate ``b``; ``incompatible[m, a]`` is set when ``a`` should
+    not support main DPS ``m``; ``preferred_elements`` and
+    ``excluded_elements`` are per-character bitmasks over ELEMENTS.
+    ``pair_score`` folds the two matrices into the score ``a`` contributes
+    whenever ``b`` is in the same team.  ``character_rules`` lists the
+    CHARACTER_RULES that apply, as ``(id, elements, fewest, most, delta)``.
+    """
+
+    def __init__(self, names, synergy, incompatible, preferred_elements, excluded_elements, character_rules,
+                 unknown_names):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.synergy = synergy
+        self.incompatible = incompatible
+        self.preferred_elements = preferred_elements
+        self.excluded_elements = excluded_elements
+        self.character_rules = character_rules
+        self.unknown_names = unknown_names
+        self.pair_score = synergy - INCOMPATIBLE_SUPPORT_PENALTY * incompatible.T.astype(np.int32)
+
+    def ids(self, names):
+        return np.array([self.index[name] for name in names], dtype=np.int16)
+
+    def for_roster(self, roster):
+        """Slice the tables down to one request's roster indices."""
+        ids = roster.ids
+        position = {int(char_id): i for i, char_id in enumerate(ids)}
+        character_rules = [(position[c], *rule) for c, *rule in self.character_rules if c in position]
+        return RosterRules(self.pair_score[np.ix_(ids, ids)], self.preferred_elements[ids],
+                           self.excluded_elements[ids], character_rules)
+
+
+class RosterRules:
+    def __init__(self, pair_score, preferred_elements, excluded_elements, character_rules):
+        self.pair_score = pair_score
+        self.preferred_elements = preferred_elements
+        self.excluded_elements = excluded_elements
+        # (roster index, elements, fewest, most, delta)
+        self.character_rules = character_rules
+
+
+def compile_team_rules(team_rules, char_data, normalise):
+    """Build CompiledRules from the raw team_rules.json dict.
+
+    Names are normalised and checked against the character_data keys;
+    anything that does not resolve is printed and listed in
+    ``unknown_names`` instead of being silently ignored.
+    """
+    names = list(char_data)
+    index = {name: i for i, name in enumerate(names)}
+    n = len(names)
+    synergy = np.zeros((n, n), dtype=np.int32)
+    incompatible = np.zeros((n, n), dtype=bool)
+    preferred_elements = np.zeros(n, dtype=np.uint8)
+    excluded_elements = np.zeros(n, dtype=np.uint8)
+    unknown_names = []
+
+    def resolve(name, where):
+        char_id = index.get(normalise(name))
+        if char_id is None:
+            unknown_names.append(f"{where}: {name}")
+        return char_id
+
+    def element_mask(elements, where):
+        mask = 0
+        for element in elements:
+            if element in ELEMENT_BITS:
+                mask |= ELEMENT_BITS[element]
+            else:
+                unknown_names.append(f"{where}: {element}")
+        return mask
+
+    for char, rules in team_rules.get("synergy_rules", {}).items():
+        a = resolve(char, "synergy_rules")
+        if a is None:
+            continue
+        for name in dict.fromkeys(rules.get('preferred', [])):
+            b = resolve(name, f"synergy_rules.{char}.preferred")
+            if b is not None:
+                synergy[a, b] = PREFERRED_CHARACTER_BONUS
+        preferred_elements[a] = element_mask(rules.get('preferred_elements', []), f"synergy_rules.{char}.preferred_elements")
+        excluded_elements[a] = element_mask(rules.get('excluded_elements', []), f"synergy_rules.{char}.excluded_elements")
+
+    for main_dps, incompatible_list in team_rules.get("incompatible_supports", {}).items():
+        m = resolve(main_dps, "incompatible_supports")
+        if m is None:
+            continue
+        for name in incompatible_list:
+            a = resolve(name, f"incompatible_supports.{main_dps}")
+            if a is not None and a != m:
+                incompatible[m, a] = True
+
+    character_rules = []
+    for name, needs_support, counted, fewest, most, delta in CHARACTER_RULES:
+        c = resolve(name, "CHARACTER_RULES")
+        if c is not None and (not needs_support or 'Support' in char_data[names[c]].get('roles', [])):
+            character_rules.append((c, counted, fewest, most, delta))
+
+    if unknown_names:
+        logger.warning("Unknown names in team rules will be ignored: %s", unknown_names)
+    return CompiledRules(names, synergy, incompatible, preferred_elements, excluded_elements, character_rules,
+                         unknown_names)
+
+
+@lru_cache(maxsize=None)
+def _combination_positions(n, k):
+    # Same lexicographic order as itertools.combinations, which the original
+    # per-team loops used and which the tie-breaking below depends on.
+    positions = np.array(list(combinations(range(n), k)), dtype=np.int16)
+    return positions.reshape(-1, k)
+
+
+def enumerate_candidates(roster, main_dps_list, sub_dps_list, support_list, query=None):
+    """Enumerate every Format A/B/C team in the order the per-team loops did.
+
+    Returns ``(teams, main_pos, formats)``: an ``(N, 4)`` array of roster
+    indices laid out as [main, subs..., supports...], the position of each
+    team's main DPS in ``main_dps_list`` and the format code of each team.
+    With a TeamQuery only the teams matching it are enumerated (see
+    enumerate_matching).
+    """
+    if query is not None and query.narrows:
+        return enumerate_matching(roster, main_dps_list, sub_dps_list, support_list, query)
+    sub_idx = roster.indices(sub_dps_list)
+    support_idx = roster.indices(support_list)
+
+    blocks, owners, formats = [], [], []
+
+    def add(pos, fmt, block):
+        if len(block):
+            blocks.append(block)
+            owners.append(np.full(len(block), pos, dtype=np.int32))
+            formats.append(np.full(len(block), fmt, dtype=np.int8))
+
+    for pos, main in enumerate(main_dps_list):
+        m = roster.index[main]
+        subs = sub_idx[sub_idx != m]
+        supports = support_idx[support_idx != m]
+
+        # Format A: each sub pair followed by every support not in the pair
+        if len(subs) >= 2 and len(supports) >= 1:
+            pairs = subs[_combination_positions(len(subs), 2)]
+            rep_pairs = np.repeat(pairs, len(supports), axis=0)
+            rep_supports = np.tile(supports, len(pairs))
+            keep = (rep_supports != rep_pairs[:, 0]) & (rep_supports != rep_pairs[:, 1])
+            block = np.empty((int(keep.sum()), 4), dtype=np.int16)
+            block[:, 0] = m
+            block[:, 1:3] = rep_pairs[keep]
+            block[:, 3] = rep_supports[keep]
+            add(pos, FORMAT_A, block)
+
+        # Format B: each sub followed by every support pair without it
+        if len(subs) >= 1 and len(supports) >= 2:
+            pairs = supports[_combination_positions(len(supports), 2)]
+            rep_subs = np.repeat(subs, len(pairs))
+            rep_pairs = np.tile(pairs, (len(subs), 1))
+            keep = (rep_pairs[:, 0] != rep_subs) & (rep_pairs[:, 1] != rep_subs)
+            block = np.empty((int(keep.sum()), 4), dtype=np.int16)
+            block[:, 0] = m
+            block[:, 1] = rep_subs[keep]
+            block[:, 2:4] = rep_pairs[keep]
+            add(pos, FORMAT_B, block)
+
+        # Format C: hypercarry with three supports
+        if len(supports) >= 3:
+            triples = supports[_combination_positions(len(supports), 3)]
+            block = np.empty((len(triples), 4), dtype=np.int16)
+            block[:, 0] = m
+            block[:, 1:4] = triples
+            add(pos, FORMAT_C, block)
+
+    if not blocks:
+        return np.empty((0, 4), dtype=np.int16), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8)
+    return np.concatenate(blocks), np.concatenate(owners), np.concatenate(formats)
+
+
+# --- Team queries ---
+# "Best teams with Furina", "no Bennett", "mono-Pyro": constraints applied
+# while enumerating rather than to the ranked result, so the per-main and
+# overall limits apply to the matching teams only. Excluded characters and
+# elements are dropped from the roster up front, which changes nothing else
+# about the remaining teams. Must-include characters, required elements and
+# formats prune each main DPS's sub pairs, supports and triples before they
+# are combined. The matching teams are then ranked exactly as if every
+# candidate had been ranked and the others filtered out.
+
+FORMAT_NAMES = {'A': FORMAT_A, 'B': FORMAT_B, 'C': FORMAT_C}
+
+
+class TeamQuery:
+    """Constraints on the candidate teams.
+
+    ``include`` and ``exclude`` are character names every team must have or
+    none may have; ``elements`` and ``exclude_elements`` are ELEMENTS
+    indices a team needs a member of or may have no member of; ``formats``
+    are the FORMAT_* codes teams may be generated in.
+    """
+
+    __slots__ = ('include', 'exclude', 'elements', 'exclude_elements', 'formats')
+
+    def __init__(self, include=(), exclude=(), elements=(), exclude_elements=(), formats=tuple(FORMAT_NAMES.values())):
+        self.include = tuple(sorted(set(include)))
+        self.exclude = tuple(sorted(set(exclude)))
+        self.elements = tuple(sorted(set(elements)))
+        self.exclude_elements = tuple(sorted(set(exclude_elements)))
+        self.formats = tuple(sorted(set(formats)))
+
+    @property
+    def narrows(self):
+        # Anything beyond dropping characters from the roster
+        return bool(self.include or self.elements or len(self.formats) < len(FORMAT_NAMES))
+
+    def __bool__(self):
+        return bool(self.exclude or self.exclude_elements or self.narrows)
+
+    def key(self):
+        return (self.include, self.exclude, self.elements, self.exclude_elements, self.formats)
+
+    def element_mask(self):
+        mask = 0
+        for element in self.elements:
+            mask |= 1 << element
+        return mask
+
+    def allows(self, record):
+        """Whether a scoring.Character may be in the roster at all."""
+        return record.name not in self.exclude and record.element not in self.exclude_elements
+
+    def contradiction(self):
+        """Why no team can match, or None."""
+        if len(self.include) > 4:
+            return "A team has at most 4 characters."
+        if len(self.elements) > 4:
+            return "A team has at most 4 elements."
+        if set(self.include) & set(self.exclude):
+            return "A character cannot be both included and excluded."
+        if set(self.elements) & set(self.exclude_elements):
+            return "An element cannot be both required and excluded."
+        if not self.formats:
+            return "At least one format is needed."
+        return None
+
+
+def element_bits(roster):
+    """Each roster character's ELEMENT_BITS bit, 0 outside ELEMENTS."""
+    return np.where(roster.element < len(ELEMENTS), np.left_shift(1, roster.element.astype(np.int64)), 0)
+
+
+def first_formats(roster, teams):
+    """The format the main DPS in column 0 first generates each team in:
+    A if two teammates can be subs and the third a support, else B if one
+    can be a sub and two supports, else C."""
+    roles = roster.roles[teams[:, 1:]]
+    sub = (roles & ROLE_SUB_DPS) != 0
+    sup = (roles & ROLE_SUPPORT) != 0
+    can_a = np.zeros(len(teams), dtype=bool)
+    can_b = np.zeros(len(teams), dtype=bool)
+    for s, p, q in ((0, 1, 2), (1, 0, 2), (2, 0, 1)):
+        can_a |= sup[:, s] & sub[:, p] & sub[:, q]
+        can_b |= sub[:, s] & sup[:, p] & sup[:, q]
+    return np.where(can_a, FORMAT_A, np.where(can_b, FORMAT_B, FORMAT_C)).astype(np.int8)
+
+
+def matching_teams(roster, teams, required, elements, formats):
+    """Mask of enumerate_candidates rows (main first) that hold every
+    ``required`` index and a member of each element in the ``elements``
+    bitmask, and that their main generates first in one of ``formats``.
+    ``roster`` may also be a CharacterTable, with ``teams`` of its ids."""
+    keep = np.ones(len(teams), dtype=bool)
+    for c in required:
+        keep &= (teams == c).any(axis=1)
+    if elements:
+        keep &= (np.bitwise_or.reduce(element_bits(roster)[teams], axis=1) & elements) == elements
+    if len(formats) < len(FORMAT_NAMES):
+        keep &= np.isin(first_formats(roster, teams), formats)
+    return keep
+
+
+def _matching_block(m, heads, tails, required, elements, bits):
+    """Rows [m, head..., tail...] for every disjoint head and tail (2-D
+    arrays of roster indices) that together hold the ``required`` indices
+    and a member of each element in the ``elements`` bitmask, head-major as
+    enumerate_candidates lists them."""
+    head_width, tail_width = heads.shape[1], tails.shape[1]
+    head_bits = np.bitwise_or.reduce(bits[heads], axis=1) if head_width else np.zeros(len(heads), dtype=np.int64)
+    tail_bits = np.bitwise_or.reduce(bits[tails], axis=1) if tail_width else np.zeros(len(tails), dtype=np.int64)
+    head_has = [(heads == c).any(axis=1) for c in required]
+    tail_has = [(tails == c).any(axis=1) for c in required]
+
+    # Drop heads (and tails) leaving more to the other side than it holds
+    # (a required character may well bring a required element too)
+    head_missing = np.maximum(POPCOUNT[elements & ~head_bits], sum((~has).astype(np.int32) for has in head_has))
+    tail_missing = np.maximum(POPCOUNT[elements & ~tail_bits], sum((~has).astype(np.int32) for has in tail_has))
+    h, t = np.flatnonzero(head_missing <= tail_width), np.flatnonzero(tail_missing <= head_width)
+    if not len(h) or not len(t):
+        return np.empty((0, 4), dtype=np.int16)
+
+    keep = np.ones((len(h), len(t)), dtype=bool)
+    for i in range(head_width):
+        for j in range(tail_width):
+            keep &= heads[h, i][:, None] != tails[t, j][None, :]
+    for head_c, tail_c in zip(head_has, tail_has):
+        keep &= head_c[h][:, None] | tail_c[t][None, :]
+    if elements:
+        keep &= ((head_bits[h][:, None] | tail_bits[t][None, :]) & elements) == elements
+    rows, cols = np.nonzero(keep)
+    block = np.empty((len(rows), 4), dtype=np.int16)
+    block[:, 0] = m
+    block[:, 1:1 + head_width] = heads[h[rows]]
+    block[:, 1 + head_width:] = tails[t[cols]]
+    return block
+
+
+def enumerate_matching(roster, main_dps_list, sub_dps_list, support_list, query):
+    """enumerate_candidates restricted to the teams matching ``query``.
+
+    A main DPS is skipped when the characters or elements it still needs
+    are missing from its teammates, and every block is built from the sub
+    pairs, subs and support pairs or triples that can still complete a
+    match. Teams are in enumeration order, and one whose first occurrence
+    is in a format the query leaves out is left out in every format, so
+    first_occurrences keeps exactly the matching unconstrained candidates.
+    """
+    sub_idx = roster.indices(sub_dps_list)
+    support_idx = roster.indices(support_list)
+    required = [roster.index[name] for name in query.include if name in roster.index]
+    if len(required) < len(query.include):
+        return np.empty((0, 4), dtype=np.int16), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8)
+    bits = element_bits(roster)
+    wanted = query.element_mask()
+    teammate_bits = int(np.bitwise_or.reduce(bits[np.union1d(sub_idx, support_idx)]))
+    restricted = len(query.formats) < len(FORMAT_NAMES)
+    no_block = np.empty((1, 0), dtype=np.int16)
+
+    blocks, owners, formats = [], [], []
+    for pos, main in enumerate(main_dps_list):
+        m = roster.index[main]
+        need = [c for c in required if c != m]
+        elements = wanted & ~int(bits[m])
+        subs = sub_idx[sub_idx != m]
+        supports = support_idx[support_idx != m]
+        if len(need) > 3 or POPCOUNT[elements] > 3 or elements & ~teammate_bits:
+            continue
+        if any(c not in subs and c not in supports for c in need):
+            continue
+
+        candidates = []
+        if FORMAT_A in query.formats and len(subs) >= 2 and len(supports) >= 1:
+            candidates.append((FORMAT_A, subs[_combination_positions(len(subs), 2)], supports[:, None]))
+        if FORMAT_B in query.formats and len(subs) >= 1 and len(supports) >= 2:
+            candidates.append((FORMAT_B, subs[:, None], supports[_combination_positions(len(supports), 2)]))
+        if FORMAT_C in query.formats and len(supports) >= 3:
+            candidates.append((FORMAT_C, supports[_combination_positions(len(supports), 3)], no_block))
+        for fmt, heads, tails in candidates:
+            block = _matching_block(m, heads, tails, need, elements, bits)
+            if restricted and fmt != FORMAT_A and len(block):
+                # Teams this main already generates in an earlier format
+                block = block[first_formats(roster, block) == fmt]
+            if len(block):
+                blocks.append(block)
+                owners.append(np.full(len(block), pos, dtype=np.int32))
+                formats.append(np.full(len(block), fmt, dtype=np.int8))
+
+    if not blocks:
+        return np.empty((0, 4), dtype=np.int16), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8)
+    teams, main_pos, formats = np.concatenate(blocks), np.concatenate(owners), np.concatenate(formats)
+    if restricted:
+        # ...and so are the teams an earlier main generates
+        main_rank = np.full(len(roster), len(main_dps_list), dtype=np.int32)
+        main_rank[roster.indices(main_dps_list)] = np.arange(len(main_dps_list), dtype=np.int32)
+        earlier = owned_by_earlier_main(roster, teams, main_rank, main_pos)
+        teams, main_pos, formats = teams[~earlier], main_pos[~earlier], formats[~earlier]
+    return teams, main_pos, formats
+# --- End Team queries ---
+
+
+def _sorted_members(teams):
+    # Sorting network for four columns; much cheaper than np.sort(axis=1)
+    a, b, c, d = (teams[:, i] for i in range(4))
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    c, d = np.minimum(c, d), np.maximum(c, d)
+    a, c = np.minimum(a, c), np.maximum(a, c)
+    b, d = np.minimum(b, d), np.maximum(b, d)
+    b, c = np.minimum(b, c), np.maximum(b, c)
+    return a, b, c, d
+
+
+@lru_cache(maxsize=None)
+def _binomial_table(n, k):
+    return np.array([comb(i, k) for i in range(n + 1)], dtype=np.int64)
+
+
+def team_ranks(teams, num_characters):
+    """Combinatorial-number-system rank of each team's character set.
+
+    Teams with the same members get the same rank regardless of order, and
+    ranks are dense in ``range(comb(num_characters, 4))``.
+    """
+    a, b, c, d = _sorted_members(teams)
+    n = max(num_characters, 4)
+    return (a.astype(np.int64) + _binomial_table(n, 2)[b] + _binomial_table(n, 3)[c] + _binomial_table(n, 4)[d])
+
+
+def first_occurrences(teams, num_characters, chunk_size=1 << 16):
+    """Mask keeping only the first enumeration of each character set."""
+    mask = np.zeros(len(teams), dtype=bool)
+    ranks = team_ranks(teams, num_characters)
+    seen = np.zeros(comb(max(num_characters, 4), 4), dtype=bool)
+    for start in range(0, len(teams), chunk_size):
+        chunk = ranks[start:start + chunk_size]
+        unique_ranks, first = np.unique(chunk, return_index=True)
+        new = ~seen[unique_ranks]
+        mask[start + first[new]] = True
+        seen[unique_ranks] = True
+    return mask
+
+
+def member_sum(values, teams):
+    """Sum of a per-character array over each team's four members."""
+    return values[teams[:, 0]] + values[teams[:, 1]] + values[teams[:, 2]] + values[teams[:, 3]]
+
+
+def character_rule_scores(rules, teams, codes):
+    score = np.zeros(len(teams), dtype=np.int64)
+    for c, counted, fewest, most, delta in rules.character_rules:
+        n = sum(count_digit(codes, e) for e in counted)
+        score += delta * ((teams == c).any(axis=1) & (n >= fewest) & (n <= most))
+    return score
+
+
+def element_scores(counts, dendro_off_field):
+    """Resonance and reaction score of each row of element counts."""
+    pyro, hydro, cryo, electro, geo, anemo, dendro = (counts[:, e] for e in range(len(ELEMENTS)))
+    score = np.zeros(len(counts), dtype=np.int64)
+
+    # Resonances
+    for element, weight in RESONANCE_WEIGHTS.items():
+        score += weight * (counts[:, element] >= 2)
+
+    # Reactions
+    has_pyro, has_hydro, has_cryo, has_electro = pyro > 0, hydro > 0, cryo > 0, electro > 0
+    has_geo, has_anemo, has_dendro = geo > 0, anemo > 0, dendro > 0
+    w = REACTION_WEIGHTS
+
+    score += w['vaporize'] * (has_hydro & has_pyro)
+    score += w['melt'] * (has_cryo & has_pyro)
+    score += w['freeze'] * (has_cryo & has_hydro)
+    score += w['overload'] * (has_electro & has_pyro)
+    score += w['hyperbloom'] * (has_electro & has_hydro & dendro_off_field & ~has_pyro)
+    score += w['burgeon'] * (has_hydro & has_dendro & has_pyro)
+    score += w['bloom'] * (has_hydro & has_dendro)
+    score += w['quicken'] * (has_electro & has_dendro)
+    score += w['crystallise'] * (has_geo & (has_hydro | has_pyro | has_electro))
+    score += w['swirl'] * (has_anemo & (has_hydro | has_pyro | has_electro))
+    score += w['anemo_clash'] * (has_anemo & (has_geo | has_dendro))
+    return score
+
+
+# --- Element composition table ---
+# The element part of a team's score depends only on how many members it
+# has of each element and on whether one is an off-field Dendro. Each
+# member contributes COUNT_BASE ** element (nothing for non-elements) plus
+# COUNT_BASE ** DOF_DIGIT if it is an off-field Dendro, so the sum over a
+# team is its element count vector written in base COUNT_BASE, and a table
+# indexed by that sum gives the score in one gather.
+COUNT_BASE = 5  # a team has 0-4 members of an element
+DOF_DIGIT = len(ELEMENTS)
+TABLE_SIZE = COUNT_BASE ** (DOF_DIGIT + 1)
+
+
+def member_codes(element, dendro_off_field):
+    """Per-character contribution to a team's composition code."""
+    code = np.where(element < len(ELEMENTS), COUNT_BASE ** element.clip(0, len(ELEMENTS) - 1).astype(np.int32), 0)
+    return (code + dendro_off_field * COUNT_BASE ** DOF_DIGIT).astype(np.int32)
+
+
+def count_digit(codes, digit):
+    """Members counted in one digit of composition codes."""
+    return (codes // COUNT_BASE ** digit) % COUNT_BASE
+
+
+class ElementScoreTable:
+    """element_scores of every reachable team composition, by code."""
+
+    def __init__(self, weights):
+        self.weights = weights
+        # Every multiset of four members over the elements plus "none"
+        # (index DOF_DIGIT), and every number of off-field Dendro among them
+        multisets = np.array(list(combinations_with_replacement(range(len(ELEMENTS) + 1), 4)))
+        counts = np.stack([(multisets == e).sum(axis=1) for e in range(len(ELEMENTS))], axis=1)
+        counts = np.repeat(counts, COUNT_BASE, axis=0)
+        off_field_dendro = np.tile(np.arange(COUNT_BASE), len(multisets))
+        keep = off_field_dendro <= counts[:, DENDRO]
+        counts, off_field_dendro = counts[keep], off_field_dendro[keep]
+
+        self.codes = (counts * COUNT_BASE ** np.arange(len(ELEMENTS))).sum(axis=1) + off_field_dendro * COUNT_BASE ** DOF_DIGIT
+        values = element_scores(counts, off_field_dendro > 0)
+        self.scores = np.zeros(TABLE_SIZE, dtype=np.int16)
+        self.scores[self.codes] = values
+        self.max_score = int(values.max())
+
+    def __getitem__(self, codes):
+        return self.scores[codes]
+
+
+_element_table = None
+
+
+def element_score_table():
+    """The ElementScoreTable for the current weights, rebuilt when they change."""
+    global _element_table
+    weights = (tuple(RESONANCE_WEIGHTS.items()), tuple(REACTION_WEIGHTS.items()))
+    if _element_table is None or _element_table.weights != weights:
+        _element_table = ElementScoreTable(weights)
+    return _element_table
+# --- End Element composition table ---
+
+
+def resonance_scores(roster, rules, teams, codes):
+    """Vectorised calculate_resonance_score, from composition codes."""
+    return character_rule_scores(rules, teams, codes) + element_score_table()[codes]
+
+
+def element_masks(roster, teams):
+    """Bitmask over ELEMENTS of the elements present in each team."""
+    bits = np.array([1 << e if e < len(ELEMENTS) else 0 for e in range(roster.num_elements)], dtype=np.uint8)
+    members = bits[roster.element[teams]]
+    return members[:, 0] | members[:, 1] | members[:, 2] | members[:, 3]
+
+
+def synergy_scores(rules, teams, masks):
+    n = len(rules.pair_score)
+    pair = rules.pair_score.ravel()
+    members = teams.astype(np.int32)
+    score = np.zeros(len(teams), dtype=np.int64)
+    for a in range(teams.shape[1]):
+        row = members[:, a] * n
+        for b in range(teams.shape[1]):
+            score += pair[row + members[:, b]]
+        score += PREFERRED_ELEMENT_BONUS * POPCOUNT[rules.preferred_elements[teams[:, a]] & masks]
+        score -= EXCLUDED_ELEMENT_PENALTY * POPCOUNT[rules.excluded_elements[teams[:, a]] & masks]
+    return score
+
+
+def score_teams(roster, rules, teams):
+    """Total score of every team, identical to calculate_team_score."""
+    codes = member_sum(roster.element_code, teams)
+    base = member_sum(roster.tier_value, teams)
+    nightsoul = NIGHTSOUL_SCORES[member_sum(roster.nightsoul.view(np.int8), teams)]
+    off_field = OFF_FIELD_BONUSES[member_sum(roster.off_field.view(np.int8), teams)]
+    synergy = synergy_scores(rules, teams, element_masks(roster, teams))
+    return base + resonance_scores(roster, rules, teams, codes) + nightsoul + off_field + synergy
+
+
+def rank_candidates(scores, main_pos, num_teams, max_teams_per_dps):
+    """Indices of the final teams, best first.
+
+    Keeps the ``max_teams_per_dps`` best teams of each main DPS and then the
+    ``num_teams`` best overall.  Ties are broken by enumeration order, which
+    is what the stable sorts in the per-team implementation did.
+    """
+    if not len(scores):
+        return np.empty(0, dtype=np.int64)
+    order = np.lexsort((np.arange(len(scores)), -scores, main_pos))
+    grouped = main_pos[order]
+    starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    rank_in_main = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    kept = order[rank_in_main < max_teams_per_dps]
+    # Enumeration index grows with main position, so it alone breaks ties
+    kept = kept[np.lexsort((kept, -scores[kept]))]
+    return kept[:num_teams]
+
+
+class SearchStats:
+    """Counters filled in by search_top_teams."""
+
+    def __init__(self):
+        self.candidates = 0
+        self.scored = 0
+        self.pruned = 0
+        self.mains_pruned = 0
+        # Deduplicated candidates of each format
+        self.format_a = 0
+        self.format_b = 0
+        self.format_c = 0
+
+    def count_formats(self, formats):
+        self.format_a, self.format_b, self.format_c = (
+            int(n) for n in np.bincount(formats, minlength=3)[:3])
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def member_bonus_bounds(roster, rules):
+    """Most that each character can add through synergy and character rules."""
+    pair = rules.pair_score.astype(np.int64)
+    bound = np.diag(pair).copy()
+    off_diagonal = np.maximum(pair, 0)
+    np.fill_diagonal(off_diagonal, 0)
+    # A member meets at most three teammates and four elements
+    bound += -np.sort(-off_diagonal, axis=1)[:, :3].sum(axis=1)
+    bound += PREFERRED_ELEMENT_BONUS * np.minimum(POPCOUNT[rules.preferred_elements], 4)
+    for c, _, _, _, delta in rules.character_rules:
+        if delta > 0:
+            bound[c] += delta
+    return bound
+
+
+def team_bounds(roster, teams, value):
+    """Upper bound on score_teams that only needs a few gathers per team.
+
+    ``value`` is each character's tier value plus its member_bonus_bounds.
+    """
+    bound = member_sum(value, teams)
+    bound += NIGHTSOUL_SCORES[member_sum(roster.nightsoul.view(np.int8), teams)]
+    bound += OFF_FIELD_BONUSES[member_sum(roster.off_field.view(np.int8), teams)]
+    return bound + element_score_table().max_score
+
+
+def search_top_teams(roster, rules, teams, main_pos, num_teams, max_teams_per_dps, stats=None, chunk_size=2048):
+    """Bounded top-K search returning the same indices as rank_candidates.
+
+    Mains are visited in order while a min-heap holds the best ``num_teams``
+    teams so far.  A main DPS is skipped outright when even its best possible
+    completion (its own tier and bonus bound plus the three best teammates
+    available to it) cannot beat the heap's worst team.  Otherwise its teams
+    are scored best-bound-first in chunks, and the rest are dropped as soon
+    as their bound can beat neither that heap nor the main's own top
+    ``max_teams_per_dps``.  Teams are never pruned on a tie they could win,
+    so the result matches the exhaustive ranking exactly.
+    """
+    stats = stats if stats is not None else SearchStats()
+    stats.candidates += len(teams)
+    if not len(teams) or num_teams <= 0 or max_teams_per_dps <= 0:
+        stats.pruned += len(teams)
+        return np.empty(0, dtype=np.int64)
+
+    value = roster.tier_value + member_bonus_bounds(roster, rules)
+    teammates = np.flatnonzero(roster.roles & (ROLE_SUB_DPS | ROLE_SUPPORT))
+    teammates = teammates[np.argsort(-value[teammates], kind='stable')][:4]
+    fixed_bonus = element_score_table().max_score + NIGHTSOUL_SCORES.max() + OFF_FIELD_BONUSES.max()
+
+    best = []  # min-heap of (score, -index)
+    starts = np.flatnonzero(np.r_[True, main_pos[1:] != main_pos[:-1]])
+    ends = np.r_[starts[1:], len(teams)]
+    for start, end in zip(starts, ends):
+        m = teams[start, 0]
+        if len(best) == num_teams:
+            main_bound = value[m] + value[teammates[teammates != m][:3]].sum() + fixed_bonus
+            # Everything already in the heap comes earlier, so ties lose
+            if main_bound <= best[0][0]:
+                stats.mains_pruned += 1
+                stats.pruned += end - start
+                continue
+
+        bounds = team_bounds(roster, teams[start:end], value)
+        order = np.argsort(-bounds)
+        top_scores = np.empty(0, dtype=np.int64)
+        top_index = np.empty(0, dtype=np.int64)
+        for pos in range(0, len(order), chunk_size):
+            chunk = order[pos:pos + chunk_size]
+            chunk_bounds = bounds[chunk]
+            index = start + chunk
+            main_full = len(top_scores) == max_teams_per_dps
+            if ((len(best) == num_teams and chunk_bounds[0] <= best[0][0])
+                    or (main_full and chunk_bounds[0] < top_scores[-1])):
+                stats.pruned += len(order) - pos
+                break
+
+            alive = np.ones(len(chunk), dtype=bool)
+            if len(best) == num_teams:
+                alive &= chunk_bounds > best[0][0]
+            if main_full:
+                alive &= (chunk_bounds > top_scores[-1]) | ((chunk_bounds == top_scores[-1]) & (index < top_index[-1]))
+            stats.pruned += len(chunk) - int(alive.sum())
+            stats.scored += int(alive.sum())
+            if not alive.any():
+                continue
+
+            scores = np.concatenate([top_scores, score_teams(roster, rules, teams[index[alive]])])
+            candidates = np.concatenate([top_index, index[alive]])
+            keep = np.lexsort((candidates, -scores))[:max_teams_per_dps]
+            top_scores, top_index = scores[keep], candidates[keep]
+
+        for score, i in zip(top_scores.tolist(), top_index.tolist()):
+            if len(best) < num_teams:
+                heapq.heappush(best, (score, -i))
+            else:
+                heapq.heappushpop(best, (score, -i))
+
+    return np.array([-neg_index for _, neg_index in sorted(best, reverse=True)], dtype=np.int64)
+
+
+def owned_by_earlier_main(roster, teams, main_rank, pos):
+    """Mask of main ``pos``'s teams that an earlier main DPS also generates.
+
+    A main DPS generates a team exactly when its other three members are all
+    Sub-DPS or Support and at least one of them is a Support, so whether a
+    team was already enumerated can be decided from the team alone.
+    ``main_rank`` maps each roster index to its position in the main DPS
+    list (or more than any position if it is not a main).
+    """
+    roles = roster.roles[teams]
+    teammate = (roles & (ROLE_SUB_DPS | ROLE_SUPPORT)) != 0
+    support = (roles & ROLE_SUPPORT) != 0
+    owned = np.zeros(len(teams), dtype=bool)
+    for j in range(1, 4):
+        others = [k for k in range(4) if k != j]
+        owned |= (main_rank[teams[:, j]] < pos) & teammate[:, others].all(axis=1) & support[:, others].any(axis=1)
+    return owned
+
+
+def partition_mains(num_mains, parts):
+    """Contiguous ``(first, last)`` ranges of main DPS positions."""
+    parts = max(1, min(parts, num_mains))
+    bounds = np.linspace(0, num_mains, parts + 1).round().astype(int)
+    return [(int(first), int(last)) for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+
+
+def search_partition(roster, rules, main_dps_list, sub_dps_list, support_list, first, last,
+                     num_teams, max_teams_per_dps, prune=True):
+    """Best teams of the mains at positions ``first:last``, for merging.
+
+    Runs in a worker process.  Only teams no earlier main generates are
+    considered, so the partitions together hold exactly the deduplicated
+    candidates.  Returns ``(scores, index, teams, stats)`` where ``index`` is
+    each team's position among its partition's candidates; since partitions
+    cover the mains in order, (partition, index) is the enumeration order.
+    """
+    stats = SearchStats()
+    main_rank = np.full(len(roster), len(main_dps_list), dtype=np.int32)
+    main_rank[roster.indices(main_dps_list)] = np.arange(len(main_dps_list), dtype=np.int32)
+
+    teams, main_pos, formats = enumerate_candidates(roster, main_dps_list[first:last], sub_dps_list, support_list)
+    keep = first_occurrences(teams, len(roster)) & ~owned_by_earlier_main(roster, teams, main_rank, first + main_pos)
+    teams, main_pos = teams[keep], main_pos[keep]
+    stats.count_formats(formats[keep])
+
+    if prune:
+        best = search_top_teams(roster, rules, teams, main_pos, num_teams, max_teams_per_dps, stats)
+    else:
+        stats.candidates = stats.scored = len(teams)
+        best = rank_candidates(score_teams(roster, rules, teams), main_pos, num_teams, max_teams_per_dps)
+    return score_teams(roster, rules, teams[best]), best, teams[best], stats
+
+
+def parallel_top_teams(executor, roster, rules, main_dps_list, sub_dps_list, support_list,
+                       num_teams, max_teams_per_dps, partitions, prune=True, stats=None):
+    """Same teams as ranking every candidate, searched one partition of main
+    DPS characters per task on ``executor``.
+
+    Each main belongs to one partition, so the per-main limit is applied
+    there; the overall top ``num_teams`` of the union is then the global top
+    ``num_teams``, with ties broken by (partition, index) as in the
+    sequential search.  Returns the team rows best first.
+    """
+    stats = stats if stats is not None else SearchStats()
+    futures = [
+        executor.submit(search_partition, roster, rules, main_dps_list, sub_dps_list, support_list,
+                        first, last, num_teams, max_teams_per_dps, prune)
+        for first, last in partition_mains(len(main_dps_list), partitions)
+    ]
+    results = [future.result() for future in futures]
+    for *_, part_stats in results:
+        for key, value in part_stats.as_dict().items():
+            setattr(stats, key, getattr(stats, key) + value)
+    if not results:
+        return np.empty((0, 4), dtype=np.int16)
+
+    scores = np.concatenate([part_scores for part_scores, *_ in results])
+    index = np.concatenate([part_index for _, part_index, *_ in results])
+    part = np.concatenate([np.full(len(part_index), p) for p, (_, part_index, *_) in enumerate(results)])
+    teams = np.concatenate([part_teams for _, _, part_teams, _ in results]).reshape(-1, 4)
+    order = np.lexsort((index, part, -scores))[:num_teams]
+    return teams[order]
+
+
+# --- Roster-independent ordering ---
+# Every role list is sorted by tier value (stable over the sorted names), so
+# one global order of characters fixes the relative order of any roster's
+# lists. With it, where a team first appears in enumerate_candidates -- its
+# owning main DPS, its format and its place in that format's block -- is a
+# function of the team alone, and so is its score.
+
+ORDER_BITS = 8
+KEY_BITS = 2 * ORDER_BITS + 2 + 2 * ORDER_BITS  # owner, format, three teammates
+SCORE_OFFSET = 1 << 20
+
+
+def character_order(roster):
+    """Each character's position in the tier-then-name order of role lists."""
+    if len(roster) >= 1 << ORDER_BITS:
+        raise ValueError(f"At most {(1 << ORDER_BITS) - 1} characters can be ordered")
+    name_rank = np.argsort(np.argsort(np.array(roster.names)))
+    order = np.empty(len(roster), dtype=np.int64)
+    order[np.lexsort((name_rank, -roster.tier_value))] = np.arange(len(roster))
+    return order
+
+
+def _pack(a, b, c):
+    return (a << (2 * ORDER_BITS)) | (b << ORDER_BITS) | c
+
+
+def team_order_keys(roster, order, teams):
+    """``(valid, keys)`` for rows of roster indices in any column order.
+
+    ``valid`` marks teams some member can own as main DPS.  Sorting valid
+    teams by ``keys`` gives their order in first_occurrences(enumerate_
+    candidates(...)) for any roster containing them.
+    """
+    roles = roster.roles[teams]
+    # Cheap necessary conditions first: a main, a support, three teammates
+    maybe = (((roles & ROLE_MAIN_DPS) != 0).any(axis=1) & ((roles & ROLE_SUPPORT) != 0).any(axis=1)
+             & (((roles & (ROLE_SUB_DPS | ROLE_SUPPORT)) != 0).sum(axis=1) >= 3))
+    valid = np.zeros(len(teams), dtype=bool)
+    keys = np.zeros(len(teams), dtype=np.int64)
+    valid[maybe], keys[maybe] = _order_keys(roster, order, teams[maybe])
+    return valid, keys
+
+
+def _order_keys(roster, order, teams):
+    roles = roster.roles[teams]
+    g = order[teams]
+    main = (roles & ROLE_MAIN_DPS) != 0
+    sub = (roles & ROLE_SUB_DPS) != 0
+    sup = (roles & ROLE_SUPPORT) != 0
+    none = np.int64(1) << (KEY_BITS + 1)
+
+    best_owner = np.full(len(teams), 1 << ORDER_BITS, dtype=np.int64)
+    keys = np.full(len(teams), none, dtype=np.int64)
+    for j in range(4):
+        x, y, z = [k for k in range(4) if k != j]
+        gx, gy, gz = g[:, x], g[:, y], g[:, z]
+        fmt_key = np.full(len(teams), none, dtype=np.int64)
+        # Three supports, in order
+        lo, hi = np.minimum(gx, gy), np.maximum(gx, gy)
+        mid = np.clip(gz, lo, hi)
+        trio = _pack(np.minimum(lo, gz), mid, np.maximum(hi, gz))
+        fmt_key = np.where(sup[:, x] & sup[:, y] & sup[:, z], (np.int64(FORMAT_C) << (3 * ORDER_BITS)) | trio, fmt_key)
+        for fmt in (FORMAT_B, FORMAT_A):
+            block = np.full(len(teams), none, dtype=np.int64)
+            # Each of the three in turn plays the odd role out
+            for s, p, q in ((x, y, z), (y, x, z), (z, x, y)):
+                lo, hi = np.minimum(g[:, p], g[:, q]), np.maximum(g[:, p], g[:, q])
+                if fmt == FORMAT_A:  # pair of subs (lo, hi), then the support
+                    ok = sup[:, s] & sub[:, p] & sub[:, q]
+                    key = _pack(lo, hi, g[:, s])
+                else:                # the sub, then a pair of supports
+                    ok = sub[:, s] & sup[:, p] & sup[:, q]
+                    key = _pack(g[:, s], lo, hi)
+                block = np.where(ok, np.minimum(block, key), block)
+            # Visiting C, B, A lets the earliest valid format win
+            fmt_key = np.where(block != none, (np.int64(fmt) << (3 * ORDER_BITS)) | block, fmt_key)
+        owns = main[:, j] & (fmt_key != none) & (g[:, j] < best_owner)
+        best_owner = np.where(owns, g[:, j], best_owner)
+        keys = np.where(owns, (g[:, j] << (3 * ORDER_BITS + 2)) | fmt_key, keys)
+    return keys != none, keys
+
+
+def rank_keys(scores, keys):
+    """One sortable int64 per team: higher score first, then enumeration order."""
+    return ((SCORE_OFFSET - scores) << KEY_BITS) | keys
+
+
+def owner_of(keys):
+    return keys >> (3 * ORDER_BITS + 2)
+
+
+def select_ranked(ranked, owners, num_teams, max_teams_per_dps):
+    """Indices of the rank_candidates result given rank_keys and owners.
+
+    Walks the teams best first, skipping those whose main DPS already has
+    ``max_teams_per_dps``; only as much of the order is sorted as needed.
+    """
+    size = min(len(ranked), max(4 * num_teams * max_teams_per_dps, 64))
+    while True:
+        if size < len(ranked):
+            head = np.argpartition(ranked, size)[:size]
+        else:
+            head = np.arange(len(ranked))
+        head = head[np.argsort(ranked[head])]
+        picked, taken = [], {}
+        for i in head.tolist():
+            owner = int(owners[i])
+            if taken.get(owner, 0) < max_teams_per_dps:
+                taken[owner] = taken.get(owner, 0) + 1
+                picked.append(i)
+                if len(picked) == num_teams:
+                    break
+        if len(picked) == num_teams or size >= len(ranked):
+            return np.array(picked, dtype=np.int64)
+        size *= 4
+
+
+def key_members(keys, order):
+    """Teams laid out as enumerate_candidates rows, recovered from their keys."""
+    by_order = np.argsort(order)
+    mask = (1 << ORDER_BITS) - 1
+    rows = np.stack([owner_of(keys), keys >> (2 * ORDER_BITS), keys >> ORDER_BITS, keys], axis=1) & mask
+    return by_order[rows]
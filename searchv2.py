@@ -1,91 +1,219 @@
-from google import genai
-import json
+import asyncio
+import logging
 import os
-from google.genai import types
-from dotenv import load_dotenv
-load_dotenv()
+import re
+from cache import FileVersion, SingleFlight, VersionedCache
+from character_store import CHARACTER_STORE, display_name, lookup_key
+from llm import LLMError, generate_text, stream_text
+from prompts import PROMPT_VERSION, build_team_prompt
+from store import STORE
 
-API_KEY = os.getenv('API_KEY')
-if not API_KEY:
-    raise ValueError("API_KEY environment variable not set.")
-client = genai.Client(api_key=API_KEY)
+logger = logging.getLogger(__name__)
 
-async def explain_teams(teams): 
-    character_data_path='characters.json'
+# Same header the frontend splits explanations on
+TEAM_HEADER = re.compile(r'\*\*Team (\d+):\s?(.*?)\*\*', re.S | re.I)
+
+EXPLAIN_FANOUT = int(os.getenv('EXPLAIN_FANOUT', 3))
+UNAVAILABLE = "Explanation unavailable right now, please try again later."
+
+# Per-team explanations, dropped whenever characters.json changes
+EXPLANATION_CACHE = VersionedCache(
+    FileVersion('characters.json'),
+    maxsize=int(os.getenv('EXPLANATION_CACHE_SIZE', 2048)),
+    ttl=float(os.getenv('EXPLANATION_CACHE_TTL', 24 * 3600)),
+)
+# Per-team Gemini calls in progress, by the same key
+EXPLANATION_FLIGHTS = SingleFlight()
+
+
+def team_header(team):
+    # Matches the key the frontend builds for each team card
+    return ", ".join(f"{display_name(char['Name'])} ({char['Role']})" for char in team['Characters'])
+
+
+def team_cache_key(team):
+    # Rank and member order don't change the explanation; roles do
+    members = tuple(sorted((lookup_key(char['Name']), char['Role']) for char in team['Characters']))
+    return EXPLANATION_CACHE.versioned_key((PROMPT_VERSION, members))
+
+
+def build_prompt(team):
+    # Picks up edits to characters.json; otherwise just dictionary lookups.
+    # (prompt, estimated tokens), or (None, 0) without character data.
+    CHARACTER_STORE.refresh()
+    if not CHARACTER_STORE.loaded:
+        return None, 0
+    return build_team_prompt(team, CHARACTER_STORE.talents)
+
+
+def _strip_header(text):
+    # The model sometimes echoes a **Team N: ...** title despite the prompt
+    text = text.strip()
+    match = TEAM_HEADER.match(text)
+    return text[match.end():].strip() if match else text
+
+
+class _StreamedSection:
+    """Passes a team's streamed text on to ``on_text``, holding back the start
+    until it is clear whether the model echoed a **Team N: ...** title."""
+
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self.parts = []
+        self.held = ""
+
+    def feed(self, chunk):
+        self.parts.append(chunk)
+        if self.held is None:
+            self.on_text(chunk)
+            return
+        self.held = (self.held + chunk).lstrip()
+        match = TEAM_HEADER.match(self.held)
+        if match:
+            self._release(self.held[match.end():].lstrip())
+        elif not "**team".startswith(self.held[:6].lower()) or len(self.held) > 200:
+            # Not a title, or one that never closes
+            self._release(self.held)
+
+    def _release(self, text):
+        self.held = None
+        if text:
+            self.on_text(text)
+
+    def text(self):
+        return "".join(self.parts)
+
+
+async def _call_model(prompt, on_text):
+    if on_text is None:
+        return await generate_text(prompt, temperature=0.5)
+    section = _StreamedSection(on_text)
+    async for chunk in stream_text(prompt, temperature=0.5):
+        section.feed(chunk)
+    return section.text()
+
+
+async def _generate_explanation(team, number, key, limit, on_text=None):
+    # (text, prompt tokens); text is None if no explanation could be made
+    prompt, prompt_tokens = build_prompt(team)
+    if prompt is None:
+        return None, 0
+    try:
+        if limit is None:
+            text = await _call_model(prompt, on_text)
+        else:
+            async with limit:
+                text = await _call_model(prompt, on_text)
+    except LLMError as e:
+        logger.warning("Explanation for team %d failed: %s", number, e)
+        return None, prompt_tokens
+
+    text = _strip_header(text or "")
+    if not text:
+        return None, prompt_tokens
+    EXPLANATION_CACHE.set(key, text)
+    STORE.put("explanations", key, text, EXPLANATION_CACHE.ttl)
+    return text, prompt_tokens
+
+
+async def explain_team(team, number, limit=None, on_text=None):
+    """Explanation section for one team, from cache (in memory, then the
+    on-disk store) or a single Gemini call.
+
+    Failures are reported in the section (``failed``) rather than raised, so
+    one slow or broken team does not sink the others. Requests explaining
+    the same team at the same time share one call, and its failure.
+
+    With ``on_text`` the call is streamed and each piece of text is passed to
+    it as it arrives; a request that joins another's call only gets the
+    finished section.
+    """
+    section = {"team": number, "key": team_header(team), "cached": False, "failed": False, "prompt_tokens": 0}
+    key = team_cache_key(team)
+    text = EXPLANATION_CACHE.get(key)
+    if text is None:
+        text = await STORE.get("explanations", key)
+        if text is not None:
+            EXPLANATION_CACHE.set(key, text)
+    if text is not None:
+        return {**section, "text": text, "cached": True}
+
+    # Only the request that starts the call is charged its prompt
+    joined = key in EXPLANATION_FLIGHTS
+    text, prompt_tokens = await EXPLANATION_FLIGHTS.run(
+        key, lambda: _generate_explanation(team, number, key, limit, on_text))
+    if not joined:
+        section["prompt_tokens"] = prompt_tokens
+    if text is None:
+        return {**section, "text": UNAVAILABLE, "failed": True}
+    return {**section, "text": text}
+
+
+def _fan_out(teams):
+    # Cached teams resolve immediately; at most EXPLAIN_FANOUT uncached
+    # teams of this request are in flight at once
+    limit = asyncio.Semaphore(EXPLAIN_FANOUT)
+    return [asyncio.ensure_future(explain_team(team, i + 1, limit)) for i, team in enumerate(teams)]
+
+
+async def explain_sections(teams):
+    """Per-team sections in rank order."""
+    return list(await asyncio.gather(*_fan_out(teams)))
+
+
+async def stream_sections(teams):
+    """("text", {"team", "key", "text"}) for each piece of an uncached team's
+    explanation as the model writes it, and ("section", section) for each
+    team as it finishes, in any order."""
+    queue = asyncio.Queue()
+    limit = asyncio.Semaphore(EXPLAIN_FANOUT)
+
+    async def explain(team, number):
+        key = team_header(team)
+        on_text = lambda text: queue.put_nowait(("text", {"team": number, "key": key, "text": text}))
+        try:
+            queue.put_nowait(("section", await explain_team(team, number, limit, on_text)))
+        except Exception as e:
+            queue.put_nowait(("error", e))
+
+    tasks = [asyncio.ensure_future(explain(team, i + 1)) for i, team in enumerate(teams)]
     try:
-        with open(character_data_path, 'r', encoding='utf-8') as f:
-            character_data = json.load(f)
-    except FileNotFoundError:
-        print(f"Error: Character data file '{character_data_path}' not found.")
-        return None  
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in '{character_data_path}'.")
+        remaining = len(tasks)
+        while remaining:
+            kind, item = await queue.get()
+            if kind == "error":
+                raise item
+            remaining -= kind == "section"
+            yield kind, item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def assemble_explanation(sections):
+    sections = sorted(sections, key=lambda section: section["team"])
+    return "\n\n".join(f"**Team {section['team']}: {section['key']}**\n{section['text']}" for section in sections)
+
+
+async def explain_teams(teams): 
+    CHARACTER_STORE.refresh()
+    if not CHARACTER_STORE.loaded:
         return None
+    sections = await explain_sections(teams)
+    if sections and all(section["failed"] for section in sections):
+        raise LLMError("No team explanation could be generated.")
+    explanation = assemble_explanation(sections)
+    logger.debug("Explanation:\n%s", explanation)
+    return explanation
+
+
+def _section(match, text):
+    return {"team": int(match.group(1)), "key": match.group(2).strip(), "text": text.strip()}
+
 
-    team_text = ""
-    for team in teams:
-        formatted_team_key = ", ".join(
-            f"{char['Name']} ({char['Role']})" for char in team['Characters']
-        )
-        
-        team_text += f"**Team Explanation Start**\nTEAM: {formatted_team_key}\nExplanation:\n"
-        for char in team['Characters']:
-            char_name = char['Name']
-            # Ensure the lookup key is capitalized correctly, handling hyphens (e.g., "Kaedehara-Kazuha")
-            lookup_key = '-'.join(part.capitalize() for part in char_name.strip().split('-'))
-            char_data = character_data.get(lookup_key)
-
-            if char_data:
-                # Use the original char_name for display purposes if needed, or lookup_key if consistent capitalization is preferred
-                team_text += f" - {lookup_key} (Role: {char['Role']}, Element: {char['Element']}, Tier: {char['Tier']})\n" 
-                team_text += f"    - Elemental Skill: {char_data.get('elemental_skill', 'N/A')}\n"
-                team_text += f"    - Elemental Burst: {char_data.get('elemental_burst', 'N/A')}\n"
-                team_text += f"    - Passive talent 1: {char_data.get('passive_talent_1','N/A')}\n"
-                team_text += f"    - Passive talent 2: {char_data.get('passive_talent_2', 'N/A')}\n"
-                team_text += f"    - Artifact Set: {char_data.get('best_artifact_set', 'N/A')}\n"
-            else:
-                 # Use the original char_name or lookup_key here as well
-                team_text += f" - {lookup_key} (Data not found!)\n"
-    print(team_text)
-    prompt = f'''
-        You are an expert Genshin Impact team strategist. Based solely on the given team composition and character details, generate a structured explanation that covers elemental synergies, valid playstyles, role distribution, resource management (based on characters' energy requirements), a funny overall judgement on the team and optimal artifact sets.
-
-        1. Allowed reactions (DO NOT mix up these reactions, DO NOT MENTION UNRELATED REACTIONS.):
-        - Vaporize = Hydro + Pyro
-        - Freeze = Cryo + Hydro
-        - Superconduct = Cryo + Electro
-        - Melt = Cryo + Pyro
-        - Burning = Dendro + Pyro 
-        - Bloom = Dendro + Hydro
-        - Quicken = Dendro + Electro
-        - Hyperbloom = Electro + Dendro + Hydro. If this occurs, bloom or quicken should not be mentioned.
-        - Burgeon = Pyro + Dendro + Hydro 
-        - Electro-Charged = Hydro + Electro
-        - Overload = Pyro + Electro
-        - Swirl = triggered only with Pyro/Hydro/Electro/Cryo
-        - Crystallize = triggered only with Pyro/Hydro/Electro/Cryo
-        2. IMPORTANT: Capitalize the first letter of all character names in the explanation, but KEEP the hyphens, e.g Kamisato-Ayato instead of kamisato-ayato.
-        3. The following is an example explanation generation:
-        (GENERATE ALL TEAMS LIKE THIS, and always start with Team 1)**Team 1: Mavuika (Main DPS), Citlali (Sub-DPS), Xilonen (Support), Bennett (Support)** 
-        Both Citlali and Xilonen gain and lose Nightsoul points quickly, allowing Mavuika to continuously cast her Elemental Burst with ease. Bennett provides healing and ATK buff through his Burst.
-
-        Role distribution: Citlali is a notable off-field Cryo driver who can help Mavuika continuously trigger Melt on most of her attacks. On top of that, Citlali reduces enemies’ resistance to Pyro by 20% through her Ascension passive. Let Xilonen take the field for a few seconds and shred enemies' RES, allowing your attacks to deal more manage.
-
-        Resource management: Fighting Spirit generation is crucial for Mavuika, but that is not an issue with both Citlali and Xilonen, who both have Nightsoul, in the team.
-        
-        Overall, this is an extremely good team which should serve you well in both the abyss and the overworld. With 3 five-stars in the same team, are you sure you aren't a whale?
-        
-        Recommended artifact set: Mavuika (Obsidian Codex), Citlali (Scroll of the Hero of Cinder City), Xilonen (Archaic Petra), Bennett (Noblesse Oblige)
-
-        Teams for Analysis:
-        {team_text}
-        '''
-
-
-    response = client.models.generate_content(model="gemini-2.5-flash",
-                                       contents=prompt, 
-                                       config=types.GenerateContentConfig(temperature=0.5)
-                                       ) 
-
-    print(response.text)
-    return response.text
+def split_team_sections(explanation):
+    """Per-team sections of an assembled explanation, e.g. a cached one."""
+    explanation = explanation or ""
+    headers = list(TEAM_HEADER.finditer(explanation))
+    ends = [header.start() for header in headers[1:]] + [len(explanation)]
+    return [_section(header, explanation[header.end():end]) for header, end in zip(headers, ends)]
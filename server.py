@@ -1,25 +1,52 @@
 from fastapi import FastAPI, HTTPException, Request 
 from pydantic import BaseModel
-from fastapi.responses import HTMLResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
 import genshin 
-import pandas as pd
+import hmac
 import json 
+import math
 import time
 import os 
-from itertools import combinations
-from fastapi.staticfiles import StaticFiles
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
+import numpy as np
 load_dotenv()
-
-from searchv2 import explain_teams
+# Configured before the local imports so their startup messages use it.
+# LOG_LEVEL=DEBUG also logs every roster and its recommended teams.
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+from searchv2 import (EXPLANATION_CACHE, EXPLANATION_FLIGHTS, assemble_explanation, explain_sections, explain_teams,
+                      split_team_sections, stream_sections)
+import abyss
+import assets
+import hoyolab
+import metrics
+import registry
+import scoring
+import team_index
+from cache import LRUTTLCache, SingleFlight, VersionedCache
+from character_store import lookup_key
+from llm import LLMError
+from store import STORE
 from fastapi.templating import Jinja2Templates
 
 
 app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Fingerprinted, precompressed and revalidated static assets (see assets.py)
+ASSETS = assets.Assets()
+ASSETS.load()
+app.mount("/static", assets.AssetFiles(ASSETS), name="static")
 templates = Jinja2Templates(directory="static")
+templates.env.globals["asset"] = ASSETS.url
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,15 +62,9 @@ class HoYoLABLoginRequest(BaseModel):
 
 @app.get("/")
 def root(request : Request):
-    return templates.TemplateResponse("login.html", {"request": request})
-    
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-@app.get("/")
-def read_root():
-    with open("static/login.html", "r") as file:
-        return HTMLResponse(content=file.read())
+    # Rendered once per asset version; revalidated through its ETag
+    page = ASSETS.page("login.html", lambda: templates.get_template("login.html").render())
+    return page.response(request.headers, assets.REVALIDATE)
 
 @app.post("/hoyolab_login")
 async def hoyolab_login(request: HoYoLABLoginRequest):
@@ -59,13 +80,9 @@ async def hoyolab_login(request: HoYoLABLoginRequest):
     except genshin.errors.InvalidCookies:
         raise HTTPException(status_code=401, detail="Invalid login credentials.")
     except Exception as e:
-        print(f"Error occurred: {str(e)}")
+        logger.error("Error occurred: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-def normalise(name):
-    # Normalize and convert to lowercase
-    return name.replace(" ", "-").lower()
-
 @app.post("/get_characters") # Changed to POST
 async def get_characters(request: Request):
     try:
@@ -81,95 +98,28 @@ async def get_characters(request: Request):
         if not hoyolab_cookies.get("ltuid_v2") or not hoyolab_cookies.get("ltoken_v2"):
              raise HTTPException(status_code=401, detail="Missing required HoYoLAB authentication cookies (ltuid_v2, ltoken_v2) in request body.")
 
-        client = genshin.Client(hoyolab_cookies)
-        # Fetch characters directly, removed file caching
-        characters = await client.get_calculator_characters(sync=True)
-        character_names = [char.name for char in characters]
-        return character_names
+        # Pooled client, short-TTL cache and one upstream call per account at a time
+        return await hoyolab.get_owned_characters(hoyolab_cookies)
     except genshin.errors.InvalidCookies:
         raise HTTPException(status_code=401, detail="Invalid HoYoLAB cookies provided.")
     except Exception as e:
-        print(f"Error fetching characters: {str(e)}")
+        logger.error("Error fetching characters: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to fetch characters: {str(e)}")
 
 
-def load_character_data():
-    # Load character data from CSV, handling potential duplicates and processing roles
-    try:
-        df = pd.read_csv('actual.csv')
-    except FileNotFoundError:
-        print("Error: 'actual.csv' not found. Cannot load character data.")
-        return {} # Return empty dict if file not found
-
-    # Check for duplicates before setting index
-    duplicates = df[df['Character'].duplicated()]['Character'].tolist()
-    if duplicates:
-        print(f"Warning: Duplicate characters found in actual.csv and will be dropped: {duplicates}")
-        df = df.drop_duplicates(subset='Character', keep='first')
-
-    if df['Character'].isnull().any():
-        print("Warning: Found rows with missing 'Character' names in actual.csv. These rows will be skipped.")
-        df = df.dropna(subset=['Character'])
-
-    # Normalize character names in the DataFrame index *before* creating the dictionary
-    df['Character'] = df['Character'].apply(normalise)
-    df = df.set_index('Character')
-
-    # Check for required columns
-    required_columns = ['Best Role', 'Role Tier', 'Element', 'Nightsoul', 'Off-field']
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        print(f"Error: Missing required columns in actual.csv: {missing_columns}. Cannot process character data fully.")
-
-    processed_data = {}
-    for char_name, row in df.iterrows():
-        try:
-            roles = str(row.get('Best Role', '')).split('/') if pd.notna(row.get('Best Role')) else []
-            tier = str(row.get('Role Tier', 'B'))
-            element = str(row.get('Element', 'Unknown')) 
-            nightsoul = bool(row.get('Nightsoul', False)) 
-            off_field = str(row.get('Off-field', 'False')).strip().upper() == "TRUE" 
-
-            processed_data[char_name] = {
-                'roles': [role.strip() for role in roles if role.strip()], 
-                'tier': tier.strip(),
-                'element': element.strip(),
-                'nightsoul': nightsoul,
-                'off_field': off_field
-            }
-        except Exception as e:
-            print(f"Error processing character '{char_name}': {e}. Skipping this character.")
-
-    print(f"Loaded data for {len(processed_data)} characters.")
-    return processed_data
-
-# --- Character Data Loading ---
-# Load character data once at startup
-character_data = load_character_data()
-# --- End Character Data Loading ---
+# --- Roster Data ---
+# Character data and team rules as an immutable registry.RosterData, loaded
+# at startup (from the precompiled snapshot unless the source files changed)
+# and replaced whole when actual.csv or team_rules.json change. Handlers take
+# one snapshot up front and pass it down, so a request in flight during a
+# reload finishes on the data it started with.
+REGISTRY = registry.DataRegistry()
+REGISTRY.load()
 
-# --- Team Rules Loading ---
-def load_team_rules(filepath="team_rules.json"):
-    try:
-        with open(filepath, 'r') as f:
-            rules = json.load(f)
-            # Basic validation (check if keys exist)
-            if "incompatible_supports" not in rules or "synergy_rules" not in rules:
-                print(f"Warning: '{filepath}' is missing expected keys ('incompatible_supports', 'synergy_rules'). Using empty rules.")
-                return {"incompatible_supports": {}, "synergy_rules": {}}
-            print(f"Loaded team rules from '{filepath}'.")
-            return rules
-    except FileNotFoundError:
-        print(f"Warning: Team rules file '{filepath}' not found. Using empty rules.")
-        return {"incompatible_supports": {}, "synergy_rules": {}}
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON in team rules file '{filepath}'. Using empty rules.")
-        return {"incompatible_supports": {}, "synergy_rules": {}}
-
-team_rules = load_team_rules()
-INCOMPATIBLE_SUPPORTS = team_rules.get("incompatible_supports", {})
-SYNERGY_RULES = team_rules.get("synergy_rules", {})
-# --- End Team Rules Loading ---
+@app.on_event("startup")
+def watch_roster_data():
+    REGISTRY.watch()
+# --- End Roster Data ---
 
 
 # Corrected expand_traveler_variants function definition
@@ -183,8 +133,9 @@ def expand_traveler_variants(user_characters, char_data): # Renamed param for cl
         'traveler-hydro',
         'traveler-pyro'
     ]
-    # Normalize input characters first (assuming they might not be normalized yet)
-    normalized_user_chars = [normalise(name) for name in user_characters]
+    # Normalize input characters first; lookup_key also maps the spellings
+    # used by characters.json and the selector (e.g. Sangonomiya-Kokomi)
+    normalized_user_chars = [lookup_key(name) for name in user_characters]
 
     new_characters = set() # Use a set to avoid duplicates
     for char in normalized_user_chars:
@@ -197,7 +148,9 @@ def expand_traveler_variants(user_characters, char_data): # Renamed param for cl
         # else:
         #     print(f"Warning: Character '{char}' from user list not found in character data. Skipping.")
 
-    return list(new_characters) # Return as list
+    # Sorted so the same selection always yields the same roster (and the
+    # same tie-breaking between equally ranked teams)
+    return sorted(new_characters)
 
 
 
@@ -207,287 +160,348 @@ def tier_sort(character_list, char_data): # Use char_data consistently
     valid_chars = [char for char in character_list if char in char_data]
     return sorted(valid_chars, key=lambda char: tier_order.get(char_data[char].get('tier', 'C'), 0), reverse=True)
 
-def calculate_resonance_score(team_elements, team, char_cache): # char_cache comes from generate_teams_optimized
+def calculate_resonance_score(team_elements, team, char_cache, rules): # char_cache comes from generate_teams_optimized
+        # team_elements are CharacterTable element indices; rules is the
+        # snapshot's scoring.CompiledRules
         element_counts = {}
         score = 0 
         for element in team_elements:
             element_counts[element] = element_counts.get(element, 0) + 1
-        for char in team: #character specific support
-            if char == 'Fischl': #fischl not the best in hyperbloom
-                    hydro = element_counts.get('Hydro',0)
-                    dendro = element_counts.get('Dendro',0)
-                    if hydro + dendro >= 2:
-                        score-=20 
-            if 'Support' in char_cache[char]['roles']:
-                # Chev needs Pyro/Electro teammates
-                if char == 'Chevreuse':
-                    pyro = element_counts.get('Pyro', 0)
-                    electro = element_counts.get('Electro', 0)
-                    if pyro + electro < 3:
-                        score -= 50  
-                        
-                # Sara needs Electro DPS
-                elif char == 'Kujou Sara':
-                    if element_counts.get('Electro', 0) < 2:
-                        score -= 100
-                
-                # Shenhe is a cryo support 
-                elif char == 'Shenhe':
-                    if element_counts.get('Cryo', 0) < 2:
-                        score -= 100
-                
-                elif char == 'Faruzan':
-                    if element_counts.get('Anemo', 0) < 2:
-                        score -= 100
-                
-                elif char == 'Gorou':
-                    if element_counts.get('Geo', 0) < 2:
-                        score -= 100
-
-                elif char == 'Kuki Shinobu': #prioritize kuki over other electro supports like fischl in hyperbloom teams
-                    hydro = element_counts.get('Hydro',0)
-                    dendro = element_counts.get('Dendro',0)
-                    if hydro + dendro >= 2:
-                        score+=100
-                
-        
-        pyro_count = element_counts.get("Pyro", 0)
-        hydro_count = element_counts.get("Hydro", 0)
-        cryo_count = element_counts.get("Cryo", 0)
-        electro_count = element_counts.get("Electro", 0)
-        geo_count = element_counts.get("Geo", 0)
-        anemo_count = element_counts.get("Anemo", 0)
-        dendro_count = element_counts.get("Dendro", 0)
+
+        # Character specific support (Chevreuse, Sara, Kuki...), see scoring.CHARACTER_RULES
+        team_ids = {char_cache[char].id for char in team}
+        for char_id, counted, fewest, most, delta in rules.character_rules:
+            if char_id in team_ids and fewest <= sum(element_counts.get(e, 0) for e in counted) <= most:
+                score += delta
+
+        # The rest depends only on the element counts and the off-field Dendro
+        # flag; scoring.element_score_table holds it for every composition
+        pyro_count = element_counts.get(scoring.PYRO, 0)
+        hydro_count = element_counts.get(scoring.HYDRO, 0)
+        cryo_count = element_counts.get(scoring.CRYO, 0)
+        electro_count = element_counts.get(scoring.ELECTRO, 0)
+        geo_count = element_counts.get(scoring.GEO, 0)
+        anemo_count = element_counts.get(scoring.ANEMO, 0)
+        dendro_count = element_counts.get(scoring.DENDRO, 0)
         
         #Resonances 
-        if pyro_count >= 2: score += 20
-        if hydro_count >= 2: score += 15
-        if cryo_count >= 2: score += 20
-        if electro_count >= 2: score += 15
-        if geo_count >= 2: score += 15
-        if anemo_count >= 2: score += 10
-        if dendro_count >= 2: score += 15
-
-
+        for element, weight in scoring.RESONANCE_WEIGHTS.items():
+            if element_counts.get(element, 0) >= 2: score += weight
 
         #Reactions
-        if hydro_count and pyro_count: score += 25  # Vaporize
-        if cryo_count and pyro_count: score += 30   # Melt
-        if cryo_count and hydro_count: score += 8  # Freeze
-        if electro_count and pyro_count: score += 15  # Overload
+        weights = scoring.REACTION_WEIGHTS
+        if hydro_count and pyro_count: score += weights['vaporize']
+        if cryo_count and pyro_count: score += weights['melt']
+        if cryo_count and hydro_count: score += weights['freeze']
+        if electro_count and pyro_count: score += weights['overload']
         dendro_off_field = any(
-            char_cache[char]['element'] == 'Dendro' and char_cache[char].get('off_field', True)
+            char_cache[char].element == scoring.DENDRO and char_cache[char].off_field
             for char in team
     )
-        if electro_count and hydro_count and dendro_off_field and pyro_count==0: score += 50  #hyperbloom
-        if hydro_count and dendro_count and pyro_count: score += 20 #burgeon 
-        if hydro_count and dendro_count: score +=15 #bloom 
-        if electro_count and dendro_count: score+=8 #quicken
+        if electro_count and hydro_count and dendro_off_field and pyro_count==0: score += weights['hyperbloom']
+        if hydro_count and dendro_count and pyro_count: score += weights['burgeon']
+        if hydro_count and dendro_count: score += weights['bloom']
+        if electro_count and dendro_count: score += weights['quicken']
 
-        if geo_count and (hydro_count or pyro_count or electro_count): #crystallise 
-            score +=5
+        if geo_count and (hydro_count or pyro_count or electro_count):
+            score += weights['crystallise']
         
-        if anemo_count and (hydro_count or pyro_count or electro_count): #swirl
-            score += 25
+        if anemo_count and (hydro_count or pyro_count or electro_count):
+            score += weights['swirl']
         if anemo_count and (geo_count or dendro_count):
-            score -= 50
+            score += weights['anemo_clash']
             
         return score
 
 
 
-# generate teams
-def generate_teams_optimized(user_characters, char_data, num_teams, max_teams_per_dps): 
-    expanded_characters = expand_traveler_variants(user_characters, char_data)
-    print(f"Generating teams for: {expanded_characters}")
-
-    char_cache = {}
-    char_elements = {} 
-    char_nightsoul = {} 
-    main_dps_usage = {}
-
-    tier_value_map = {"SS": 100, "S": 80, "A": 50, "B": 20, "C": 10}
-
-    for char in expanded_characters: 
-        info = char_data[char]
-        roles = set(info.get('roles', [])) 
-        tier = info.get('tier', 'B') 
-        element = info.get('element', 'Unknown') 
-        nightsoul = info.get('nightsoul', False) 
-        off_field = info.get('off_field', False) 
-        tier_value = tier_value_map.get(tier, 0)
-
-        is_main_dps = 'Main DPS' in roles
-        is_sub_dps = 'Sub-DPS' in roles
-        is_support = 'Support' in roles
-
-        char_cache[char] = {
-            'roles': roles,
-            'element': element,
-            'nightsoul': nightsoul,
-            'tier_value': tier_value,
-            'off_field': off_field,
-            'is_main_dps': is_main_dps,
-            'is_sub_dps': is_sub_dps,
-            'is_support': is_support
-        }
+def build_char_cache(characters, roster_data=None):
+    # The scoring.Character records of the given characters, by name
+    table = (roster_data or REGISTRY.get()).characters
+    return {char: table[char] for char in characters}
+
+# Per-team scoring. generate_teams_optimized scores candidates in bulk with
+# scoring.score_teams; these remain as the reference implementation.
+def calculate_off_field_bonus(team, char_cache):
+    off_field_count = sum(1 for char in team if char_cache[char].off_field)
+    bonus = 0
+    if off_field_count == 2:
+        bonus = 10  
+    elif off_field_count == 3:
+        bonus = 15
+    return bonus
+
+def calculate_nightsoul_score(team, char_cache):
+    nightsoul_count = sum(1 for char in team if char_cache[char].nightsoul)
+    # Simplified scoring logic
+    if nightsoul_count >= 4: return 30 # Should not exceed 4, but safe check
+    elif nightsoul_count == 3:
+        return 25
+    elif nightsoul_count >= 2:
+        return 20
+    return 0
+
+def calculate_team_score(team, char_cache, rules):
+    elements = [char_cache[char].element for char in team]
+    base_score = sum(char_cache[char].tier_value for char in team)
+
+    resonance_score = calculate_resonance_score(elements, team, char_cache, rules) # Pass char_cache
+    nightsoul_score = calculate_nightsoul_score(team, char_cache)
+    off_field_bonus = calculate_off_field_bonus(team, char_cache)
+
+    # Synergy from the compiled rule tables
+    synergy_score = 0
+    ids = rules.ids(team)
+    element_mask = 0
+    for element in set(elements):
+        if element < len(scoring.ELEMENTS):
+            element_mask |= 1 << element
+    for a in ids:
+        synergy_score += int(rules.pair_score[a, ids].sum())
+        synergy_score += scoring.PREFERRED_ELEMENT_BONUS * int(scoring.POPCOUNT[rules.preferred_elements[a] & element_mask])
+        synergy_score -= scoring.EXCLUDED_ELEMENT_PENALTY * int(scoring.POPCOUNT[rules.excluded_elements[a] & element_mask])
+
+    return base_score + resonance_score + nightsoul_score + off_field_bonus + synergy_score
+
+
+# --- Parallel Generation ---
+# Rosters can be searched on a process pool, one range of main DPS per task.
+# Workers are spawned rather than forked (the server has threads running)
+# and only import scoring.py. Off by default: each partition prunes against
+# its own K-th best only and pays for spawning and pickling, so on the full
+# roster the pool measured slower than the sequential bounded search. The
+# "parallel" section of benchmark_suite.py measures it on a given machine.
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', os.cpu_count() or 1))
+# Rosters with at least this many main DPS use the pool; 0 never does
+PARALLEL_MIN_MAINS = int(os.getenv('PARALLEL_MIN_MAINS', 0))
+_generation_pool = None
+_generation_pool_lock = threading.Lock()
+
+def generation_pool():
+    global _generation_pool
+    with _generation_pool_lock:
+        if _generation_pool is None:
+            _generation_pool = ProcessPoolExecutor(max_workers=GENERATION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _generation_pool
+
+@app.on_event("shutdown")
+def shutdown_generation_pool():
+    if _generation_pool is not None:
+        _generation_pool.shutdown(cancel_futures=True)
+# --- End Parallel Generation ---
+
+# --- Team Index ---
+# Ranked teams of every main DPS over all characters (team_index.py), built
+# or refreshed in the background at startup. Rosters are answered from it
+# once it is complete; until then, or with TEAM_INDEX_DIR='', they are
+# searched as before. A data reload refreshes it the same way; requests on
+# other data than the index's are searched.
+TEAM_INDEX = team_index.TeamIndex()
+
+def refresh_team_index(build=True, roster_data=None):
+    roster_data = roster_data or REGISTRY.get()
+    if roster_data is not REGISTRY.get():
+        return  # superseded by a newer reload
+    try:
+        TEAM_INDEX.refresh(roster_data.characters, roster_data.rules, build=build)
+    except Exception:
+        logger.exception("Team index refresh failed; rosters will be searched directly")
 
-        # Populate char_elements and char_nightsoul directly from info
-        char_elements[char] = element
-        char_nightsoul[char] = nightsoul
+def start_team_index(roster_data=None):
+    if TEAM_INDEX.path:
+        threading.Thread(target=refresh_team_index, kwargs={"roster_data": roster_data},
+                         name="team-index", daemon=True).start()
 
-        if is_main_dps:
-            main_dps_usage[char] = 0
+app.on_event("startup")(start_team_index)
+REGISTRY.subscribe(start_team_index)
+# --- End Team Index ---
 
-    # Filter role_chars based on the actual roles found in char_cache
+def role_lists(char_cache):
+    # Main DPS, Sub-DPS and Support candidates, each best tier first
     role_chars = {
-        'Main DPS': [char for char, cache_data in char_cache.items() if cache_data['is_main_dps']],
-        'Sub-DPS': [char for char, cache_data in char_cache.items() if cache_data['is_sub_dps']],
-        'Support': [char for char, cache_data in char_cache.items() if cache_data['is_support']]
+        'Main DPS': [char for char, record in char_cache.items() if record.is_main_dps],
+        'Sub-DPS': [char for char, record in char_cache.items() if record.is_sub_dps],
+        'Support': [char for char, record in char_cache.items() if record.is_support]
     }
 
     # Sort roles based on tier_value from char_cache
     for role in role_chars:
-        role_chars[role].sort(key=lambda x: char_cache[x]['tier_value'], reverse=True)
-
-    def calculate_off_field_bonus(team):
-        # Access off_field safely from char_cache
-        off_field_count = sum(1 for char in team if char_cache.get(char, {}).get('off_field', False))
-        bonus = 0
-        if off_field_count == 2:
-            bonus = 10  
-        elif off_field_count == 3:
-            bonus = 15
-        return bonus
-    
-    def calculate_nightsoul_score(team):
-        # Access nightsoul safely from char_cache
-        nightsoul_count = sum(1 for char in team if char_cache.get(char, {}).get('nightsoul', False))
-        # Simplified scoring logic
-        if nightsoul_count >= 4: return 30 # Should not exceed 4, but safe check
-        elif nightsoul_count == 3:
-            return 25
-        elif nightsoul_count >= 2:
-            return 20
-        return 0
-
-    def calculate_team_score(team):
-        # Safely get elements and tier values from char_cache
-        elements = [char_cache.get(char, {}).get('element', 'Unknown') for char in team]
-        # print(f"Calculating score for team: {team}, Elements: {elements}") # Debug print
-        base_score = sum(char_cache.get(char, {}).get('tier_value', 0) for char in team)
-
-        resonance_score = calculate_resonance_score(elements, team, char_cache) # Pass char_cache
-        nightsoul_score = calculate_nightsoul_score(team)
-        off_field_bonus = calculate_off_field_bonus(team)
-
-        synergy_score = 0
-        for char in team:
-            if char in SYNERGY_RULES:
-                rules = SYNERGY_RULES[char]
-                team_elements_set = set(elements) 
-
-                if 'preferred_elements' in rules:
-                    count = sum(1 for element in rules['preferred_elements'] if element in team_elements_set)
-                    synergy_score += 25 * count
-
-                if 'preferred' in rules:
-                    normalized_preferred = [normalise(p) for p in rules['preferred']]
-                    count = sum(1 for preferred_char in normalized_preferred if preferred_char in team)
-                    synergy_score += 50 * count
-
-                # Excluded elements check
-                if 'excluded_elements' in rules:
-                    count = sum(1 for element in rules['excluded_elements'] if element in team_elements_set)
-                    synergy_score -= 100 * count
-
-            for main_dps, incompatible_list in INCOMPATIBLE_SUPPORTS.items():
-                 if main_dps in team and char in [normalise(inc) for inc in incompatible_list] and char != main_dps:
-                     synergy_score -= 100
-
-        total_score = base_score + resonance_score + nightsoul_score + off_field_bonus + synergy_score
-        # print(f" Team: {team}, Base: {base_score}, Res: {resonance_score}, NS: {nightsoul_score}, Off: {off_field_bonus}, Syn: {synergy_score}, Total: {total_score}") 
-        return total_score
-
-    seen_teams = set()
-    def is_unique_team(team):
-        # Normalize traveler names for consistent checking
-        team_key = tuple(sorted(char.replace('traveler-', 'traveler') for char in team))
-        if team_key in seen_teams:
-            return False
-        seen_teams.add(team_key)
-        return True
-    
-    collected_teams = []
-    
-    # --- Team Generation Logic ---
-    collected_teams = []
-    # Use the filtered and sorted role_chars lists
-    main_dps_list = role_chars.get('Main DPS', [])
-    sub_dps_list = role_chars.get('Sub-DPS', [])
-    support_list = role_chars.get('Support', [])
+        role_chars[role].sort(key=lambda x: char_cache[x].tier_value, reverse=True)
+    return role_chars['Main DPS'], role_chars['Sub-DPS'], role_chars['Support']
+
+# Below this many candidates scoring them all at once beats the bounded search
+PRUNE_MIN_CANDIDATES = int(os.getenv('PRUNE_MIN_CANDIDATES', 10000))
+
+# --- Generation Metrics ---
+STAGE_SECONDS = metrics.histogram('generation_stage_seconds', "Time spent in each team generation stage", ['stage'])
+CANDIDATES = metrics.counter('generation_candidates_total', "Deduplicated candidate teams by format", ['format'])
+SCORED = metrics.counter('generation_scored_total', "Candidate teams scored")
+PRUNED = metrics.counter('generation_pruned_total', "Candidate teams skipped by the bounded search")
+GENERATIONS = metrics.counter('generation_runs_total', "Team generation runs by strategy", ['strategy'])
+
+def record_search(stats):
+    for fmt in ('A', 'B', 'C'):
+        CANDIDATES.inc(getattr(stats, f'format_{fmt.lower()}'), format=fmt)
+    SCORED.inc(stats.scored)
+    PRUNED.inc(stats.pruned)
+# --- End Generation Metrics ---
 
+# generate teams
+@metrics.sampled
+def generate_teams_optimized(user_characters, char_data, num_teams, max_teams_per_dps, prune=None, stats=None, parallel=None,
+                             roster_data=None, query=None):
+    # prune=True runs the bounded top-K search (same result as scoring every
+    # candidate); pass a scoring.SearchStats as stats to read its counters.
+    # prune=None searches only when there are enough candidates to pay off;
+    # parallel=None uses the process pool only if PARALLEL_MIN_MAINS is set
+    # and the roster has that many main DPS.
+    # With prune left as None the team index answers when it is ready.
+    # roster_data is the registry.RosterData to rank with (char_data should be
+    # its character_data), the current one if None. query is a
+    # scoring.TeamQuery the teams must match (see parse_team_query).
+    roster_data = roster_data or REGISTRY.get()
+    expanded_characters = expand_traveler_variants(user_characters, char_data)
+    narrows = query is not None and query.narrows
+    if query:
+        expanded_characters = [char for char in expanded_characters if query.allows(roster_data.characters[char])]
+    logger.debug("Generating teams for: %s", expanded_characters)
+    if prune is None:
+        with STAGE_SECONDS.time(stage='index'):
+            final_teams = TEAM_INDEX.best_teams(expanded_characters, num_teams, max_teams_per_dps,
+                                                table=roster_data.characters, query=query)
+        if final_teams is not None:
+            GENERATIONS.inc(strategy='index')
+            # A fallback team would ignore the query
+            return final_teams or ([] if narrows else fallback_teams(expanded_characters, char_data))
+
+    with STAGE_SECONDS.time(stage='expand'):
+        char_cache = build_char_cache(expanded_characters, roster_data)
+        main_dps_list, sub_dps_list, support_list = role_lists(char_cache)
+
+    # --- Team Generation Logic ---
     if not main_dps_list:
-        print("Warning: No Main DPS characters found in the provided list or data. Cannot generate standard teams.")
-
-    for main in main_dps_list:
-        teams_for_main = []
-        current_sub_candidates = [s for s in sub_dps_list if s != main]
-        current_support_candidates = [sup for sup in support_list if sup != main]
-
-        # --- Format A: 1 Main DPS + 2 Sub-DPS + 1 Support ---
-        if len(current_sub_candidates) >= 2 and len(current_support_candidates) >= 1:
-            for subs in combinations(current_sub_candidates, 2):
-                remaining_supports = [sup for sup in current_support_candidates if sup not in subs]
-                for support in remaining_supports:
-                    team = [main] + list(subs) + [support]
-                    if is_unique_team(team):
-                        score = calculate_team_score(team)
-                        teams_for_main.append((team, score))
-
-        # --- Format B: 1 Main DPS + 1 Sub-DPS + 2 Supports ---
-        if len(current_sub_candidates) >= 1 and len(current_support_candidates) >= 2:
-            for sub in current_sub_candidates:
-                eligible_supports = [sup for sup in current_support_candidates if sup != sub]
-                if len(eligible_supports) >= 2:
-                    for supports in combinations(eligible_supports, 2):
-                        team = [main, sub] + list(supports)
-                        if is_unique_team(team):
-                            score = calculate_team_score(team)
-                            teams_for_main.append((team, score))
-
-        # --- Format C: 1 Main DPS + 3 Supports (Hypercarry) ---
-        # Ensure enough supports exist and are different from main
-        if len(current_support_candidates) >= 3:
-            for supports in combinations(current_support_candidates, 3):
-                team = [main] + list(supports)
-                if is_unique_team(team):
-                    score = calculate_team_score(team)
-                    teams_for_main.append((team, score))
-
-        # Sort and limit teams for this specific main DPS
-        teams_for_main.sort(key=lambda x: x[1], reverse=True)
-        limited_teams = teams_for_main[:max_teams_per_dps]
-        if main in main_dps_usage: # Check if main_dps was added to usage dict
-             main_dps_usage[main] += len(limited_teams)
-        collected_teams.extend(limited_teams)
+        logger.debug("No Main DPS characters found in the provided list or data. Cannot generate standard teams.")
+
+    roster = roster_data.characters.roster(expanded_characters)
+    rules = roster_data.rules.for_roster(roster)
+    stats = stats if stats is not None else scoring.SearchStats()
+    if parallel is None:
+        parallel = GENERATION_WORKERS > 1 and 0 < PARALLEL_MIN_MAINS <= len(main_dps_list)
+
+    # The workers enumerate every candidate; a narrowing query leaves few
+    # enough that they are not worth the pool
+    if parallel and not narrows:
+        # Each worker enumerates, dedupes and searches a range of main DPS
+        GENERATIONS.inc(strategy='parallel')
+        with STAGE_SECONDS.time(stage='parallel_search'):
+            rows = scoring.parallel_top_teams(
+                generation_pool(), roster, rules, main_dps_list, sub_dps_list, support_list,
+                num_teams, max_teams_per_dps, partitions=2 * GENERATION_WORKERS, prune=prune is not False, stats=stats)
+        logger.debug("Scored %d of %d candidate teams across %d worker processes",
+                     stats.scored, stats.candidates, GENERATION_WORKERS)
+    else:
+        # Every Format A/B/C team for every main DPS, in enumeration order. A team
+        # (as a set of characters) is only kept the first time it is generated.
+        with STAGE_SECONDS.time(stage='enumerate'):
+            teams, main_pos, formats = scoring.enumerate_candidates(roster, main_dps_list, sub_dps_list, support_list,
+                                                                    query=query)
+            unique = scoring.first_occurrences(teams, len(roster))
+            teams, main_pos = teams[unique], main_pos[unique]
+        stats.count_formats(formats[unique])
+
+        if prune is None:
+            prune = len(teams) >= PRUNE_MIN_CANDIDATES
+        if prune:
+            GENERATIONS.inc(strategy='search')
+            with STAGE_SECONDS.time(stage='search'):
+                best = scoring.search_top_teams(roster, rules, teams, main_pos, num_teams, max_teams_per_dps, stats)
+            logger.debug("Scored %d of %d candidate teams (%d pruned, %d main DPS skipped)",
+                         stats.scored, stats.candidates, stats.pruned, stats.mains_pruned)
+        else:
+            GENERATIONS.inc(strategy='exhaustive')
+            with STAGE_SECONDS.time(stage='score'):
+                scores = scoring.score_teams(roster, rules, teams)
+            stats.candidates = stats.scored = len(teams)
+            with STAGE_SECONDS.time(stage='sort'):
+                best = scoring.rank_candidates(scores, main_pos, num_teams, max_teams_per_dps)
+        rows = teams[best]
+    record_search(stats)
+    final_teams = [[roster.names[i] for i in row] for row in rows]
     # --- End Team Generation Logic ---
 
-    collected_teams.sort(key=lambda x: x[1], reverse=True)
-    # Limit total number of teams
-    final_teams = [team for team, score in collected_teams][:num_teams]
-
     # Fallback if no teams generated but enough characters exist
-    if not final_teams and len(expanded_characters) >= 4:
-        print("No suitable teams generated based on roles/synergy. Creating fallback team based on tier.")
-        # Use the already filtered expanded_characters list
-        fallback_team = tier_sort(expanded_characters, char_data)[:4] # Use char_data
-        if len(fallback_team) == 4: 
-             final_teams = [fallback_team]
-        else:
-             print("Could not generate a valid fallback team.")
+    if not final_teams and not narrows:
+        final_teams = fallback_teams(expanded_characters, char_data)
+
+    return final_teams
+
+def fallback_teams(expanded_characters, char_data):
+    if len(expanded_characters) < 4:
+        return []
+    logger.debug("No suitable teams generated based on roles/synergy. Creating fallback team based on tier.")
+    # Use the already filtered expanded_characters list
+    fallback_team = tier_sort(expanded_characters, char_data)[:4] # Use char_data
+    if len(fallback_team) == 4:
+         return [fallback_team]
+    logger.debug("Could not generate a valid fallback team.")
+    return []
+
+# --- Result Cache ---
+# Ranked teams and their explanation keyed by the canonical roster. The
+# roster data version a result was computed with is part of its key, and the
+# cache empties itself when the current version changes. Results are also
+# written to the on-disk store (store.py), which outlives restarts and is
+# shared with the other workers.
+TEAM_CACHE = VersionedCache(
+    REGISTRY,
+    maxsize=int(os.getenv('TEAM_CACHE_SIZE', 512)),
+    ttl=float(os.getenv('TEAM_CACHE_TTL', 6 * 3600)),
+)
 
-    return final_teams 
+async def cached_result(key):
+    # Memory first, then the store
+    value = TEAM_CACHE.get(key)
+    if value is None:
+        value = await STORE.get("teams", key)
+        if value is not None:
+            TEAM_CACHE.set(key, value)
+    return value
+
+def cache_result(key, value):
+    TEAM_CACHE.set(key, value)
+    STORE.put("teams", key, value, TEAM_CACHE.ttl)
+
+@app.on_event("shutdown")
+def close_store():
+    STORE.close()
+
+def canonical_roster(user_characters, char_data):
+    # Normalised, traveler-expanded and sorted
+    return tuple(expand_traveler_variants(user_characters, char_data))
+
+@app.get("/cache_stats")
+async def cache_stats():
+    return {**TEAM_CACHE.stats(), "explanations": EXPLANATION_CACHE.stats(), "hoyolab": hoyolab.stats(),
+            "team_index": TEAM_INDEX.stats(), "data": REGISTRY.stats(), "static": ASSETS.stats(), "store": STORE.stats(),
+            "coalescing": {"generation": GENERATION_FLIGHTS.stats(), "explanation": EXPLANATION_FLIGHTS.stats()}}
+# --- End Result Cache ---
+
+# --- Request Coalescing ---
+# Identical rosters submitted at the same moment (a popular or default
+# selection) are ranked once: later requests await the generation already
+# in flight, and their explanations share one Gemini call per team
+# (searchv2.EXPLANATION_FLIGHTS). Errors reach every waiter and nothing is
+# kept once the work finishes; completed results go to TEAM_CACHE as before.
+GENERATION_FLIGHTS = SingleFlight()
+
+async def generate_teams_coalesced(user_characters, roster_data, num_teams, max_teams_per_dps, query=None):
+    key = (roster_data.version, canonical_roster(user_characters, roster_data.character_data), num_teams,
+           max_teams_per_dps, query.key() if query else None)
+    # Off the event loop (and on the process pool if PARALLEL_MIN_MAINS is set)
+    return await GENERATION_FLIGHTS.run(key, lambda: asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(generate_teams_optimized, user_characters, roster_data.character_data, num_teams,
+                                max_teams_per_dps, roster_data=roster_data, query=query)))
+# --- End Request Coalescing ---
 
 @app.post("/explain_teams_with_gemini")
 async def explain_teams_endpoint(teams: dict):
@@ -497,6 +511,99 @@ async def explain_teams_endpoint(teams: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def format_teams(recommended_teams, char_data):
+    teams_for_explanation = []
+    for i, team in enumerate(recommended_teams):
+        formatted_team = {
+            "Team Name": f"Team {i + 1}",
+            "Characters": [
+                 {
+                    "Name": char, # Already normalized
+                    "Role": ', '.join(char_data.get(char, {}).get('roles', ['N/A'])),
+                    "Element": char_data.get(char, {}).get('element', 'N/A'),
+                    "Tier": char_data.get(char, {}).get('tier', 'N/A')
+                }
+                for char in team # team contains normalized names
+            ]
+        }
+        teams_for_explanation.append(formatted_team)
+    return teams_for_explanation
+
+# --- Team Queries ---
+# /generate_teams_from_selection and its /stream variant take optional
+# constraints next to "characters", e.g. "best teams with Furina" or
+# mono-Pyro (every other element excluded):
+#   "include": names every team must have (all must be in "characters")
+#   "exclude": names no team may have
+#   "elements": elements every team needs a member of
+#   "exclude_elements": elements no member may have
+#   "formats": any of "A" (2 Sub-DPS + Support), "B" (Sub-DPS + 2 Supports)
+#              and "C" (3 Supports)
+# They are pushed into candidate enumeration (see "Team queries" in
+# scoring.py) and into the team index walk, so the six teams returned are
+# the best matching ones rather than whatever survives a filter of the
+# usual six. Results are cached per roster and query.
+QUERY_FIELDS = ('include', 'exclude', 'elements', 'exclude_elements', 'formats')
+QUERY_FAILURE = "No team matches the requested constraints."
+
+def parse_team_query(data, roster, char_data):
+    # A scoring.TeamQuery from a request body, or None without constraints.
+    # roster is the canonical roster; HTTPException(400) on bad input.
+    fields = {}
+    for field in QUERY_FIELDS:
+        value = data.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise HTTPException(status_code=400, detail=f"{field} must be a list of strings.")
+        fields[field] = value
+    if not fields:
+        return None
+
+    def characters(field):
+        names = []
+        for name in fields.get(field, []):
+            key = lookup_key(name)
+            if key == 'traveler' and field == 'exclude':
+                names.extend(expand_traveler_variants([key], char_data))
+            elif key == 'traveler':
+                raise HTTPException(status_code=400, detail="Name the traveler's element to include it, e.g. traveler-anemo.")
+            elif key not in char_data:
+                raise HTTPException(status_code=400, detail=f"Unknown character in {field}: {name}")
+            else:
+                names.append(key)
+        return names
+
+    def codes(field, known):
+        try:
+            return [known[name.strip().capitalize()] for name in fields.get(field, [])]
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Unknown value in {field}: {e.args[0]} (expected one of {', '.join(known)})")
+
+    element_codes = {element: i for i, element in enumerate(scoring.ELEMENTS)}
+    include = characters('include')
+    missing = [name for name in include if name not in roster]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Included characters must be selected: {', '.join(missing)}")
+    query = scoring.TeamQuery(
+        include=include,
+        exclude=characters('exclude'),
+        elements=codes('elements', element_codes),
+        exclude_elements=codes('exclude_elements', element_codes),
+        formats=codes('formats', scoring.FORMAT_NAMES) if 'formats' in fields else scoring.FORMAT_NAMES.values(),
+    )
+    problem = query.contradiction()
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
+    return query if query else None
+
+def selection_key(roster, query, roster_data):
+    # TEAM_CACHE key of a selection's six teams; unconstrained keys are
+    # unchanged so earlier entries stay valid
+    key = (roster, 6, 2) if query is None else (roster, 6, 2, query.key())
+    return TEAM_CACHE.versioned_key(key, roster_data.version)
+# --- End Team Queries ---
+
 @app.post("/generate_teams_from_selection")
 async def generate_teams_from_selection(request: Request):
     try:
@@ -505,38 +612,589 @@ async def generate_teams_from_selection(request: Request):
         if not user_characters:
             raise HTTPException(status_code=400, detail="No characters provided in request body.")
 
-        print(f"Generating teams from selection: {user_characters}")
-        recommended_teams = generate_teams_optimized(user_characters, character_data, 6, 2)
-        print(f"Recommended teams: {recommended_teams}")
+        roster_data = REGISTRY.get()
+        character_data = roster_data.character_data
+        roster = canonical_roster(user_characters, character_data)
+        query = parse_team_query(data, roster, character_data)
+        cache_key = selection_key(roster, query, roster_data)
+        cached = await cached_result(cache_key)
+        if cached is not None:
+            return {**cached, "prompt_tokens": 0, "status": "success"}
+
+        logger.debug("Generating teams from selection: %s", user_characters)
+        recommended_teams = await generate_teams_coalesced(user_characters, roster_data, 6, 2, query=query)
+        logger.debug("Recommended teams: %s", recommended_teams)
 
         if not recommended_teams:
-             return {"teams": [], "explanation": "Could not generate teams from selection. Ensure you provided at least 4 valid characters.", "status": "failure"}
-
-        teams_for_explanation = []
-        for i, team in enumerate(recommended_teams):
-            formatted_team = {
-                "Team Name": f"Team {i + 1}",
-                "Characters": [
-                     {
-                        "Name": char, # Already normalized
-                        "Role": ', '.join(character_data.get(char, {}).get('roles', ['N/A'])),
-                        "Element": character_data.get(char, {}).get('element', 'N/A'),
-                        "Tier": character_data.get(char, {}).get('tier', 'N/A')
-                    }
-                    for char in team # team contains normalized names
-                ]
-            }
-            teams_for_explanation.append(formatted_team)
-
-        explanation = await explain_teams(teams_for_explanation)
+            if query is not None and query.narrows:
+                return {"teams": [], "explanation": QUERY_FAILURE, "status": "failure"}
+            return {"teams": [], "explanation": "Could not generate teams from selection. Ensure you provided at least 4 valid characters.", "status": "failure"}
+
+        teams_for_explanation = format_teams(recommended_teams, character_data)
+
+        with STAGE_SECONDS.time(stage='explanation'):
+            sections = await explain_sections(teams_for_explanation)
+        if all(section["failed"] for section in sections):
+            raise LLMError("No team explanation could be generated.")
+        explanation = assemble_explanation(sections)
+        # Partial results are still returned, but only complete ones are kept
+        if not any(section["failed"] for section in sections):
+            cache_result(cache_key, {"teams": teams_for_explanation, "explanation": explanation})
 
         return {
             "teams": teams_for_explanation,
             "explanation": explanation,
+            # Estimated, summed over this request's uncached teams
+            "prompt_tokens": sum(section["prompt_tokens"] for section in sections),
             "status": "success"
         }
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error in /generate_teams_from_selection: {str(e)}")
+        logger.error("Error in /generate_teams_from_selection: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to generate teams from selection: {str(e)}")
 
 
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate_teams_from_selection/stream")
+async def generate_teams_from_selection_stream(request: Request):
+    # Server-sent events: "teams" as soon as they are ranked, "text" with
+    # each piece of a team's explanation as the model writes it (tagged with
+    # the team's number and key), one "explanation" per team with its final
+    # text as each finishes (in any order), then "done" with the full text
+    # (or "error"). elapsed_ms on each event is the time since the request
+    # arrived.
+    data = await request.json()
+    user_characters = data.get('characters', [])
+    if not user_characters:
+        raise HTTPException(status_code=400, detail="No characters provided in request body.")
+
+    started = time.perf_counter()
+    elapsed_ms = lambda: round((time.perf_counter() - started) * 1000, 1)
+    roster_data = REGISTRY.get()
+    character_data = roster_data.character_data
+    roster = canonical_roster(user_characters, character_data)
+    query = parse_team_query(data, roster, character_data)
+    cache_key = selection_key(roster, query, roster_data)
+    cached = await cached_result(cache_key)
+
+    async def selection_events():
+        if cached is not None:
+            yield sse_event("teams", {"teams": cached["teams"], "cached": True, "elapsed_ms": elapsed_ms()})
+            for section in split_team_sections(cached["explanation"]):
+                yield sse_event("explanation", {**section, "elapsed_ms": elapsed_ms()})
+            yield sse_event("done", {"status": "success", "explanation": cached["explanation"], "prompt_tokens": 0,
+                                     "elapsed_ms": elapsed_ms()})
+            return
+
+        logger.debug("Generating teams from selection: %s", user_characters)
+        recommended_teams = await generate_teams_coalesced(user_characters, roster_data, 6, 2, query=query)
+        if not recommended_teams:
+            failure = (QUERY_FAILURE if query is not None and query.narrows else
+                       "Could not generate teams from selection. Ensure you provided at least 4 valid characters.")
+            yield sse_event("done", {"status": "failure", "explanation": failure, "elapsed_ms": elapsed_ms()})
+            return
+
+        teams_for_explanation = format_teams(recommended_teams, character_data)
+        yield sse_event("teams", {"teams": teams_for_explanation, "cached": False, "elapsed_ms": elapsed_ms()})
+
+        sections = []
+        explain_started = time.perf_counter()
+        async for kind, item in stream_sections(teams_for_explanation):
+            if kind == "text":
+                yield sse_event("text", {**item, "elapsed_ms": elapsed_ms()})
+                continue
+            sections.append(item)
+            yield sse_event("explanation", {**item, "elapsed_ms": elapsed_ms()})
+        STAGE_SECONDS.observe(time.perf_counter() - explain_started, stage='explanation')
+
+        if all(section["failed"] for section in sections):
+            logger.error("Error in /generate_teams_from_selection/stream: no team explanation could be generated")
+            yield sse_event("error", {"detail": "Failed to generate explanation.", "elapsed_ms": elapsed_ms()})
+            return
+        explanation = assemble_explanation(sections)
+        if not any(section["failed"] for section in sections):
+            cache_result(cache_key, {"teams": teams_for_explanation, "explanation": explanation})
+        yield sse_event("done", {"status": "success", "explanation": explanation,
+                                 "prompt_tokens": sum(section["prompt_tokens"] for section in sections),
+                                 "elapsed_ms": elapsed_ms()})
+
+    async def events():
+        # Headers are already sent, so a failure ends the stream with an event
+        try:
+            async for event in selection_events():
+                yield event
+        except Exception as e:
+            logger.error("Error in /generate_teams_from_selection/stream: %s", e)
+            yield sse_event("error", {"detail": f"Failed to generate teams from selection: {str(e)}",
+                                      "elapsed_ms": elapsed_ms()})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Largest num_teams / max_teams_per_dps a request may ask for
+MAX_NUM_TEAMS = int(os.getenv('MAX_NUM_TEAMS', 50))
+
+def parse_team_limit(data, field, default):
+    # A positive integer up to MAX_NUM_TEAMS from a request body; ValueError
+    # with a message for the client otherwise
+    value = data.get(field, default)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{field} must be an integer.")
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{field} must be an integer.") from None
+    if not 1 <= value <= MAX_NUM_TEAMS:
+        raise ValueError(f"{field} must be between 1 and {MAX_NUM_TEAMS}.")
+    return value
+
+# --- Batch Generation ---
+# Rosters in, results out, as JSON lines: one result per input line, in input
+# order. Work is done BATCH_CHUNK_SIZE rosters at a time with at most
+# BATCH_WINDOW chunks in flight, so memory stays flat however long the input.
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', 64))
+BATCH_WINDOW = int(os.getenv('BATCH_WINDOW', 8))
+# POST /generate_teams_batch holds its whole body in memory, so it is
+# limited; bigger inputs go through batch.py, which streams them
+BATCH_MAX_BODY_BYTES = int(os.getenv('BATCH_MAX_BODY_BYTES', 8 * 1024 * 1024))
+# Rosters already ranked in this process, e.g. the same account twice
+BATCH_MEMO = VersionedCache(
+    REGISTRY,
+    maxsize=int(os.getenv('BATCH_MEMO_SIZE', 4096)),
+    ttl=float(os.getenv('TEAM_CACHE_TTL', 6 * 3600)),
+)
+
+def parse_batch_line(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return ValueError(f"Invalid JSON: {e}")
+
+def generate_batch_record(record, roster_data=None):
+    # Problems with one roster are reported on its line, never raised
+    if isinstance(record, Exception):
+        return {"status": "error", "detail": str(record)}
+    if not isinstance(record, dict):
+        return {"status": "error", "detail": "Each line must be a JSON object."}
+    result = {"id": record["id"]} if "id" in record else {}
+    characters = record.get("characters")
+    if not characters or not isinstance(characters, list):
+        return {**result, "status": "error", "detail": "No characters provided."}
+    try:
+        num_teams = parse_team_limit(record, "num_teams", 6)
+        max_teams_per_dps = parse_team_limit(record, "max_teams_per_dps", 2)
+    except ValueError as e:
+        return {**result, "status": "error", "detail": str(e)}
+    try:
+        roster_data = roster_data or REGISTRY.get()
+        character_data = roster_data.character_data
+        key = BATCH_MEMO.versioned_key((canonical_roster(characters, character_data), num_teams, max_teams_per_dps),
+                                       roster_data.version)
+        teams = BATCH_MEMO.get(key)
+        if teams is None:
+            recommended_teams = generate_teams_optimized(
+                characters, character_data, num_teams, max_teams_per_dps, parallel=False, roster_data=roster_data)
+            teams = format_teams(recommended_teams, character_data)
+            BATCH_MEMO.set(key, teams)
+    except Exception as e:
+        return {**result, "status": "error", "detail": str(e)}
+    if not teams:
+        return {**result, "status": "failure", "teams": [], "detail": "Could not generate teams. Ensure you provided at least 4 valid characters."}
+    return {**result, "status": "success", "teams": teams}
+
+def generate_batch_chunk(records):
+    # Module level so process pools can run it. One data version per chunk.
+    roster_data = REGISTRY.get()
+    return [generate_batch_record(record, roster_data) for record in records]
+
+async def add_explanation(result):
+    with STAGE_SECONDS.time(stage='explanation'):
+        sections = await explain_sections(result["teams"])
+    if all(section["failed"] for section in sections):
+        result["explanation"] = None
+        result["explanation_error"] = "No team explanation could be generated."
+    else:
+        result["explanation"] = assemble_explanation(sections)
+    result["prompt_tokens"] = sum(section["prompt_tokens"] for section in sections)
+
+async def stream_batch(lines, explain=False, executor=None):
+    """Results for an async iterable of JSONL lines, in input order.
+
+    Chunks are ranked on ``executor`` (the default thread pool if None);
+    with ``explain`` each successful result also gets an explanation.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def run_chunk(records):
+        results = await loop.run_in_executor(executor, generate_batch_chunk, records)
+        if explain:
+            await asyncio.gather(*(add_explanation(result) for result in results if result["status"] == "success"))
+        return results
+
+    pending = deque()
+    try:
+        chunk = []
+        async for line in lines:
+            if not line.strip():
+                continue
+            chunk.append(parse_batch_line(line))
+            if len(chunk) == BATCH_CHUNK_SIZE:
+                pending.append(asyncio.ensure_future(run_chunk(chunk)))
+                chunk = []
+                if len(pending) >= BATCH_WINDOW:
+                    for result in await pending.popleft():
+                        yield result
+        if chunk:
+            pending.append(asyncio.ensure_future(run_chunk(chunk)))
+        while pending:
+            for result in await pending.popleft():
+                yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def aiter_lines(text):
+    for line in text.splitlines():
+        yield line
+
+@app.post("/generate_teams_batch")
+async def generate_teams_batch(request: Request, explain: bool = False):
+    # Body: one {"id": ..., "characters": [...]} object per line, optionally
+    # with "num_teams" and "max_teams_per_dps". Response: one result per line.
+    # The body is read up front: the streaming response's disconnect listener
+    # would otherwise compete with us for the request's receive channel.
+    # Bodies over BATCH_MAX_BODY_BYTES get a 413; batch.py streams both ways
+    # for inputs that big.
+    too_large = HTTPException(status_code=413, detail=f"Batch bodies are limited to {BATCH_MAX_BODY_BYTES} bytes; "
+                                                      "use batch.py for bigger inputs.")
+    try:
+        if int(request.headers.get('content-length', 0)) > BATCH_MAX_BODY_BYTES:
+            raise too_large
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length.")
+    received = bytearray()
+    async for chunk in request.stream():
+        received += chunk
+        if len(received) > BATCH_MAX_BODY_BYTES:
+            raise too_large
+    body = received.decode("utf-8")
+
+    async def results():
+        async for result in stream_batch(aiter_lines(body), explain=explain):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+# --- End Batch Generation ---
+
+# --- Selection Sessions ---
+# Users toggle one character at a time. A session keeps every candidate team
+# of its current roster with its score and enumeration-order key, all of
+# which depend only on the team's members. Adding a character scores just
+# the teams containing it, removing one drops its teams, and the top teams
+# are re-selected from the stored keys.
+SESSION_LIMIT = int(os.getenv('SESSION_LIMIT', 1000))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', 30 * 60))
+# Rosters with more possible teams than this (49+ characters at the default)
+# are searched from scratch on each toggle; stored teams take 16 bytes each
+SESSION_MAX_TEAMS = int(os.getenv('SESSION_MAX_TEAMS', 200_000))
+# Teams stored across all sessions (about 64 MB at the default); a session
+# that would go over searches from scratch too
+SESSION_TOTAL_TEAMS = int(os.getenv('SESSION_TOTAL_TEAMS', 4_000_000))
+SESSIONS = LRUTTLCache(maxsize=SESSION_LIMIT, ttl=SESSION_IDLE_TTL)
+
+def stored_session_teams(exclude=None):
+    return sum(len(session.members) for session in SESSIONS.values() if session is not exclude and session.stored)
+
+class TeamSession:
+    def __init__(self, characters, num_teams=6, max_teams_per_dps=2):
+        self.lock = threading.Lock()
+        self.num_teams = num_teams
+        self.max_teams_per_dps = max_teams_per_dps
+        self.selection = set()
+        self.roster = []
+        # Stored teams belong to one data version; a reload starts them over
+        self.roster_data = REGISTRY.get()
+        # Stored candidates as rows of roster_data.all_characters indices and their
+        # scoring.rank_keys; None while the roster is too big to keep.
+        # self.roster lists the characters whose teams are stored.
+        self.members = np.empty((0, 4), dtype=np.int16)
+        self.ranked = np.empty(0, dtype=np.int64)
+        self.teams = []
+        self.update(add=characters)
+
+    @property
+    def stored(self):
+        return self.ranked is not None
+
+    def characters(self):
+        return expand_traveler_variants(self.selection, self.roster_data.character_data)
+
+    def _add_character(self, char):
+        # Every team of char plus three characters already in the roster
+        roster_data = self.roster_data
+        c = roster_data.all_characters.index[char]
+        others = roster_data.all_characters.indices(self.roster)
+        self.roster.append(char)
+        if len(others) < 3:
+            return
+        members = np.empty((math.comb(len(others), 3), 4), dtype=np.int16)
+        members[:, 0] = c
+        members[:, 1:] = others[scoring._combination_positions(len(others), 3)]
+        valid, keys = scoring.team_order_keys(roster_data.all_characters, roster_data.order, members)
+        members, keys = members[valid], keys[valid]
+        scores = scoring.score_teams(roster_data.all_characters, roster_data.all_rules, members)
+        self.members = np.concatenate([self.members, members])
+        self.ranked = np.concatenate([self.ranked, scoring.rank_keys(scores, keys)])
+
+    def update(self, add=(), remove=()):
+        self.selection.update(lookup_key(name) for name in add)
+        self.selection.difference_update(lookup_key(name) for name in remove)
+        if self.roster_data is not REGISTRY.get():
+            self.roster_data = REGISTRY.get()
+            self.roster, self.members, self.ranked = [], None, None
+        roster_data = self.roster_data
+        expanded_characters = self.characters()
+
+        possible = math.comb(len(expanded_characters), 4)
+        if possible > SESSION_MAX_TEAMS or stored_session_teams(exclude=self) + possible > SESSION_TOTAL_TEAMS:
+            self.roster, self.members, self.ranked = [], None, None
+            self.teams = generate_teams_optimized(expanded_characters, roster_data.character_data, self.num_teams,
+                                                  self.max_teams_per_dps, parallel=False, roster_data=roster_data)
+        else:
+            if not self.stored:
+                self.members = np.empty((0, 4), dtype=np.int16)
+                self.ranked = np.empty(0, dtype=np.int64)
+            removed = [char for char in self.roster if char not in set(expanded_characters)]
+            if removed:
+                keep = ~np.isin(self.members, roster_data.all_characters.indices(removed)).any(axis=1)
+                self.members, self.ranked = self.members[keep], self.ranked[keep]
+                self.roster = [char for char in self.roster if char not in removed]
+            for char in expanded_characters:
+                if char not in self.roster:
+                    self._add_character(char)
+
+            keys = self.ranked & ((1 << scoring.KEY_BITS) - 1)
+            best = scoring.select_ranked(self.ranked, scoring.owner_of(keys), self.num_teams, self.max_teams_per_dps)
+            rows = scoring.key_members(keys[best], roster_data.order)
+            self.teams = [[roster_data.all_characters.names[i] for i in row] for row in rows]
+
+        if not self.teams:
+            self.teams = fallback_teams(expanded_characters, roster_data.character_data)
+        return self.teams
+
+    def as_response(self, session_id):
+        return {
+            "session_id": session_id,
+            "characters": self.characters(),
+            "teams": format_teams(self.teams, self.roster_data.character_data),
+            "stored_teams": len(self.members) if self.stored else 0,
+            "status": "success" if self.teams else "failure",
+        }
+
+def parse_names(data, field):
+    # A list of character names from a session request body; HTTPException(400) otherwise
+    value = data.get(field, [])
+    if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+        raise HTTPException(status_code=400, detail=f"'{field}' must be a list of character names.")
+    return value
+
+def session_body(data):
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object.")
+    return data
+
+def get_session(session_id):
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session.")
+    # Re-storing restarts the idle timer
+    SESSIONS.set(session_id, session)
+    return session
+
+@app.post("/sessions")
+async def create_session(request: Request):
+    data = session_body(await request.json())
+    characters = parse_names(data, 'characters')
+    try:
+        num_teams = parse_team_limit(data, 'num_teams', 6)
+        max_teams_per_dps = parse_team_limit(data, 'max_teams_per_dps', 2)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    session = await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(TeamSession, characters, num_teams, max_teams_per_dps))
+    session_id = uuid.uuid4().hex
+    SESSIONS.set(session_id, session)
+    return session.as_response(session_id)
+
+@app.post("/sessions/{session_id}")
+async def update_session(session_id: str, request: Request):
+    # Body: {"add": [...], "remove": [...]}
+    data = session_body(await request.json())
+    add, remove = parse_names(data, 'add'), parse_names(data, 'remove')
+    session = get_session(session_id)
+
+    def apply():
+        with session.lock:
+            session.update(add=add, remove=remove)
+            return session.as_response(session_id)
+
+    return await asyncio.get_running_loop().run_in_executor(None, apply)
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if SESSIONS.pop(session_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session.")
+    return {"status": "success"}
+# --- End Selection Sessions ---
+
+# --- Spiral Abyss ---
+# The Abyss has two halves, each needing its own team: POST /abyss_teams
+# returns the best pairs of teams sharing no character, by combined score
+# (see abyss.py). Candidates come from the team index when it is ready.
+ABYSS_MAX_PAIRS = int(os.getenv('ABYSS_MAX_PAIRS', 20))
+
+def generate_abyss_pairs(user_characters, char_data, num_pairs, roster_data=None):
+    # [(total, team_a, team_b, score_a, score_b), ...] with teams as names
+    roster_data = roster_data or REGISTRY.get()
+    expanded_characters = expand_traveler_variants(user_characters, char_data)
+    roster = roster_data.characters.roster(expanded_characters)
+    identity = abyss.identities(roster.names)
+    shards = TEAM_INDEX.roster_shards(expanded_characters, table=roster_data.characters)
+    if shards is not None:
+        GENERATIONS.inc(strategy='abyss_index')
+        candidates = abyss.IndexedCandidates(shards, len(roster_data.characters), roster, identity)
+    else:
+        GENERATIONS.inc(strategy='abyss_search')
+        with STAGE_SECONDS.time(stage='enumerate'):
+            char_cache = build_char_cache(expanded_characters, roster_data)
+            teams, _, _ = scoring.enumerate_candidates(roster, *role_lists(char_cache))
+        candidates = abyss.EnumeratedCandidates(roster, roster_data.rules.for_roster(roster), teams, identity)
+    with STAGE_SECONDS.time(stage='abyss_pairs'):
+        pairs = abyss.best_pairs(candidates, num_pairs)
+    return [(total, [roster.names[i] for i in a], [roster.names[i] for i in b], score_a, score_b)
+            for total, a, b, score_a, score_b in pairs]
+
+@app.post("/abyss_teams")
+async def abyss_teams(request: Request):
+    # Body: {"characters": [...], "num_pairs": 3}
+    data = await request.json()
+    user_characters = data.get('characters', [])
+    if not user_characters:
+        raise HTTPException(status_code=400, detail="No characters provided in request body.")
+    try:
+        num_pairs = int(data.get('num_pairs', 3))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="num_pairs must be an integer.")
+    if not 1 <= num_pairs <= ABYSS_MAX_PAIRS:
+        raise HTTPException(status_code=400, detail=f"num_pairs must be between 1 and {ABYSS_MAX_PAIRS}.")
+
+    try:
+        roster_data = REGISTRY.get()
+        character_data = roster_data.character_data
+        roster_key = canonical_roster(user_characters, character_data)
+        cache_key = TEAM_CACHE.versioned_key(("abyss", roster_key, num_pairs), roster_data.version)
+        pairs = await cached_result(cache_key)
+        if pairs is None:
+            pairs = await GENERATION_FLIGHTS.run(
+                ("abyss", roster_data.version, roster_key, num_pairs),
+                lambda: asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                    generate_abyss_pairs, user_characters, character_data, num_pairs, roster_data=roster_data)))
+            pairs = [
+                {
+                    "Pair Name": f"Pair {i + 1}",
+                    "Score": total,
+                    "Teams": [
+                        {**team, "Team Name": half, "Score": score}
+                        for team, half, score in zip(format_teams([a, b], character_data),
+                                                     ("First Half", "Second Half"), (score_a, score_b))
+                    ],
+                }
+                for i, (total, a, b, score_a, score_b) in enumerate(pairs)
+            ]
+            cache_result(cache_key, pairs)
+    except Exception as e:
+        logger.error("Error in /abyss_teams: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to generate Abyss teams: {str(e)}")
+
+    if not pairs:
+        return {"pairs": [], "status": "failure",
+                "detail": "Could not form two teams without shared characters. Ensure you provided at least 8 valid characters."}
+    return {"pairs": pairs, "status": "success"}
+# --- End Spiral Abyss ---
+
+# --- Admin ---
+# POST /admin/reload re-reads the roster data now rather than at the next
+# check of the file watcher (DATA_WATCH_INTERVAL); ?force=true rebuilds it
+# even if the files look unchanged. Disabled unless ADMIN_TOKEN is set,
+# which requests must send as X-Admin-Token.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+def check_admin(request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them.")
+    if not hmac.compare_digest(request.headers.get('x-admin-token', '').encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token.")
+
+@app.post("/admin/reload")
+async def admin_reload(request: Request, force: bool = False):
+    check_admin(request)
+    previous = REGISTRY.current()
+    try:
+        # Parsing and validation happen here, off the event loop
+        changed, roster_data = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(REGISTRY.reload, force=force))
+    except registry.DataError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"status": "reloaded" if changed else "unchanged", "version": roster_data.version,
+            "previous_version": previous, "characters": len(roster_data.character_data)}
+# --- End Admin ---
+
+# --- Metrics ---
+# Prometheus text format. Request durations are labelled with the route
+# template so session ids do not create a series each; for streaming
+# responses they cover the time until the headers are sent.
+REQUEST_SECONDS = metrics.histogram('http_request_seconds', "HTTP request latency by route", ['method', 'route', 'status'])
+metrics.REGISTRY.add_collector(metrics.cache_collector({
+    "teams": TEAM_CACHE,
+    "explanations": EXPLANATION_CACHE,
+    "batch": BATCH_MEMO,
+    "sessions": SESSIONS,
+    "hoyolab_clients": hoyolab.CLIENT_POOL,
+    "owned_characters": hoyolab.OWNED_CHARACTERS,
+}))
+metrics.REGISTRY.add_collector(metrics.flight_collector({
+    "generation": GENERATION_FLIGHTS,
+    "explanation": EXPLANATION_FLIGHTS,
+    "owned_characters": hoyolab.OWNED_FLIGHTS,
+}))
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method,
+                                route=route.path if route is not None else "unmatched", status=status)
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, limit: int = 40, sort: str = 'cumulative'):
+    # Accumulated cProfile output of sampled generations (PROFILE_SAMPLE_RATE);
+    # an admin endpoint, since it exposes the server's internals
+    check_admin(request)
+    try:
+        return PlainTextResponse(metrics.profile_report(limit, sort))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+# --- End Metrics ---
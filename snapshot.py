@@ -0,0 +1,172 @@
+"""Precompiled snapshot of the roster data loaded at startup.
+
+``python snapshot.py`` parses actual.csv (through pandas) and team_rules.json
+once and pickles the result. Server startup then only has to hash the source
+files and unpickle a few kilobytes, without importing pandas at all. The
+snapshot records the content hash of each source file and a hash of this
+module's own code; if either differs, the data is rebuilt from the sources
+and the snapshot rewritten.
+
+Set ROSTER_SNAPSHOT to change the file, or to an empty string to always
+load from the sources.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from character_store import normalise
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.getenv('ROSTER_SNAPSHOT', 'roster.snapshot')
+SOURCES = ('actual.csv', 'team_rules.json')
+
+with open(__file__, 'rb') as _f:
+    # Changing how the sources are parsed changes the snapshot format
+    SCHEMA_HASH = hashlib.sha256(_f.read()).hexdigest()[:16]
+
+
+def load_character_data():
+    # Load character data from CSV, handling potential duplicates and processing roles.
+    # Only used when the snapshot is missing or stale, so pandas is imported here.
+    import pandas as pd
+    try:
+        df = pd.read_csv('actual.csv')
+    except FileNotFoundError:
+        logger.error("'actual.csv' not found. Cannot load character data.")
+        return {} # Return empty dict if file not found
+
+    # Check for duplicates before setting index
+    duplicates = df[df['Character'].duplicated()]['Character'].tolist()
+    if duplicates:
+        logger.warning("Duplicate characters found in actual.csv and will be dropped: %s", duplicates)
+        df = df.drop_duplicates(subset='Character', keep='first')
+
+    if df['Character'].isnull().any():
+        logger.warning("Found rows with missing 'Character' names in actual.csv. These rows will be skipped.")
+        df = df.dropna(subset=['Character'])
+
+    # Normalize character names in the DataFrame index *before* creating the dictionary
+    df['Character'] = df['Character'].apply(normalise)
+    df = df.set_index('Character')
+
+    # Check for required columns
+    required_columns = ['Best Role', 'Role Tier', 'Element', 'Nightsoul', 'Off-field']
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if missing_columns:
+        logger.error("Missing required columns in actual.csv: %s. Cannot process character data fully.", missing_columns)
+
+    processed_data = {}
+    for char_name, row in df.iterrows():
+        try:
+            roles = str(row.get('Best Role', '')).split('/') if pd.notna(row.get('Best Role')) else []
+            tier = str(row.get('Role Tier', 'B'))
+            element = str(row.get('Element', 'Unknown')) 
+            nightsoul = bool(row.get('Nightsoul', False)) 
+            off_field = str(row.get('Off-field', 'False')).strip().upper() == "TRUE" 
+
+            processed_data[char_name] = {
+                'roles': [role.strip() for role in roles if role.strip()], 
+                'tier': tier.strip(),
+                'element': element.strip(),
+                'nightsoul': nightsoul,
+                'off_field': off_field
+            }
+        except Exception as e:
+            logger.error("Error processing character '%s': %s. Skipping this character.", char_name, e)
+
+    logger.info("Loaded data for %d characters.", len(processed_data))
+    return processed_data
+
+
+def load_team_rules(filepath="team_rules.json", strict=False):
+    # strict raises ValueError instead of falling back to empty rules
+    try:
+        with open(filepath, 'r') as f:
+            rules = json.load(f)
+            # Basic validation (check if keys exist)
+            if "incompatible_supports" not in rules or "synergy_rules" not in rules:
+                if strict:
+                    raise ValueError(f"'{filepath}' is missing 'incompatible_supports' or 'synergy_rules'")
+                logger.warning("'%s' is missing expected keys ('incompatible_supports', 'synergy_rules'). Using empty rules.", filepath)
+                return {"incompatible_supports": {}, "synergy_rules": {}}
+            logger.info("Loaded team rules from '%s'.", filepath)
+            return rules
+    except FileNotFoundError:
+        if strict:
+            raise ValueError(f"Team rules file '{filepath}' not found")
+        logger.warning("Team rules file '%s' not found. Using empty rules.", filepath)
+        return {"incompatible_supports": {}, "synergy_rules": {}}
+    except json.JSONDecodeError as e:
+        if strict:
+            raise ValueError(f"Invalid JSON in team rules file '{filepath}': {e}")
+        logger.error("Invalid JSON in team rules file '%s'. Using empty rules.", filepath)
+        return {"incompatible_supports": {}, "synergy_rules": {}}
+
+
+def source_hashes(paths=SOURCES):
+    hashes = {}
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                hashes[path] = hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            hashes[path] = None
+    return hashes
+
+
+def build_roster_data(strict=False):
+    return {"character_data": load_character_data(), "team_rules": load_team_rules(strict=strict)}
+
+
+def write_snapshot(data, hashes, path=SNAPSHOT_PATH):
+    snapshot = {"schema": SCHEMA_HASH, "sources": hashes, "data": data}
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write roster snapshot '%s': %s", path, e)
+        return False
+    return True
+
+
+def read_snapshot(hashes, path=SNAPSHOT_PATH):
+    """The snapshot's data if it matches the current sources and schema."""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Unreadable roster snapshot '%s' will be rebuilt: %s", path, e)
+        return None
+    if snapshot.get("schema") != SCHEMA_HASH or snapshot.get("sources") != hashes:
+        logger.info("Roster snapshot '%s' is stale; rebuilding from source files.", path)
+        return None
+    return snapshot["data"]
+
+
+def load_roster_data(path=SNAPSHOT_PATH, strict=False):
+    """{"character_data", "team_rules"}, from the snapshot when it is fresh."""
+    if not path:
+        return build_roster_data(strict)
+    hashes = source_hashes()
+    data = read_snapshot(hashes, path)
+    if data is not None:
+        logger.info("Loaded data for %d characters from snapshot '%s'.", len(data['character_data']), path)
+        return data
+    data = build_roster_data(strict)
+    # Missing sources are not worth a snapshot; the next start tries again
+    if all(hashes.values()):
+        write_snapshot(data, hashes, path)
+    return data
+
+
+if __name__ == "__main__":
+    hashes = source_hashes()
+    if write_snapshot(build_roster_data(), hashes):
+        print(f"Wrote roster snapshot '{SNAPSHOT_PATH}' (schema {SCHEMA_HASH}).")
@@ -143,15 +143,29 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
 const LOCAL_ASSETS_PATH = '/static/assets/images/characters';
+// Slim selector index named by the page: {icon: URL pattern, characters: [[name, icon hash], ...]}
+const CHARACTER_INDEX_URL = document.currentScript?.dataset.characterIndex || `${LOCAL_ASSETS_PATH}/characters.json`;
+const characterIconUrls = new Map();
+
+function characterIconUrl(name) {
+    const key = name.toLowerCase().replace(/ /g, "_");
+    return characterIconUrls.get(key) || `${LOCAL_ASSETS_PATH}/${key}/icon-big.png`;
+}
 
 async function fetchCharacters() {
     try {
-        const response = await fetch(`${LOCAL_ASSETS_PATH}/characters.json`);
+        const response = await fetch(CHARACTER_INDEX_URL);
         if (!response.ok) {
             throw new Error('Failed to load local character data');
         }
-        const characters = await response.json();
-        return characters;
+        const index = await response.json();
+        // The plain name list is still understood
+        if (Array.isArray(index)) return index;
+        return index.characters.map(([name, hash]) => {
+            const key = name.toLowerCase().replace(/ /g, "_");
+            if (hash) characterIconUrls.set(key, index.icon.replace('{key}', key).replace('{hash}', hash));
+            return name;
+        });
     } catch (error) {
         console.error('Error fetching characters:', error);
         alert('Failed to load characters from local assets.');
@@ -181,7 +195,7 @@ async function loadCharacterIcons() {
         card.classList.add('character-card');
 
         const img = document.createElement('img');
-        img.src = `${LOCAL_ASSETS_PATH}/${character.toLowerCase().replace(/ /g, "_")}/icon-big.png`; 
+        img.src = characterIconUrl(character);
         img.alt = character;
         img.classList.add('character-icon');
 
@@ -239,7 +253,8 @@ async function generateTeamsFromSelection() {
         );
         console.log('Sending characters to backend:', formattedCharacters);
 
-        const response = await fetch(`${BASE_URL}/generate_teams_from_selection`, {
+        // Streamed: teams arrive first, then each team's explanation as the model writes it
+        const response = await fetch(`${BASE_URL}/generate_teams_from_selection/stream`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ characters: formattedCharacters })
@@ -249,37 +264,53 @@ async function generateTeamsFromSelection() {
             throw new Error(`Server responded with status: ${response.status}`);
         }
 
-        const data = await response.json();
-
-        if (!data.teams || !Array.isArray(data.teams)) {
-            throw new Error('Invalid teams data format: ' + JSON.stringify(data));
-        }
-        const teamsHTML = data.teams.map(team => `
-            <li>
-                <h3>${team['Team Name']}</h3>
-                <div class="characters">
-                    ${team.Characters.map(char => `
-                        <div class="character">
-                            <strong>${char.Name}</strong>
-                            <br>Role: ${char.Role}
-                            <br>Element: ${char.Element}
-                            <br>Tier: ${char.Tier}
+        // Text streamed so far for each team, until its final explanation arrives
+        const streamed = {};
+        await readEventStream(response, (event, data) => {
+            if (event === 'teams') {
+                if (!data.teams || !Array.isArray(data.teams)) {
+                    throw new Error('Invalid teams data format: ' + JSON.stringify(data));
+                }
+                console.log(`Teams received after ${data.elapsed_ms} ms`);
+                const teamsHTML = data.teams.map(team => `
+                    <li>
+                        <h3>${team['Team Name']}</h3>
+                        <div class="characters">
+                            ${team.Characters.map(char => `
+                                <div class="character">
+                                    <strong>${char.Name}</strong>
+                                    <br>Role: ${char.Role}
+                                    <br>Element: ${char.Element}
+                                    <br>Tier: ${char.Tier}
+                                </div>
+                            `).join('')}
                         </div>
-                    `).join('')}
-                </div>
-            </li>
-        `).join('');
-
-        localStorage.setItem('teamsContent', teamsHTML);
-        localStorage.setItem('explanationContent', data.explanation || '');
-        toggleVisibility('characterSelectionContainer', false);
-
-        displayTeams(data.teams, data.explanation);
-        const teamsTab = document.getElementById('pills-teams-tab');
-        const bsTab = new bootstrap.Tab(teamsTab);
-        bsTab.show();
-        
-
+                    </li>
+                `).join('');
+
+                localStorage.setItem('teamsContent', teamsHTML);
+                toggleVisibility('characterSelectionContainer', false);
+                toggleVisibility('loading', false);
+
+                displayTeams(data.teams, '', true);
+                const teamsTab = document.getElementById('pills-teams-tab');
+                const bsTab = new bootstrap.Tab(teamsTab);
+                bsTab.show();
+            } else if (event === 'text') {
+                streamed[data.team] = (streamed[data.team] || '') + data.text;
+                showTeamExplanation(data.key, streamed[data.team]);
+            } else if (event === 'explanation') {
+                showTeamExplanation(data.key, data.text);
+            } else if (event === 'done') {
+                if (data.status !== 'success') {
+                    alert(data.explanation);
+                }
+                localStorage.setItem('explanationContent', data.explanation || '');
+                console.log(`Explanation finished after ${data.elapsed_ms} ms`);
+            } else if (event === 'error') {
+                throw new Error(data.detail);
+            }
+        });
 
     } catch (error) {
         console.error('Error generating teams:', error);
@@ -289,6 +320,38 @@ async function generateTeamsFromSelection() {
     }
 }
 
+// Calls onEvent(event, data) for each server-sent event in a fetch response
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of rawEvent.split('\n')) {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            }
+            onEvent(event, data ? JSON.parse(data) : null);
+        }
+    }
+}
+
+function showTeamExplanation(key, text) {
+    const teamKey = canonicalizeTeamKey(key);
+    const card = [...document.querySelectorAll('#teamsList .team-card')]
+        .find(el => el.dataset.teamKey === teamKey);
+    if (!card) return;
+    card.querySelector('.team-explanation').innerHTML = `<p>${text.replace(/\n/g, "<br>")}</p>`;
+}
+
 function canonicalizeTeamKey(key) {
     return key         
       .replace(/\//g, ', ')       
@@ -296,7 +359,7 @@ function canonicalizeTeamKey(key) {
       .trim();
   }
 
-function displayTeams(teams, explanation) {
+function displayTeams(teams, explanation, pending = false) {
     const teamsList = document.getElementById("teamsList");
     const teamsContainer = document.getElementById('teams-container');
 
@@ -332,7 +395,7 @@ function displayTeams(teams, explanation) {
 
         const characterDisplay = team.Characters.map(char => `
             <div class="character-entry">
-                <img src="${LOCAL_ASSETS_PATH}/${char.Name.toLowerCase().replace(/ /g, "_")}/icon-big.png" 
+                <img src="${characterIconUrl(char.Name)}" 
                      alt="${char.Name}" 
                      class="character-icon">
                 <span class="character-name">${char.Name} (${char.Role})</span>
@@ -348,9 +411,9 @@ function displayTeams(teams, explanation) {
 
         const formattedExplanation = explanationSections[teamKey]
             ? `<p>${explanationSections[teamKey].replace(/\n/g, "<br>")}</p>`
-            : "<p>No explanation available.</p>";
+            : pending ? "<p>Generating explanation...</p>" : "<p>No explanation available.</p>";
         return `
-            <li class="team-card">
+            <li class="team-card" data-team-key="${teamKey}">
                 ${teamName}
                 <div class="character-icons">${characterDisplay}</div>
                 <div class="team-explanation">${formattedExplanation}</div>
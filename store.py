@@ -0,0 +1,252 @@
+"""Generated teams and explanations kept on disk across restarts.
+
+An SQLite database in WAL mode (STORE_PATH, '' disables it) sits behind the
+in-memory TEAM_CACHE and EXPLANATION_CACHE: a miss there looks here before
+ranking or paying for a Gemini call again, and every worker on the host
+shares the file. Keys are the caches' versioned keys -- the canonical
+roster or team plus the data and prompt versions -- so entries made with
+other data or prompts are never returned; they just expire.
+
+Reads run on a small pool of threads, each with its own connection. Writes
+never wait on the disk: they are queued and one writer thread commits them
+in batches, then deletes expired rows every STORE_COMPACT_INTERVAL seconds.
+Database errors are logged and count as misses, since everything here can
+be recomputed.
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH = os.getenv('STORE_PATH', 'results.sqlite3')
+STORE_READERS = int(os.getenv('STORE_READERS', 4))
+# Queued writes wait at most this long to be committed together
+STORE_WRITE_DELAY = float(os.getenv('STORE_WRITE_DELAY', 0.05))
+STORE_WRITE_BATCH = int(os.getenv('STORE_WRITE_BATCH', 256))
+STORE_COMPACT_INTERVAL = float(os.getenv('STORE_COMPACT_INTERVAL', 600))
+# Seconds a connection waits for another process's write lock
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS entries (
+           namespace TEXT NOT NULL,
+           key TEXT NOT NULL,
+           value TEXT NOT NULL,
+           created REAL NOT NULL,
+           expires REAL NOT NULL,
+           PRIMARY KEY (namespace, key)
+       ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)',
+)
+
+_STOP = object()
+
+
+def encode_key(key):
+    # Versioned cache keys are nested tuples of strings and numbers
+    return json.dumps(key, separators=(',', ':'))
+
+
+class PersistentStore:
+    def __init__(self, path=STORE_PATH, readers=STORE_READERS, write_delay=STORE_WRITE_DELAY,
+                 write_batch=STORE_WRITE_BATCH, compact_interval=STORE_COMPACT_INTERVAL):
+        self.path = path
+        self.readers = readers
+        self.write_delay = write_delay
+        self.write_batch = write_batch
+        self.compact_interval = compact_interval
+        self.enabled = bool(path)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._writer = None
+        self._queue = queue.Queue()
+        # Queued or being written, so reads see them before the commit
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.batches = 0
+        self.compacted = 0
+        self.errors = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks the last commits on power loss
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _start(self):
+        """Create the schema and the reader pool on first use; False if the
+        store is (or has just been) disabled."""
+        if self._pool is not None or not self.enabled:
+            return self.enabled
+        with self._lock:
+            if self._pool is None and self.enabled:
+                try:
+                    conn = self._connect()
+                    for statement in SCHEMA:
+                        conn.execute(statement)
+                    conn.close()
+                except sqlite3.Error as e:
+                    logger.warning("Result store '%s' unavailable, continuing without it: %s", self.path, e)
+                    self.enabled = False
+                    return False
+                self._pool = ThreadPoolExecutor(self.readers, thread_name_prefix='store-read')
+                self._writer = threading.Thread(target=self._write_loop, name='store-write', daemon=True)
+                self._writer.start()
+        return self.enabled
+
+    def _read(self, namespace, key):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        row = conn.execute('SELECT value FROM entries WHERE namespace = ? AND key = ? AND expires > ?',
+                           (namespace, key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    async def get(self, namespace, key):
+        """The value stored under ``key``, or None."""
+        if not self._start():
+            return None
+        encoded = encode_key(key)
+        pending = self._pending.get((namespace, encoded))
+        if pending is not None and pending[1] > time.time():
+            self.hits += 1
+            return pending[0]
+        try:
+            value = await asyncio.get_running_loop().run_in_executor(self._pool, self._read, namespace, encoded)
+        except (sqlite3.Error, ValueError) as e:
+            self.errors += 1
+            logger.warning("Result store read failed: %s", e)
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, namespace, key, value, ttl):
+        """Queue ``value`` (JSON-serialisable) to be kept for ``ttl`` seconds."""
+        if not self._start():
+            return
+        encoded = encode_key(key)
+        entry = (value, time.time() + ttl)
+        self._pending[(namespace, encoded)] = entry
+        self._queue.put((namespace, encoded, entry))
+
+    def _flush(self, conn, batch):
+        now = time.time()
+        try:
+            rows = [(namespace, key, json.dumps(value), now, expires) for namespace, key, (value, expires) in batch]
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self.writes += len(rows)
+            self.batches += 1
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self.errors += 1
+            logger.warning("Result store dropped %d writes: %s", len(batch), e)
+        for namespace, key, entry in batch:
+            # Unless a newer value was queued meanwhile
+            if self._pending.get((namespace, key)) is entry:
+                del self._pending[(namespace, key)]
+
+    def _compact(self, conn):
+        try:
+            removed = conn.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),)).rowcount
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Result store compaction failed: %s", e)
+            return 0
+        self.compacted += removed
+        if removed:
+            logger.info("Result store: removed %d expired entries", removed)
+        return removed
+
+    def _write_loop(self):
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            logger.warning("Result store writer could not connect, writes are dropped: %s", e)
+            self.enabled = False
+            return
+        next_compaction = time.monotonic() + self.compact_interval
+        stop = False
+        while not stop:
+            timeout = max(next_compaction - time.monotonic(), 0) if self.compact_interval > 0 else None
+            batch = []
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            # Gather whatever else arrives shortly after, up to a batch
+            deadline = time.monotonic() + self.write_delay
+            while item is not None:
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.write_batch:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    item = None
+            if batch:
+                self._flush(conn, batch)
+            if self.compact_interval > 0 and time.monotonic() >= next_compaction:
+                self._compact(conn)
+                next_compaction = time.monotonic() + self.compact_interval
+        conn.close()
+
+    def close(self):
+        """Commit the queued writes and stop the writer thread."""
+        writer = self._writer
+        if writer is None or not writer.is_alive():
+            return
+        self._queue.put(_STOP)
+        writer.join(timeout=BUSY_TIMEOUT * 2)
+        self._writer = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        try:
+            size = os.path.getsize(self.path) if self.enabled else 0
+        except OSError:
+            size = 0
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "batches": self.batches,
+            "pending": len(self._pending),
+            "compacted": self.compacted,
+            "errors": self.errors,
+            "file_bytes": size,
+        }
+
+
+STORE = PersistentStore()
+# Scripts such as batch.py exit without a server shutdown
+atexit.register(STORE.close)
@@ -0,0 +1,472 @@
+"""Materialized ranked teams of every main DPS, shared by all rosters.
+
+A team's score and its place in the tie-breaking order depend only on its
+members (see "Roster-independent ordering" in scoring.py), so every team a
+main DPS can own is ranked once, over all characters, and stored as one
+shard per main. A roster is then answered by walking each of its mains'
+shards best first, keeping the first ``max_teams_per_dps`` teams whose
+members it has, and merging those -- the same teams as enumerating and
+scoring the roster's candidates. A constrained query (scoring.TeamQuery)
+walks only the teams holding its must-include characters, found through
+per-shard posting lists, and checks each team's element and format columns
+before its members.
+
+Each shard records a fingerprint of everything its teams depend on: the
+main's data and rules, and the data and rules of every possible teammate
+(Sub-DPS and Support characters). ``refresh`` rebuilds only the shards
+whose fingerprint changed, so e.g. retiering a main-only DPS rebuilds one
+shard. Shards are written to TEAM_INDEX_DIR ('' disables the index);
+``python team_index.py`` refreshes it outside the server.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from math import comb
+
+import numpy as np
+
+import scoring
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.getenv('TEAM_INDEX_DIR', 'team_index')
+MANIFEST = 'manifest.json'
+# Rosters without a narrowing query (see TeamLookup): teams per main checked
+# in a first gather, and in a second for the mains still short of teams,
+# and the most teammate triples looked up instead
+HEAD_TEAMS = (256, int(os.getenv('TEAM_INDEX_HEAD_TEAMS', 4096)))
+LOOKUP_MAX_TRIPLES = int(os.getenv('TEAM_INDEX_LOOKUP_TRIPLES', 1000))
+
+with open(scoring.__file__, 'rb') as _scoring, open(__file__, 'rb') as _index:
+    # Scores and layout change with either module's code
+    SCHEMA_HASH = hashlib.sha256(_scoring.read() + _index.read()).hexdigest()[:16]
+
+
+def _digest(*parts):
+    h = hashlib.sha256(SCHEMA_HASH.encode())
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:24]
+
+
+def _record(table, c):
+    record = table.records[c]
+    return [record.name, table.element_names[record.element], record.roles, record.tier_value,
+            record.nightsoul, record.off_field]
+
+
+def shard_fingerprints(table, rules):
+    """{main name: fingerprint} for every character that can be a main DPS."""
+    teammates = np.flatnonzero(table.roles & (scoring.ROLE_SUB_DPS | scoring.ROLE_SUPPORT))
+    character_rules = {c: rule for c, *rule in rules.character_rules}
+    weights = (list(scoring.RESONANCE_WEIGHTS.items()), list(scoring.REACTION_WEIGHTS.items()))
+    pair = rules.pair_score
+
+    universe = _digest(
+        weights,
+        [_record(table, c) for c in teammates],
+        [character_rules.get(int(c)) for c in teammates],
+        rules.preferred_elements[teammates].tobytes(),
+        rules.excluded_elements[teammates].tobytes(),
+        np.ascontiguousarray(pair[np.ix_(teammates, teammates)]).tobytes(),
+    )
+    fingerprints = {}
+    for m in np.flatnonzero(table.roles & scoring.ROLE_MAIN_DPS):
+        fingerprints[table.names[m]] = _digest(
+            universe,
+            _record(table, m),
+            character_rules.get(int(m)),
+            [int(rules.preferred_elements[m]), int(rules.excluded_elements[m]), int(pair[m, m])],
+            np.ascontiguousarray(pair[m, teammates]).tobytes(),
+            np.ascontiguousarray(pair[teammates, m]).tobytes(),
+        )
+    return fingerprints
+
+
+def build_shard(roster, rules, order, m):
+    """Every team main ``m`` owns, best first: ``(members, scores)`` with
+    members as enumerate_candidates rows of roster indices."""
+    teammates = np.flatnonzero(roster.roles & (scoring.ROLE_SUB_DPS | scoring.ROLE_SUPPORT))
+    teammates = teammates[teammates != m].astype(np.int16)
+    if len(teammates) < 3:
+        return np.empty((0, 4), dtype=np.int16), np.empty(0, dtype=np.int32)
+    members = np.empty((len(teammates) * (len(teammates) - 1) * (len(teammates) - 2) // 6, 4), dtype=np.int16)
+    members[:, 0] = m
+    members[:, 1:] = teammates[scoring._combination_positions(len(teammates), 3)]
+    valid, keys = scoring.team_order_keys(roster, order, members)
+    owned = valid & (scoring.owner_of(keys) == order[m])
+    members, keys = members[owned], keys[owned]
+    scores = scoring.score_teams(roster, rules, members)
+    best = np.argsort(scoring.rank_keys(scores, keys), kind='stable')
+    return scoring.key_members(keys[best], order).astype(np.int16), scores[best].astype(np.int32)
+
+
+class Shard:
+    __slots__ = ('main', 'fingerprint', 'members', 'scores', 'element_bits', 'formats', 'postings')
+
+    def __init__(self, main, fingerprint, members, scores):
+        self.main = main
+        self.fingerprint = fingerprint
+        self.members = members  # character ids, enumeration layout
+        self.scores = scores
+        # For queries: each team's ELEMENT_BITS and format (see prepare),
+        # and the positions of the teams with a character, on first use
+        self.element_bits = None
+        self.formats = None
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def prepare(self, table):
+        # Once per shard, when refresh builds or loads it
+        if self.formats is None:
+            self.element_bits = np.bitwise_or.reduce(scoring.element_bits(table)[self.members], axis=1).astype(np.uint8)
+            self.formats = scoring.first_formats(table, self.members)
+
+    def posting(self, c):
+        """Positions, best first, of the teams with character ``c``."""
+        positions = self.postings.get(c)
+        if positions is None:
+            members = self.members
+            positions = np.flatnonzero((members[:, 1] == c) | (members[:, 2] == c) | (members[:, 3] == c))
+            self.postings[c] = positions
+        return positions
+
+    def with_members(self, required):
+        """Positions of the teams holding every ``required`` id, or None
+        for all of them."""
+        positions = None
+        others = [c for c in required if c != self.members[0, 0]] if len(self) else []
+        # Shortest posting list first
+        for c in sorted(others, key=lambda c: len(self.posting(c))):
+            positions = self.posting(c) if positions is None else np.intersect1d(
+                positions, self.posting(c), assume_unique=True)
+        return positions
+
+    def matches(self, pos, elements, forbidden, formats):
+        """Mask of the teams at ``pos`` with a member of each element in the
+        ``elements`` bitmask and none of ``forbidden``, first generated in a
+        format ``formats`` (a flag per FORMAT_*, or None for any) allows."""
+        keep = np.ones(len(pos), dtype=bool)
+        if elements or forbidden:
+            bits = self.element_bits[pos]
+            keep &= ((bits & elements) == elements) & ((bits & forbidden) == 0)
+        if formats is not None:
+            keep &= formats[self.formats[pos]]
+        return keep
+
+
+def id_masks(ids, words):
+    # Bitmask of the ids along the last axis, as a list of ``words`` uint64 words
+    ids = ids.astype(np.uint64)
+    return [np.where(ids // 64 == w, np.uint64(1) << (ids % 64), np.uint64(0)).sum(axis=-1, dtype=np.uint64)
+            for w in range(words)]
+
+
+def teammate_codes(teammates, n):
+    # Rows of three ascending ids below n as one number each
+    teammates = teammates.astype(np.uint64)
+    return (teammates[:, 0] * n + teammates[:, 1]) * n + teammates[:, 2]
+
+
+class TeamLookup:
+    """Every shard's teams again, laid out for rosters without a narrowing
+    query, which are answered without a loop over their mains. A team is
+    one number here: its main's ``offsets`` entry plus its position, so
+    numbers sort by main, then position.
+
+    ``heads`` holds the teammates (as id_masks) of each main's first teams,
+    so one pass finds a roster's best teams under all its mains at once:
+    first in the first HEAD_TEAMS[0] teams, then, for the mains that did not
+    get enough, down to HEAD_TEAMS[1]. Mains still short, and small rosters,
+    whose teams are few and far between, look each of their teammate
+    triples up instead: ``teams`` lists every team sorted by its teammates,
+    then its main, so a triple is one range holding its team under every
+    main, and ``starts`` holds where each triple's range begins.
+    """
+
+    def __init__(self, shards, n):
+        self.n = n
+        self.words = n // 64 + 1
+        self.lengths = np.zeros(n, dtype=np.int64)
+        for m, shard in shards.items():
+            self.lengths[m] = len(shard)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        by_main = sorted(shards.items())
+        self.scores = np.concatenate([shard.scores for _, shard in by_main])
+        # Teammate id n is never in a roster; it pads short shards
+        heads = np.full((n, HEAD_TEAMS[-1], 3), n, dtype=np.int16)
+        for m, shard in by_main:
+            heads[m, :min(len(shard), HEAD_TEAMS[-1])] = shard.members[:HEAD_TEAMS[-1], 1:]
+        self.heads = id_masks(heads, self.words)
+
+        mains = np.concatenate([np.full(len(shard), m, dtype=np.int16) for m, shard in by_main])
+        members = np.concatenate([shard.members for _, shard in by_main])
+        codes = teammate_codes(np.sort(members[:, 1:], axis=1), n)
+        self.teams = np.lexsort((mains, codes)).astype(np.int32)
+        self.team_mains = mains[self.teams]
+        self.starts = np.searchsorted(codes[self.teams], np.arange(n ** 3 + 1, dtype=np.uint64)).astype(np.int32)
+
+    def find(self, teammates, in_main):
+        """The teams made of three of ``teammates`` (ascending ids) owned by
+        a main with ``in_main``."""
+        if len(teammates) < 3:
+            return self.teams[:0]
+        codes = teammate_codes(teammates[scoring._combination_positions(len(teammates), 3)], self.n)
+        start = self.starts[codes]
+        lengths = self.starts[codes + 1] - start
+        # Every range's entries, in order
+        found = np.arange(lengths.sum()) + np.repeat(start - np.cumsum(lengths) + lengths, lengths)
+        return self.teams[found[in_main[self.team_mains[found]]]]
+
+    def best(self, mains, teammates, max_teams_per_dps):
+        """best_teams as (mains, positions, scores) for a roster's mains with
+        a shard and its teammates (both ascending ids)."""
+        found = [self.teams[:0]]
+        if comb(len(teammates), 3) > LOOKUP_MAX_TRIPLES:
+            outside = [~word for word in id_masks(teammates, self.words)]
+            for end in HEAD_TEAMS:
+                missing = self.heads[0][mains, :end] & outside[0]
+                for heads, word in zip(self.heads[1:], outside[1:]):
+                    missing |= heads[mains, :end] & word
+                fits = missing == 0
+                counts = np.cumsum(fits, axis=1)
+                # Mains whose heads did not hold enough teams go on
+                short = (counts[:, -1] < max_teams_per_dps) & (self.lengths[mains] > end)
+                rows, positions = np.nonzero(fits & (counts <= max_teams_per_dps) & ~short[:, None])
+                found.append(self.offsets[mains[rows]] + positions)
+                mains = mains[short]
+                if not len(mains):
+                    break
+        if len(mains):
+            in_main = np.zeros(self.n, dtype=bool)
+            in_main[mains] = True
+            found.append(self.find(teammates, in_main))
+        teams = np.sort(np.concatenate(found))
+        # Each main's first max_teams_per_dps teams, as a walk would keep
+        found_mains = np.searchsorted(self.offsets, teams, side='right') - 1
+        teams = teams[np.arange(len(teams)) - np.searchsorted(teams, self.offsets[found_mains]) < max_teams_per_dps]
+        found_mains = np.searchsorted(self.offsets, teams, side='right') - 1
+        return found_mains, teams - self.offsets[found_mains], self.scores[teams]
+
+
+class TeamIndex:
+    def __init__(self, path=INDEX_DIR):
+        self.path = path
+        self.lock = threading.Lock()
+        self.table = None
+        self.order = None
+        self.shards = {}  # main id -> Shard
+        self.lookup = None  # TeamLookup over the shards, once complete
+        self.ready = False
+        self.lookups = {}  # main name -> lookups, i.e. popularity
+        self.last_refresh = {}
+
+    def _shard_path(self, main):
+        return os.path.join(self.path, f"{main}.npz")
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest.get("shards", {}) if manifest.get("schema") == SCHEMA_HASH else {}
+
+    def _load_shard(self, table, main, fingerprint):
+        try:
+            with np.load(self._shard_path(main)) as data:
+                names, members, scores = data['names'].tolist(), data['members'], data['scores']
+            # Ids are positions in character_data and may have moved since
+            remap = np.array([table.index.get(name, -1) for name in names], dtype=np.int16)
+            members = remap[members]
+            if (members < 0).any():
+                return None
+            return Shard(main, fingerprint, members, scores)
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("Unreadable team index shard '%s' will be rebuilt: %s", main, e)
+            return None
+
+    def _write(self, table, shards, built):
+        tmp = f"{self.path}.tmp"
+        os.makedirs(self.path, exist_ok=True)
+        for shard in built:
+            path = self._shard_path(shard.main)
+            with open(f"{path}.tmp", 'wb') as f:
+                np.savez(f, names=np.array(table.names), members=shard.members, scores=shard.scores)
+            os.replace(f"{path}.tmp", path)
+        manifest = {
+            "schema": SCHEMA_HASH,
+            "shards": {shard.main: {"fingerprint": shard.fingerprint, "teams": len(shard)} for shard in shards.values()},
+        }
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+        for name in os.listdir(self.path):
+            if name.endswith('.npz') and name[:-4] not in manifest["shards"]:
+                os.remove(os.path.join(self.path, name))
+
+    def refresh(self, table, rules, build=True):
+        """Load current shards from disk and rebuild stale ones (if ``build``).
+
+        The index answers queries only once every main DPS has a current
+        shard; until then best_teams returns None.
+        """
+        if not self.path:
+            return {}
+        start = time.perf_counter()
+        fingerprints = shard_fingerprints(table, rules)
+        stored = self._read_manifest()
+        roster = table.roster(table.names)
+        roster_rules = rules.for_roster(roster)
+        order = scoring.character_order(roster)
+
+        with self.lock:
+            current = {shard.main: shard for shard in self.shards.values()} if self.table is table else {}
+        shards, built, loaded = {}, [], 0
+        for main, fingerprint in fingerprints.items():
+            shard = current.get(main)
+            if shard is None or shard.fingerprint != fingerprint:
+                shard = None
+                if stored.get(main, {}).get("fingerprint") == fingerprint:
+                    shard = self._load_shard(table, main, fingerprint)
+                    loaded += shard is not None
+            if shard is None:
+                if not build:
+                    continue
+                members, scores = build_shard(roster, roster_rules, order, table.index[main])
+                shard = Shard(main, fingerprint, members, scores)
+                built.append(shard)
+            shard.prepare(table)
+            shards[table.index[main]] = shard
+
+        complete = len(shards) == len(fingerprints)
+        if built:
+            try:
+                self._write(table, {table.index[main]: shards[table.index[main]] for main in fingerprints}, built)
+            except OSError as e:
+                logger.warning("Could not write team index '%s': %s", self.path, e)
+        lookup = TeamLookup(shards, len(table)) if complete and shards else None
+        with self.lock:
+            self.table, self.order, self.shards, self.ready, self.lookup = table, order, shards, complete, lookup
+        self.last_refresh = {
+            "shards": len(shards),
+            "built": len(built),
+            "loaded": loaded,
+            "teams": int(sum(len(shard) for shard in shards.values())),
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+        logger.info("Team index: %d shards (%d rebuilt, %d loaded from '%s') in %.2fs", len(shards), len(built),
+                    loaded, self.path, self.last_refresh["seconds"])
+        return self.last_refresh
+
+    def best_teams(self, characters, num_teams, max_teams_per_dps, table=None, chunk_size=256, query=None):
+        """The ranked teams of a roster as enumerate_candidates rows of
+        names, or None if the index is not ready for this data (``table``,
+        the CharacterTable the caller works with, if given).
+
+        With a scoring.TeamQuery only matching teams are kept; its
+        excluded characters must already be left out of ``characters``.
+        """
+        with self.lock:
+            indexed, order, shards, ready, lookup = self.table, self.order, self.shards, self.ready, self.lookup
+        if not ready or (table is not None and table is not indexed):
+            return None
+        table = indexed
+        ids = table.ids(characters)
+        teammates = np.unique(ids[(table.roles[ids] & (scoring.ROLE_SUB_DPS | scoring.ROLE_SUPPORT)) != 0])
+        if lookup is not None and (query is None or not query.narrows):
+            return self._looked_up(lookup, table, order, shards, ids, teammates, num_teams, max_teams_per_dps)
+        in_roster = np.zeros(len(table), dtype=bool)
+        in_roster[ids] = True
+
+        required, wanted, forbidden, formats = [], 0, 0, None
+        if query is not None:
+            if any(name not in characters for name in query.include):
+                return []
+            required = table.ids(query.include).tolist()
+            wanted = query.element_mask()
+            for element in query.exclude_elements:
+                forbidden |= 1 << element
+            if len(query.formats) < len(scoring.FORMAT_NAMES):
+                formats = np.zeros(len(scoring.FORMAT_NAMES), dtype=bool)
+                formats[list(query.formats)] = True
+            bits = scoring.element_bits(table)
+            teammate_bits = int(np.bitwise_or.reduce(bits[teammates]))
+        filtered = bool(wanted or forbidden or formats is not None)
+
+        found_rows, found_scores, found_owner, found_pos = [], [], [], []
+        for m in ids.tolist():
+            shard = shards.get(m)
+            if shard is None:
+                continue
+            # Shards that cannot hold a match are never read
+            if query is not None and (wanted & ~int(bits[m]) & ~teammate_bits
+                                      or any(c != m and c not in teammates for c in required)):
+                continue
+            name = table.names[m]
+            self.lookups[name] = self.lookups.get(name, 0) + 1
+            # Only the teams with the required members are walked, in order
+            positions = shard.with_members(required)
+            end = len(shard) if positions is None else len(positions)
+            need, start, size = max_teams_per_dps, 0, chunk_size
+            # Walk down the shard in growing chunks until enough teams fit
+            while need > 0 and start < end:
+                pos = np.arange(start, min(start + size, end)) if positions is None else positions[start:start + size]
+                if filtered:
+                    # Per-team columns first; cheaper than the roster lookups
+                    pos = pos[shard.matches(pos, wanted, forbidden, formats)]
+                rows = shard.members[pos]
+                fits = np.flatnonzero(in_roster[rows[:, 1]] & in_roster[rows[:, 2]] & in_roster[rows[:, 3]])[:need]
+                found_rows.append(rows[fits])
+                found_scores.append(shard.scores[pos[fits]])
+                found_pos.append(pos[fits])
+                found_owner.append(np.full(len(fits), order[m]))
+                need -= len(fits)
+                start += size
+                size *= 4
+        if not found_rows:
+            return []
+        rows = np.concatenate(found_rows)
+        # rank_keys order: score, then owner, then place in the owner's block
+        best = np.lexsort((np.concatenate(found_pos), np.concatenate(found_owner), -np.concatenate(found_scores)))
+        return [[table.names[i] for i in row] for row in rows[best[:num_teams]]]
+
+    def _looked_up(self, lookup, table, order, shards, ids, teammates, num_teams, max_teams_per_dps):
+        # best_teams through the TeamLookup
+        mains = np.unique([m for m in ids.tolist() if m in shards]).astype(np.int64)
+        for m in mains.tolist():
+            name = table.names[m]
+            self.lookups[name] = self.lookups.get(name, 0) + 1
+        found_mains, positions, scores = lookup.best(mains, teammates, max_teams_per_dps)
+        best = np.lexsort((positions, order[found_mains], -scores))[:num_teams]
+        return [[table.names[i] for i in shards[m].members[pos]]
+                for m, pos in zip(found_mains[best].tolist(), positions[best].tolist())]
+
+    def roster_shards(self, characters, table=None):
+        """The shards of a roster's main DPS, or None like best_teams. A
+        shard's teams are the roster's once filtered to its members."""
+        with self.lock:
+            indexed, shards, ready = self.table, self.shards, self.ready
+        if not ready or (table is not None and table is not indexed):
+            return None
+        return [shards[m] for m in indexed.ids(characters).tolist() if m in shards]
+
+    def stats(self):
+        popular = sorted(self.lookups.items(), key=lambda item: -item[1])[:10]
+        return {"ready": self.ready, **self.last_refresh, "popular_mains": dict(popular)}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    from character_store import normalise
+    from snapshot import load_roster_data
+
+    data = load_roster_data()
+    table = scoring.CharacterTable(data["character_data"])
+    rules = scoring.compile_team_rules(data["team_rules"], data["character_data"], normalise)
+    print(json.dumps(TeamIndex().refresh(table, rules)))
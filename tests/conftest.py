@@ -0,0 +1,34 @@
+import os
+import random
+
+import pytest
+
+# server.py reads its data files and static/ relative to the repository
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# llm.py refuses to import without a key; the tests never reach Gemini
+os.environ.setdefault('API_KEY', 'test')
+# Keep the shared result store and the team index off disk
+os.environ.setdefault('STORE_PATH', '')
+os.environ.setdefault('TEAM_INDEX_DIR', '')
+
+
+@pytest.fixture(scope="session")
+def small_data():
+    """RosterData over a few dozen characters, the Travelers included,
+    small enough to build a team index for."""
+    import registry
+    import server
+    data = server.REGISTRY.get()
+    names = sorted(data.character_data)
+    keep = set(random.Random(0).sample(names, 30)) | {name for name in names if name.startswith('traveler-')}
+    character_data = {name: info for name, info in data.character_data.items() if name in keep}
+    return registry.RosterData(data.version, character_data, data.team_rules)
+
+
+@pytest.fixture(scope="session")
+def small_index(small_data, tmp_path_factory):
+    import team_index
+    index = team_index.TeamIndex(str(tmp_path_factory.mktemp("team_index")))
+    index.refresh(small_data.characters, small_data.rules)
+    assert index.ready
+    return index
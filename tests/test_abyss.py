@@ -0,0 +1,47 @@
+import random
+
+import numpy as np
+import pytest
+
+import abyss
+import scoring
+import server
+
+
+def ranked_roster(characters, data):
+    """The roster, its rules, its enumeration and its distinct teams with
+    their masks, best first like abyss.best_pairs ranks them."""
+    expanded = server.expand_traveler_variants(characters, data.character_data)
+    char_cache = server.build_char_cache(expanded, data)
+    roster = data.characters.roster(expanded)
+    rules = data.rules.for_roster(roster)
+    all_teams = scoring.enumerate_candidates(roster, *server.role_lists(char_cache))[0]
+    identity = abyss.identities(roster.names)
+    teams = all_teams[scoring.first_occurrences(all_teams, len(roster))]
+    masks, valid = abyss.team_masks(identity, teams)
+    teams, masks = teams[valid], masks[valid]
+    scores = scoring.score_teams(roster, rules, teams)
+    order = np.lexsort((scoring.team_ranks(teams, len(roster)), -scores))
+    return roster, rules, all_teams, identity, teams[order], scores[order], masks[order]
+
+
+@pytest.mark.parametrize("num_pairs", [1, 3, 10])
+def test_best_pairs_match_brute_force(small_data, small_index, num_pairs):
+    rng = random.Random(num_pairs)
+    names = sorted(small_data.character_data)
+    travelers = {name for name in names if name.startswith('traveler-')}
+    for n in range(12):
+        characters = sorted(rng.sample(names, rng.randint(6, 16)))
+        if n % 4 == 0:  # several Traveler variants, which no pair may share
+            characters = sorted(set(characters) | travelers)
+        roster, rules, all_teams, identity, teams, scores, masks = ranked_roster(characters, small_data)
+        expected = [(total, teams[i].tolist(), teams[j].tolist())
+                    for total, i, j in abyss.brute_force_pairs(scores, masks, num_pairs)]
+        sources = {
+            "search": abyss.EnumeratedCandidates(roster, rules, all_teams, identity),
+            "index": abyss.IndexedCandidates(small_index.roster_shards(characters), len(small_data.characters),
+                                             roster, identity),
+        }
+        for source, candidates in sources.items():
+            actual = [(total, a.tolist(), b.tolist()) for total, a, b, _, _ in abyss.best_pairs(candidates, num_pairs)]
+            assert actual == expected, (source, characters)
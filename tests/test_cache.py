@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from cache import LRUTTLCache, SingleFlight
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entry_expires_after_ttl():
+    clock = FakeClock()
+    cache = LRUTTLCache(maxsize=4, ttl=10, clock=clock)
+    cache.set("key", "value")
+
+    clock.now = 9.9
+    assert cache.get("key") == "value"
+
+    clock.now = 10.0
+    assert cache.get("key") is None
+    assert cache.get("key", "default") == "default"
+    assert len(cache) == 0
+    assert cache.stats()["expirations"] == 1
+
+
+def test_set_restarts_ttl():
+    clock = FakeClock()
+    cache = LRUTTLCache(ttl=10, clock=clock)
+    cache.set("key", 1)
+    clock.now = 8
+    cache.set("key", 2)
+    clock.now = 15
+    assert cache.get("key") == 2
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUTTLCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_failed_leader_fails_every_waiter_and_is_not_kept():
+    flights = SingleFlight()
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def main():
+        results = await asyncio.gather(*(flights.run("key", failing) for _ in range(3)), return_exceptions=True)
+        assert calls == 1
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert "key" not in flights and len(flights) == 0
+
+        # The failure is not cached: the next caller starts a new call
+        with pytest.raises(RuntimeError):
+            await flights.run("key", failing)
+        assert calls == 2
+
+    asyncio.run(main())
+    assert flights.stats() == {"inflight": 0, "calls": 2, "coalesced": 2}
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    flights = SingleFlight()
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def main():
+        leader = asyncio.ensure_future(flights.run("key", slow))
+        follower = asyncio.ensure_future(flights.run("key", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(main())
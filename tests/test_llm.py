@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+import llm
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class Models:
+    """``client.aio.models`` answering from a list of outcomes: an exception
+    to raise, a number of seconds to hang, or the text to return."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def generate_content(self, model, contents, config):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, float):
+            await asyncio.sleep(outcome)
+        return Response(outcome)
+
+    async def generate_content_stream(self, model, contents, config):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+
+        async def chunks():
+            for chunk in outcome:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield Response(chunk)
+        return chunks()
+
+
+class Client:
+    def __init__(self, models):
+        self.aio = type('Aio', (), {'models': models})()
+
+
+@pytest.fixture
+def models(monkeypatch):
+    def install(*outcomes):
+        stub = Models(*outcomes)
+        monkeypatch.setattr(llm, 'client', Client(stub))
+        return stub
+    monkeypatch.setattr(llm, '_backoff', lambda attempt: 0)
+    return install
+
+
+def test_retries_then_succeeds(models):
+    stub = models(ConnectionError("reset"), ConnectionError("reset"), "text")
+    assert asyncio.run(llm.generate_text("prompt", retries=2)) == "text"
+    assert stub.calls == 3
+
+
+def test_exhausted_retries_raise_llm_error(models):
+    stub = models(ConnectionError("reset"))
+    with pytest.raises(llm.LLMError, match="after 3 attempt"):
+        asyncio.run(llm.generate_text("prompt", retries=2))
+    assert stub.calls == 3
+
+
+def test_each_attempt_times_out(models):
+    stub = models(1.0)
+    with pytest.raises(llm.LLMError) as info:
+        asyncio.run(llm.generate_text("prompt", timeout=0.01, retries=1))
+    assert isinstance(info.value.__cause__, asyncio.TimeoutError)
+    assert stub.calls == 2
+
+
+def test_other_errors_are_not_retried(models):
+    stub = models(ValueError("bad request"), "text")
+    with pytest.raises(llm.LLMError):
+        asyncio.run(llm.generate_text("prompt", retries=2))
+    assert stub.calls == 1
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_stream_retries_before_the_first_chunk(models):
+    stub = models([ConnectionError("reset")], ["a", "b"])
+    assert asyncio.run(collect(llm.stream_text("prompt", retries=1))) == ["a", "b"]
+    assert stub.calls == 2
+
+
+def test_stream_is_not_retried_after_text(models):
+    stub = models(["a", ConnectionError("reset")], ["a", "b"])
+    received = []
+
+    async def main():
+        async for chunk in llm.stream_text("prompt", retries=2):
+            received.append(chunk)
+
+    with pytest.raises(llm.LLMError):
+        asyncio.run(main())
+    assert received == ["a"] and stub.calls == 1
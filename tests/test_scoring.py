@@ -0,0 +1,36 @@
+from itertools import combinations_with_replacement
+
+import numpy as np
+import pytest
+
+import scoring
+import server
+
+
+def compositions():
+    """(elements, team, cache) for every composition of four members, an
+    element each or none, with each number of its Dendro members off-field."""
+    none = len(scoring.ELEMENTS)
+    for elements in combinations_with_replacement(range(none + 1), 4):
+        for off_field_dendro in range(elements.count(scoring.DENDRO) + 1):
+            # Characters outside the data, so no character rule applies
+            team = [f"member-{i}" for i in range(4)]
+            dendro = [i for i, e in enumerate(elements) if e == scoring.DENDRO][:off_field_dendro]
+            cache = {name: scoring.Character(-1, name, e, 0, 0, False, i in dendro)
+                     for i, (name, e) in enumerate(zip(team, elements))}
+            yield list(elements), team, cache
+
+
+@pytest.mark.parametrize("weights", [{}, {"hyperbloom": 7, scoring.CRYO: -3}], ids=["default", "changed"])
+def test_element_table_matches_resonance_score(monkeypatch, weights):
+    for key, weight in weights.items():
+        table = scoring.REACTION_WEIGHTS if isinstance(key, str) else scoring.RESONANCE_WEIGHTS
+        monkeypatch.setitem(table, key, weight)
+    rules = server.REGISTRY.get().rules
+    mismatches = []
+    for elements, team, cache in compositions():
+        code = scoring.member_codes(np.array(elements), np.array([cache[name].off_field for name in team])).sum()
+        expected = server.calculate_resonance_score(elements, team, cache, rules)
+        if int(scoring.element_score_table()[code]) != expected:
+            mismatches.append((elements, expected, int(scoring.element_score_table()[code])))
+    assert not mismatches
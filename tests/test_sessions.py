@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+import server
+
+
+def expected_teams(session):
+    roster_data = session.roster_data
+    return server.generate_teams_optimized(session.characters(), roster_data.character_data, session.num_teams,
+                                           session.max_teams_per_dps, prune=False, parallel=False,
+                                           roster_data=roster_data)
+
+
+def random_toggles(seed, steps, start=8, most=30):
+    """(add, remove) lists toggling one to three characters at a time,
+    Traveler included, starting from ``start`` random characters and only
+    removing once more than ``most`` are selected."""
+    rng = random.Random(seed)
+    names = sorted(server.REGISTRY.get().character_data) + ['traveler']
+    selected = set(rng.sample(names, start))
+    yield sorted(selected), []
+    for _ in range(steps):
+        pool = sorted(selected) if len(selected) > most else names
+        toggled = rng.sample(pool, rng.randint(1, 3))
+        add = [name for name in toggled if name not in selected]
+        remove = [name for name in toggled if name in selected]
+        selected.symmetric_difference_update(toggled)
+        yield add, remove
+
+
+@pytest.mark.parametrize("seed, num_teams, max_teams_per_dps", [(1, 6, 2), (2, 10, 1), (3, 3, 3)])
+def test_toggles_match_full_generation(seed, num_teams, max_teams_per_dps):
+    session = None
+    for step, (add, remove) in enumerate(random_toggles(seed, steps=60)):
+        if session is None:
+            session = server.TeamSession(add, num_teams, max_teams_per_dps)
+        else:
+            session.update(add=add, remove=remove)
+        assert session.stored
+        assert session.teams == expected_teams(session), f"step {step}: +{add} -{remove}"
+
+
+def test_sessions_over_the_limit_search_and_come_back(monkeypatch):
+    # Small enough that the random walk crosses it both ways
+    monkeypatch.setattr(server, 'SESSION_MAX_TEAMS', 3000)
+    session = None
+    modes = set()
+    for step, (add, remove) in enumerate(random_toggles(4, steps=60, start=14, most=20)):
+        if session is None:
+            session = server.TeamSession(add)
+        else:
+            session.update(add=add, remove=remove)
+        modes.add(session.stored)
+        assert session.teams == expected_teams(session), f"step {step}: +{add} -{remove}"
+    assert modes == {True, False}
@@ -0,0 +1,85 @@
+import asyncio
+import sqlite3
+
+from store import PersistentStore
+
+
+def open_store(path, **kwargs):
+    return PersistentStore(str(path), readers=1, write_delay=0, compact_interval=0, **kwargs)
+
+
+def stored(path, namespace, key):
+    # A fresh store, so the value comes from the file rather than the queue
+    store = open_store(path)
+    try:
+        return asyncio.run(store.get(namespace, key))
+    finally:
+        store.close()
+
+
+def test_values_survive_a_new_store(tmp_path):
+    path = tmp_path / "results.sqlite3"
+    store = open_store(path)
+    store.put("teams", ("roster", 1), {"teams": [1, 2]}, ttl=60)
+    store.close()
+    assert stored(path, "teams", ("roster", 1)) == {"teams": [1, 2]}
+    assert store.stats()["writes"] == 1
+
+
+def test_writer_error_drops_the_batch_and_keeps_writing(tmp_path):
+    path = tmp_path / "results.sqlite3"
+    store = open_store(path)
+    # Not JSON-serialisable, so the writer fails on this batch
+    store.put("teams", "bad", object(), ttl=60)
+    store.close()
+    stats = store.stats()
+    assert stats["errors"] == 1 and stats["writes"] == 0 and stats["pending"] == 0
+    assert stored(path, "teams", "bad") is None
+
+    store = open_store(path)
+    store.put("teams", "good", "value", ttl=60)
+    store.close()
+    assert stored(path, "teams", "good") == "value"
+
+
+def test_read_error_counts_as_a_miss(tmp_path):
+    path = tmp_path / "results.sqlite3"
+    store = open_store(path)
+    store.put("teams", "key", "value", ttl=60)
+    store.close()
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE entries SET value = 'not json'")
+
+    store = open_store(path)
+    try:
+        assert asyncio.run(store.get("teams", "key")) is None
+        assert store.stats()["errors"] == 1 and store.stats()["misses"] == 1
+    finally:
+        store.close()
+
+
+def test_unavailable_path_disables_the_store(tmp_path):
+    store = open_store(tmp_path / "missing" / "results.sqlite3")
+    store.put("teams", "key", "value", ttl=60)
+    assert asyncio.run(store.get("teams", "key")) is None
+    assert not store.stats()["enabled"]
+
+
+def test_expired_entries_are_misses_and_compacted(tmp_path):
+    path = tmp_path / "results.sqlite3"
+    store = open_store(path)
+    store.put("teams", "old", "value", ttl=-1)
+    # Expired even while still queued
+    assert asyncio.run(store.get("teams", "old")) is None
+    store.put("teams", "new", "value", ttl=60)
+    store.close()
+    assert stored(path, "teams", "old") is None
+    assert stored(path, "teams", "new") == "value"
+
+    store = open_store(path)
+    conn = store._connect()
+    try:
+        assert store._compact(conn) == 1
+        assert conn.execute("SELECT key FROM entries").fetchall() == [('"new"',)]
+    finally:
+        conn.close()
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import httpx
+
+import server
+
+
+def events(body):
+    # (event, data) pairs of a text/event-stream response
+    for block in body.strip().split("\n\n"):
+        event, data = block.split("\n")
+        yield event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def post_stream(characters):
+    async def post():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+            return await client.post("/generate_teams_from_selection/stream", json={"characters": characters})
+    return asyncio.run(post())
+
+
+def roster():
+    return sorted(server.REGISTRY.get().character_data)[:10]
+
+
+def test_generation_error_ends_with_an_error_event(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("generation failed")
+    monkeypatch.setattr(server, 'generate_teams_coalesced', fail)
+
+    response = post_stream(roster())
+    assert response.status_code == 200
+    assert [event for event, _ in events(response.text)] == ["error"]
+
+
+def test_explanation_error_after_text_ends_with_an_error_event(monkeypatch):
+    async def fail(teams):
+        yield "text", {"team": 1, "key": "key", "text": "partial"}
+        raise RuntimeError("explanation failed")
+    monkeypatch.setattr(server, 'stream_sections', fail)
+    monkeypatch.setattr(server, 'cached_result', lambda key: asyncio.sleep(0))
+
+    received = list(events(post_stream(roster()).text))
+    assert [event for event, _ in received] == ["teams", "text", "error"]
+    assert "explanation failed" in received[-1][1]["detail"]
@@ -0,0 +1,28 @@
+import random
+
+import pytest
+
+import team_index
+
+
+@pytest.mark.parametrize("heads, triples", [
+    (team_index.HEAD_TEAMS, team_index.LOOKUP_MAX_TRIPLES),
+    ((2, 8), 0),  # heads for every roster, most mains short of teams
+    ((2, 8), 1 << 30),  # triples for every roster
+])
+def test_lookup_matches_the_walk(small_data, small_index, monkeypatch, heads, triples):
+    monkeypatch.setattr(team_index, 'HEAD_TEAMS', heads)
+    monkeypatch.setattr(team_index, 'LOOKUP_MAX_TRIPLES', triples)
+    lookup = team_index.TeamLookup(small_index.shards, len(small_index.table))
+    rng = random.Random(len(heads) + triples)
+    names = list(small_data.character_data)
+    found = 0
+    for _ in range(40):
+        characters = rng.sample(names, rng.randint(4, len(names)))
+        for num_teams, max_teams_per_dps in ((6, 2), (10, 1), (3, 3)):
+            monkeypatch.setattr(small_index, 'lookup', None)
+            walked = small_index.best_teams(characters, num_teams, max_teams_per_dps)
+            monkeypatch.setattr(small_index, 'lookup', lookup)
+            assert small_index.best_teams(characters, num_teams, max_teams_per_dps) == walked
+            found += len(walked)
+    assert found